@@ -15,7 +15,7 @@ from install_symlinked_scripts import install_symlinked_scripts
 pkgname = 'squid_dedup'
 version = None
 
-min_python = (3, 1)
+min_python = (3, 7)
 my_python = sys.version_info
 
 if my_python < min_python:
@@ -50,6 +50,7 @@ setup(
         'console_scripts': [
             'squid_dedup = squid_dedup.main',
             'gen_openSUSE_dedups = squid_dedup.utils.gen_openSUSE_dedups',
+            'gen_dedups = squid_dedup.utils.gen_dedups',
         ],
     },
     include_package_data = True,
@@ -64,11 +65,12 @@ setup(
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.1',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Internet',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: HTTP Servers',
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# asyncio fetch engine: a single thread drives many concurrent fetches
+# with plain HTTP/1.1 over asyncio streams, reusing proxy connections
+
+import ssl
+import time
+import queue
+import asyncio
+import logging
+import urllib.parse
+from collections import defaultdict
+
+from fetch import Fetch, QUEUE_TIMEOUT, FETCH_OK, FETCH_TRUNCATED, FETCH_ERROR
+from lib import profile
+
+log = logging.getLogger('afetch')
+
+# max. number of idle connections kept per server
+MAX_IDLE = 8
+# redirects are followed up to MAX_REDIRECTS times, like urllib does
+MAX_REDIRECTS = 10
+REDIRECTS = (301, 302, 303, 307, 308)
+USER_AGENT = 'squid_dedup'
+
+
+class HTTPError(Exception):
+    pass
+
+# transfer errors, asyncio.TimeoutError is an OSError as of python 3.11 only
+ERRORS = (OSError, HTTPError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+# TLS upgrade of an open stream, as of python 3.11
+START_TLS = hasattr(asyncio.StreamWriter, 'start_tls')
+
+
+class AsyncFetch(Fetch):
+    """ fetch objects from queue concurrently, using asyncio streams """
+    def __init__(self, config, queue):
+        super().__init__(config, queue)
+        self._sslctx = ssl.create_default_context()
+        self._idle = defaultdict(list)
+        # host: [semaphore, number of fetches holding, or waiting for it]
+        self._host_slots = {}
+        # items in process, by key
+        self._items = {}
+
+    def setup(self, config):
+        super().setup(config)
+        # note: the number of connections is applied on start only
+        self._connections = config.fetch_connections
+        self._blocksize = config.fetch_blocksize
+        self._proxies = {}
+        for scheme, proxy in (('http', config.http_proxy),
+                              ('https', config.https_proxy)):
+            if proxy:
+                self._proxies[scheme] = self.hostport(proxy)
+
+    @staticmethod
+    def hostport(proxy):
+        """ split a proxy specification (host:port, or an URL) """
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        return parts.hostname, parts.port or 80
+
+    @profile.profile('afetch')
+    def run(self, name):
+        log.debug('%s: running', name)
+        asyncio.run(self.dispatch(name))
+        log.debug('%s: finished', name)
+
+    async def dispatch(self, name):
+        """ feed queue items to concurrent workers """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self._connections)
+        tasks = set()
+        while not self._exiting:
+            await slots.acquire()
+            item = None
+            while item is None and not self._exiting:
+                self._profiler.check()
+                try:
+                    item = await loop.run_in_executor(None, self._queue.get,
+                                                      True, QUEUE_TIMEOUT)
+                except queue.Empty:
+                    pass
+            if item is None:
+                slots.release()
+                break
+            self._items[item[0]] = item
+            task = loop.create_task(self.worker(name, item, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # unfinished items are put back, and kept in the journal
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        # of tasks, that were cancelled before they started
+        for item in self.unfinished():
+            self.abort(item)
+        self._items.clear()
+        for idle in self._idle.values():
+            for conn in idle:
+                self.close(conn)
+        self._idle.clear()
+
+    async def worker(self, name, item, slots):
+        try:
+            if await self.process(name, item):
+                self._queue.done(item)
+        except asyncio.CancelledError:
+            # the engine exits: the item is fetched again
+            self.abort(item)
+            raise
+        except Exception as e:
+            log.error('%s: processing <%s> failed: %s', name, item[1], e)
+            self._queue.done(item)
+        finally:
+            self._items.pop(item[0], None)
+            slots.release()
+
+    def unfinished(self):
+        return list(self._items.values())
+
+    async def process(self, name, item):
+        """ process a queue item, returns True, if finished """
+        newurl, url, section = item[:3]
+        if self.seen(name, newurl, url):
+            return True
+        await asyncio.sleep(self._delay)
+        url = self.select(name, newurl, url, section)
+        host = urllib.parse.urlsplit(url).hostname
+        if not Fetch._breakers.allow(host):
+            return self.defer(name, item, host)
+        # limit concurrent fetches per origin host
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = [asyncio.Semaphore(Fetch._slots.limit or self._connections), 0]
+            self._host_slots[host] = slot
+        slot[1] += 1
+        try:
+            waited = 0.0
+            if slot[0].locked():
+                start = time.monotonic()
+                await slot[0].acquire()
+                waited = time.monotonic() - start
+            else:
+                await slot[0].acquire()
+            try:
+                ret = await self.fetch(name, url, section, waited)
+            finally:
+                slot[0].release()
+        finally:
+            # slots of idle hosts are dropped
+            slot[1] -= 1
+            if not slot[1]:
+                del self._host_slots[host]
+        return self.finish(name, item, host, ret)
+
+    async def fetch(self, name, url, section, host_wait):
+        """ fetch a single url, applying section limits and bandwidth limits """
+        bucket = Fetch._section_buckets.get(section)
+        if host_wait:
+            log.debug('%s: waited %.3fs for a fetch slot', name, host_wait)
+            self.account(host_wait = host_wait, host_throttled = 1)
+        start = time.monotonic()
+        try:
+            url, conn, status, header = await self.open(url)
+        except ERRORS as e:
+            log.error('%s: open <%s> failed: %s', name, url, e)
+            return FETCH_ERROR
+        latency = time.monotonic() - start
+        log.trace('%s: %s\n%s', name, url, header)
+        if status != 200:
+            self.close(conn)
+            return self.http_error(name, url, status, header.get('retry-after'))
+        # check, if object is cached already
+        if header.get('x-cache', '').startswith('HIT'):
+            log.debug('%s: %s is cached already', name, url)
+            self.close(conn)
+            return FETCH_OK
+        try:
+            length = int(header['content-length'])
+        except (KeyError, ValueError):
+            length = None
+        ret = self.admit(name, url, section, length, header.get('content-type'))
+        if ret is not None:
+            self.close(conn)
+            return ret
+        # object isn't fetched already, do it now
+        log.debug('%s: fetching %s', name, url)
+        chunked = 'chunked' in header.get('transfer-encoding', '').lower()
+        ret = FETCH_OK
+        complete = False
+        nbytes = 0
+        rate_wait = 0.0
+        start = time.monotonic()
+        try:
+            async for n in self.body(conn[0], length, chunked):
+                nbytes += n
+                wait = Fetch._bucket.reserve(n)
+                if bucket is not None:
+                    wait = max(wait, bucket.reserve(n))
+                if wait:
+                    rate_wait += wait
+                    await asyncio.sleep(wait)
+                if self._exiting:
+                    break
+            else:
+                complete = chunked or nbytes == length
+        except ERRORS as e:
+            log.error('%s: read <%s> failed: %s', name, url, e)
+            ret = FETCH_TRUNCATED
+        if complete and header.get('connection', '').lower() != 'close':
+            self.release(conn)
+        else:
+            self.close(conn)
+        return self.complete(name, url, ret, nbytes, length, latency,
+                             time.monotonic() - start, rate_wait)
+
+    async def body(self, reader, length, chunked):
+        """ read a response body, yielding the size of each block """
+        blocksize = self._blocksize
+        timeout = self._read_timeout
+        wait_for = asyncio.wait_for
+        if chunked:
+            while True:
+                line = await wait_for(reader.readline(), timeout)
+                try:
+                    size = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise HTTPError('invalid chunk size: %r' % line)
+                if not size:
+                    # skip trailer
+                    while (await wait_for(reader.readline(), timeout)) not in (
+                            b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size:
+                    data = await wait_for(reader.read(min(blocksize, size)), timeout)
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', size)
+                    size -= len(data)
+                    yield len(data)
+                await wait_for(reader.readexactly(2), timeout)
+        else:
+            # with a known length, truncation is detected by the caller
+            remaining = length
+            while remaining is None or remaining > 0:
+                data = await wait_for(reader.read(blocksize if remaining is None
+                                                  else min(blocksize, remaining)), timeout)
+                if not data:
+                    return
+                if remaining is not None:
+                    remaining -= len(data)
+                yield len(data)
+
+    async def open(self, url):
+        """ send a GET request for url, and follow its redirects, returns
+            the final url, connection, status and header
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            conn, status, header = await self.request(url)
+            if status not in REDIRECTS or 'location' not in header:
+                return url, conn, status, header
+            self.close(conn)
+            newurl = urllib.parse.urljoin(url, header['location'])
+            if urllib.parse.urlsplit(newurl).scheme not in ('http', 'https'):
+                raise HTTPError('redirect to <%s> refused' % newurl)
+            log.debug('redirect <%s> to <%s>', url, newurl)
+            url = newurl
+        raise HTTPError('more than %s redirects' % MAX_REDIRECTS)
+
+    async def request(self, url):
+        """ send a GET request for url, returns connection, status and header """
+        parts = urllib.parse.urlsplit(url)
+        while True:
+            conn, reused = await asyncio.wait_for(self.connect(parts),
+                                                  self._connect_timeout)
+            reader, writer, key = conn
+            try:
+                writer.write(self.request_header(parts, key))
+                await writer.drain()
+                status, header = await asyncio.wait_for(self.response_header(reader),
+                                                        self._read_timeout)
+            except ERRORS:
+                self.close(conn)
+                # the server might have closed an idle connection meanwhile
+                if reused:
+                    continue
+                raise
+            return conn, status, header
+
+    def request_header(self, parts, key):
+        if key[0] == 'proxy':
+            # absolute form for plain http via proxy
+            target = urllib.parse.urlunsplit(parts[:2] + (parts.path or '/', parts.query, ''))
+        else:
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+        return ('GET %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'User-Agent: %s\r\n'
+                'Accept-Encoding: identity\r\n'
+                '\r\n' % (target, parts.netloc, USER_AGENT)).encode('latin-1')
+
+    async def response_header(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise HTTPError('connection closed')
+        status = line.split(None, 2)
+        if len(status) < 2 or not status[0].startswith(b'HTTP/'):
+            raise HTTPError('invalid status line: %r' % line)
+        try:
+            status = int(status[1])
+        except ValueError:
+            raise HTTPError('invalid status line: %r' % line)
+        header = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise HTTPError('incomplete header')
+            key, _, value = line.decode('latin-1').partition(':')
+            header[key.strip().lower()] = value.strip()
+        return status, header
+
+    async def connect(self, parts):
+        """ get a connection for an URL, returns (reader, writer, key), reused """
+        scheme = parts.scheme
+        proxy = self._proxies.get(scheme)
+        port = parts.port or (443 if scheme == 'https' else 80)
+        if proxy is not None and scheme == 'http':
+            key = ('proxy', ) + proxy
+        else:
+            key = (scheme, parts.hostname, port, proxy)
+        idle = self._idle[key]
+        while idle:
+            conn = idle.pop()
+            if not conn[0].at_eof():
+                return conn, True
+            self.close(conn)
+        if proxy is None:
+            reader, writer = await asyncio.open_connection(
+                parts.hostname, port, ssl = self._sslctx if scheme == 'https' else None)
+        elif scheme == 'http':
+            reader, writer = await asyncio.open_connection(*proxy)
+        else:
+            reader, writer = await self.tunnel(proxy, parts.hostname, port)
+        return (reader, writer, key), False
+
+    async def tunnel(self, proxy, host, port):
+        """ open a TLS connection to host through a proxy CONNECT tunnel """
+        reader, writer = await asyncio.open_connection(*proxy)
+        try:
+            writer.write(('CONNECT %s:%s HTTP/1.1\r\nHost: %s:%s\r\n\r\n' % (
+                          host, port, host, port)).encode('latin-1'))
+            status, header = await self.response_header(reader)
+            if status != 200:
+                raise HTTPError('proxy CONNECT failed: HTTP status %s' % status)
+            if START_TLS:
+                await writer.start_tls(self._sslctx, server_hostname = host)
+                return reader, writer
+            # hand a duplicate of the tunnelled socket over to a new TLS stream
+            sock = writer.get_extra_info('socket').dup()
+        except BaseException:
+            writer.close()
+            raise
+        writer.close()
+        try:
+            return await asyncio.open_connection(sock = sock, ssl = self._sslctx,
+                                                 server_hostname = host)
+        except BaseException:
+            sock.close()
+            raise
+
+    def release(self, conn):
+        """ keep a connection for reuse """
+        idle = self._idle[conn[2]]
+        if len(idle) < MAX_IDLE:
+            idle.append(conn)
+        else:
+            self.close(conn)
+
+    def close(self, conn):
+        conn[1].close()
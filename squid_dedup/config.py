@@ -18,7 +18,13 @@ Usage: %(appname)s [-%(_cmdlin_options)s]%(_cmdlin_parmsg)s
        -c, --cfgfile=file   alternate primary config file
                             [default: %(cfgfile)s]
        -p, --protocol=file  log squid communication into file
-       -P, --profile        enable profiling code
+       -P, --profile        profile from the start (see SIGUSR2)
+       -D, --daemon         run as resolver daemon, serving the helpers
+                            on resolver_socket
+       -F, --fetch-worker   run as fetch worker process of a helper
+                            (internal, see fetch_process)
+       -S, --simulate       simulate the savings of the ruleset over the
+                            squid access.log files given as arguments
        -X, --extract        extract primary config file
 
 Description:
@@ -39,7 +45,19 @@ Command line switches take precedence over config file settings.
 By default, only errors and warnings are logged.
 Available log levels are: %(_loglevel_list)s
 
-Profiling data is written to %(profiledir)s
+SIGUSR2 opens and closes a profiling window at runtime. Each thread writes
+its profiling data as <window>-<pid>-<name>-<thread id>.pstats to
+%(profiledir)s
+
+With resolver_socket set, helpers relay requests to a resolver daemon
+(started with --daemon), that owns the ruleset, the rewrite cache and the
+fetch machinery for all of them. Helpers fall back to processing requests
+themselves, if the daemon isn't available.
+
+The simulator models a squid cache of simulate_cache_size bytes with and
+without store-id rewriting, and reports hit ratios and bytes saved per section
+and mirror, as well as the bytes, fetch sections would request. Pass the
+access.log files oldest first.
 
 Installation:
 
@@ -76,12 +94,133 @@ intdomain: %(intdomain)s
 http_proxy: %(http_proxy)s
 https_proxy: %(https_proxy)s
 
-# url fetcher thread count
+# fetch engine: threads or asyncio
+fetch_engine: %(fetch_engine)s
+
+# url fetcher thread count (threads engine)
 fetch_threads: %(fetch_threads)s
 
+# max. url fetcher thread count: one is added, while queued fetches wait longer
+# than fetch_scale_wait seconds, and one is retired after fetch_scale_idle
+# seconds without queued fetches (0: fetch_threads)
+fetch_threads_max: %(fetch_threads_max)s
+fetch_scale_wait: %(fetch_scale_wait)s
+fetch_scale_idle: %(fetch_scale_idle)s
+
+# run the fetchers in a worker process, supervised by the helper, in order to
+# not compete with the replies for the interpreter (bool, takes effect on restart)
+fetch_process: %(fetch_process)s
+
+# max. concurrent fetches (asyncio engine)
+fetch_connections: %(fetch_connections)s
+
 # fetch delay (in seconds)
 fetch_delay: %(fetch_delay)s
 
+# fetch bandwidth limit in bytes per second, k, M, G suffixes allowed
+# (0: unlimited), sections may specify their own fetch_rate additionally
+fetch_rate: %(fetch_rate)s
+
+# max. concurrent fetches from a single origin host (0: unlimited)
+fetch_host_limit: %(fetch_host_limit)s
+
+# fetch connect and read timeouts (in seconds)
+fetch_connect_timeout: %(fetch_connect_timeout)s
+fetch_read_timeout: %(fetch_read_timeout)s
+
+# retry failed fetches this many times, with exponential backoff, starting
+# with fetch_backoff seconds, up to fetch_backoff_max seconds
+fetch_retries: %(fetch_retries)s
+fetch_backoff: %(fetch_backoff)s
+fetch_backoff_max: %(fetch_backoff_max)s
+
+# stop fetching from an origin host for fetch_breaker_cooloff seconds
+# after fetch_breaker_failures consecutive failures (0: disabled)
+fetch_breaker_failures: %(fetch_breaker_failures)s
+fetch_breaker_cooloff: %(fetch_breaker_cooloff)s
+
+# fetch read buffer size in bytes (k, M suffixes allowed)
+fetch_blocksize: %(fetch_blocksize)s
+
+# fetch order: fifo or priority (popular and recently requested objects first)
+fetch_order: %(fetch_order)s
+
+# priority bonus (in seconds) for each additional request and mirror of an object
+fetch_request_bonus: %(fetch_request_bonus)s
+
+# number of objects, whose request statistics and fetch results are tracked
+fetch_track_size: %(fetch_track_size)s
+
+# max. number of queued fetches (0: unlimited), and what to do, if the queue
+# is full: reject new objects, drop-oldest or drop-lowest-priority
+fetch_queue_size: %(fetch_queue_size)s
+fetch_queue_overflow: %(fetch_queue_overflow)s
+
+# fetch queue journal path prefix: pending fetches survive restarts
+# (leave empty to keep the fetch queue in memory only)
+fetch_journal: %(fetch_journal)s
+
+# fetch objects exceeding the fetch_max_size of their section during these
+# hours only (e.g. 22-6, 0-24 all day, leave empty to skip oversized objects)
+fetch_offpeak_hours: %(fetch_offpeak_hours)s
+
+# fetch objects from the fastest known mirror, that matches the same section (bool)
+fetch_mirror_select: %(fetch_mirror_select)s
+
+# mirror statistics file: measured latency and throughput survive restarts
+# (leave empty to keep them in memory only)
+fetch_mirror_stats: %(fetch_mirror_stats)s
+
+# process squid requests as bytes, without text decoding and encoding (bool)
+fast_io: %(fast_io)s
+
+# comma separated list of URL canonicalization steps, applied before matching,
+# the result is the rewrite cache key (leave empty to disable):
+# host: lowercase scheme and host, port: drop default ports, slashes: collapse
+# repeated slashes of the path, percent: decode unreserved percent-encoded
+# characters, and uppercase the hex digits of the others
+canonicalize: %(_canonicalize_list)s
+
+# comma separated list of squid access.log files, or URL lists, whose most
+# frequent URLs fill the rewrite cache on startup (leave empty to disable)
+warmup: %(_warmup_list)s
+
+# warm-up: read this many bytes from the end of each file (k, M suffixes
+# allowed, 0: whole file), and cache up to warmup_urls URLs
+warmup_tail: %(warmup_tail)s
+warmup_urls: %(warmup_urls)s
+
+# simulator (--simulate): cache size, max. object size (0: unlimited)
+# in bytes (k, M, G suffixes allowed), and worker processes (0: CPU count)
+simulate_cache_size: %(simulate_cache_size)s
+simulate_max_object_size: %(simulate_max_object_size)s
+simulate_processes: %(simulate_processes)s
+
+# resolver daemon socket: helpers relay requests to a daemon started with
+# --daemon (leave empty to process requests in each helper)
+resolver_socket: %(resolver_socket)s
+
+# max. number of cached URL rewrites (0: unlimited)
+rewrite_cache_size: %(rewrite_cache_size)s
+
+# keep cached URL rewrites in a compact form: several times more entries fit
+# in the same memory, at the cost of slower lookups (bool)
+rewrite_cache_compact: %(rewrite_cache_compact)s
+
+# trace memory allocations, and log the differences with each SIGUSR1 (bool)
+# note: this slows allocations down considerably
+trace_memory: %(trace_memory)s
+
+# log requests, that took longer than this many milliseconds from reading
+# until their reply was flushed, or for their post-reply work (0: disabled)
+slow_request: %(slow_request)s
+
+# traffic statistics: track the most frequent objects and origin hosts of
+# each section (0: disabled), and count distinct URLs in 2**precision bytes
+# (4..16) per section, logged with SIGUSR1
+traffic_top: %(traffic_top)s
+traffic_precision: %(traffic_precision)s
+
 # reload changed config files automatically (bool)
 auto_reload: %(auto_reload)s
 
@@ -104,16 +243,44 @@ sysloglevel: %(_sysloglevel_str)s
 profile: %(profile)s
 profiledir: %(profiledir)s
 
+# sample the stacks of the dedup and fetch threads this many times per second,
+# and write them as flamegraph input to profiledir every sample_interval
+# seconds (0: disabled, the rate is lowered, if sampling exceeds 1%% CPU time)
+sample_rate: %(sample_rate)s
+sample_interval: %(sample_interval)s
+
 #[CDN]
 ## match a list of of urls
 #match: http:\/\/url-regex-1/(.*)
 #       http:\/\/url-regex-2/(.*)
 #       http:\/\/url-regex-3/(.*)
+## ...and/or a list of literal url prefixes, \\1 refers to the rest of the url
+#prefix: http://url-prefix-1/
+#        http://url-prefix-2/
 ## replace with an internal url: must result in a unique address
 #replace: http:\/\/url-repl.%%(intdomain)s/\\1
 ## fetch URLs (optional, default: False)
 ## useful for clients, that fetch byte ranges only from multiple sources
 #fetch: false
+## fetch bandwidth limit of this section in bytes per second (optional)
+#fetch_rate: 0
+## fetch objects only after this many requests (optional, default: 1)
+#fetch_min_requests: 1
+## ...or after requests from this many distinct URLs (optional, default: off)
+#fetch_min_mirrors: 0
+## fetch objects of this size only, according to their Content-Length
+## (optional, k, M, G suffixes allowed, 0: unlimited)
+#fetch_min_size: 0
+#fetch_max_size: 0
+## comma separated lists of content types (prefixes) to fetch, or not to fetch
+## (optional, default: all)
+#fetch_types: application/
+#fetch_deny_types: text/html
+## comma separated lists of query parameters (shell patterns) to remove from
+## the rewritten URL, or to keep exclusively (optional, default: all kept),
+## prefix rules remove them before the rewrite cache lookup already
+#strip_params: token, utm_*
+#keep_params: version
 
 #[sourceforge]
 #match: http:\/\/[a-zA-Z0-9\-\_\.]+\.dl\.sourceforge\.net\/(.*)
@@ -124,8 +291,9 @@ profiledir: %(profiledir)s
 import os
 import re
 import sys
+import copy
 import glob
-import queue
+import time
 import getopt
 import socket
 import logging
@@ -133,7 +301,8 @@ import logging
 from collections import OrderedDict
 
 # local imports
-from lib import configfile, logsetup, record, frec
+from lib import configfile, logsetup, record, frec, journal, trie, accesslog, profile, sampler
+from lib import canonical
 
 
 # setup logging
@@ -155,6 +324,16 @@ def strlist(list, joiner = ', '):
     return joiner.join(list)
 
 
+def empty_ruleset():
+    """return an empty ruleset: sections, prefix tries for str and bytes URLs,
+       and the URL canonicalizer (None: disabled)
+    """
+    return record.recordfactory('Ruleset', section_dict = OrderedDict(),
+                                prefix_trie = trie.PrefixTrie(),
+                                prefix_btrie = trie.PrefixTrie(),
+                                canonical = None)
+
+
 class Config:
     """Central configuration class"""
     if __name__ == '__main__':
@@ -182,12 +361,112 @@ class Config:
     http_proxy = 'localhost:3128'
     https_proxy = 'localhost:3128'
 
+    # fetch engine: threads or asyncio
+    fetch_engine = 'threads'
+    _fetch_engines = ('threads', 'asyncio')
+
     # number of fetcher threads
     fetch_threads = 5
+    # max. number of fetcher threads, seconds of queue wait time to grow,
+    # and seconds without backlog to shrink the pool of fetcher threads
+    fetch_threads_max = 0
+    fetch_scale_wait = 10.0
+    fetch_scale_idle = 60.0
+
+    # run the fetchers in a worker process
+    fetch_process = False
+    fetch_worker = False
+
+    # max. concurrent fetches of the asyncio engine
+    fetch_connections = 100
 
     # fetch delay in seconds
     fetch_delay = 15
 
+    # fetch bandwidth limit in bytes per second (0: unlimited)
+    fetch_rate = 0
+
+    # max. concurrent fetches per origin host (0: unlimited)
+    fetch_host_limit = 2
+
+    # fetch timeouts in seconds
+    fetch_connect_timeout = 10
+    fetch_read_timeout = 30
+
+    # fetch retries and backoff delays in seconds
+    fetch_retries = 3
+    fetch_backoff = 30
+    fetch_backoff_max = 3600
+
+    # per origin host circuit breakers
+    fetch_breaker_failures = 5
+    fetch_breaker_cooloff = 300
+
+    # fetch read buffer size in bytes
+    fetch_blocksize = 65536
+
+    # fetch order: fifo or priority
+    fetch_order = 'fifo'
+    _fetch_orders = ('fifo', 'priority')
+
+    # priority bonus in seconds per additional request and mirror
+    fetch_request_bonus = 60
+
+    # number of objects with tracked request statistics
+    fetch_track_size = 100000
+
+    # max. fetch queue size (0: unlimited) and overflow policy
+    fetch_queue_size = 10000
+    fetch_queue_overflow = journal.DROP_LOWEST
+
+    # fetch queue journal path prefix (empty: in memory only)
+    fetch_journal = ''
+
+    # off-peak hours for oversized objects (empty: skip them)
+    fetch_offpeak_hours = ''
+
+    # fetch from the fastest known mirror
+    fetch_mirror_select = True
+
+    # mirror statistics file (empty: in memory only)
+    fetch_mirror_stats = ''
+
+    # process squid requests as bytes
+    fast_io = True
+
+    # URL canonicalization steps (empty: disabled)
+    canonicalize = []
+
+    # rewrite cache warm-up files, tail size in bytes, and max. URLs
+    warmup = []
+    warmup_tail = accesslog.TAIL_SIZE
+    warmup_urls = accesslog.MAX_URLS
+
+    # simulator: access.log files, cache size, max. object size, and processes
+    simulate = []
+    simulate_cache_size = 10 << 30
+    simulate_max_object_size = 0
+    simulate_processes = 0
+
+    # resolver daemon socket (empty: disabled)
+    resolver_socket = ''
+    daemon = False
+
+    # max. number of cached URL rewrites (0: unlimited), and their representation
+    rewrite_cache_size = 100000
+    rewrite_cache_compact = False
+
+    # trace memory allocations
+    trace_memory = False
+
+    # slow request log threshold in milliseconds (0: disabled)
+    slow_request = 0
+
+    # traffic statistics: top objects and origins per section (0: disabled),
+    # and the precision of the distinct URL counts
+    traffic_top = 0
+    traffic_precision = 12
+
     # reload changed config files automatically
     auto_reload = True
 
@@ -224,24 +503,38 @@ class Config:
     # profiling
     profile = False
     profiledir = os.path.join(appdir, 'profiles')
+    # statistical profiler: samples per second (0: disabled), write interval
+    sample_rate = 0
+    sample_interval = sampler.INTERVAL
 
     # internal
     primary_section = 'global'
-    section_dict = OrderedDict()
-    fetch_queue = queue.Queue()
+    # the ruleset in use is replaced as a whole: section_dict refers to its sections
+    ruleset = empty_ruleset()
+    section_dict = ruleset.section_dict
+    fetch_queue = journal.JournalQueue()
+    # the ruleset under construction, its errors, and the time of a failed reload
+    _rules = None
+    _rule_errors = 0
+    _failtime = 0
+    # the primary config file, until load_aux_config() processed its sections
+    _primary_cf = None
 
     _loglevel_str = None
     _sysloglevel_str = None
     _include_list = None
+    _warmup_list = None
+    _canonicalize_list = None
     _loglevel_list = None
 
     # command line parameter
-    _cmdlin_options = 'hVvqPX'
+    _cmdlin_options = 'hVvqPDFSX'
     _cmdlin_paropt = 'l:L:s:c:'
-    _cmdlin_parmsg = '[-l log][-L loglvl][-s sysloglvl][-c cfg]'
+    _cmdlin_parmsg = '[-l log][-L loglvl][-s sysloglvl][-c cfg] [access.log ...]'
     _cmdlin_longopt = (
         'help', 'version', 'verbose', 'quiet', 'logfile=', 'loglevel=',
-        'syslog=', 'cfgfile=', 'profile', 'extract',
+        'syslog=', 'cfgfile=', 'profile', 'daemon', 'fetch-worker', 'simulate',
+        'extract',
     )
 
 
@@ -311,29 +604,93 @@ class Config:
                     self.sysloglevel = ll
             elif opt in ('-P', '--profile'):
                 self.profile = True
+            elif opt in ('-D', '--daemon'):
+                if not self.resolver_socket:
+                    exit(1, '%s: --daemon requires resolver_socket' % self.appname)
+                self.daemon = True
+            elif opt in ('-F', '--fetch-worker'):
+                self.fetch_worker = True
+            elif opt in ('-S', '--simulate'):
+                if not args:
+                    exit(1, '%s: --simulate requires access.log files' % self.appname)
+                self.simulate = args
 
-        if self.profile and not os.path.exists(self.profiledir):
-            os.makedirs(self.profiledir)
         logsetup.logsetup(self.loglevel, self.logfile, self.sysloglevel)
         log.trace('logsetup(logfile: %s, loglevel: %s, sysloglevel: %s)',
                   self.logfile, self.loglevel, self.sysloglevel)
-        self.load_aux_config()
+        # profile from the start: open a profiling window
+        if self.profile:
+            profile.Window.start(self.profiledir)
+        # thin clients load the ruleset, if they fall back to local processing
+        if not self.thin_client():
+            profile.runcall('config', self.load_aux_config)
+
+    def thin_client(self):
+        """ helpers relay requests to a resolver daemon, if configured """
+        return bool(self.resolver_socket) and not (self.daemon or self.simulate or
+                                                   self.fetch_worker)
+
+    def setup_fetch_queue(self):
+        # queue order and journal changes take effect on restart only
+        # note: thin clients of a resolver daemon don't need a fetch queue
+        if self.fetch_order == 'priority':
+            queueclass = journal.JournalPriorityQueue
+        else:
+            queueclass = journal.JournalQueue
+        try:
+            self.fetch_queue = queueclass(self.fetch_journal or None,
+                                          self.fetch_queue_size, self.fetch_queue_overflow)
+        except (OSError, journal.JournalError) as e:
+            log.error('fetch journal %s: %s: using memory queue',
+                      self.fetch_journal, e)
+            self.fetch_queue = queueclass(None, self.fetch_queue_size,
+                                          self.fetch_queue_overflow)
 
     def reload(self):
-        self.section_dict = OrderedDict()
-        self.load_primary_config(self.cfgfile)
-        self.load_aux_config()
+        return profile.runcall('config', self._reload)
+
+    def _reload(self):
+        """ load the config files again into a copy, while the current config
+            stays in use, and take over its settings and ruleset as a whole,
+            returns False, if the current config is kept due to errors
+        """
+        staged = copy.copy(self)
+        if not (staged.load_primary_config(self.cfgfile, reload = True) and
+                staged.load_aux_config()):
+            # don't retry, until the config files change again
+            self._failtime = time.time()
+            return False
+        # the new ruleset is switched to last
+        ruleset = staged.__dict__.pop('ruleset')
+        self.__dict__.update(staged.__dict__)
+        self.ruleset = ruleset
+        # the queue bound applies to subsequent puts
+        self.fetch_queue.limit = self.fetch_queue_size
+        self.fetch_queue.overflow = self.fetch_queue_overflow
+        # reset logging setup
+        logsetup.logsetup(self.loglevel, self.logfile, self.sysloglevel)
+        return True
 
-    def load_primary_config(self, cfgfile):
+    def load_primary_config(self, cfgfile, reload = False):
+        """ load the primary config file, and start a new ruleset with its
+            sections, returns False, if a reload failed
+        """
         log.trace('load_primary_config(%s)', cfgfile)
         try:
             cf = configfile.ConfigFile(self.defaults(), cfgfile)
         except configfile.ConfigFileError as e:
+            if reload:
+                log.error('%s: keeping the previous config', e)
+                return False
             log.critical(e)
             exit(2)
+        self._rules = empty_ruleset()
+        self._rule_errors = 0
         self.process_primary_section(cf)
         self.cfgtime = os.stat(cfgfile).st_mtime
-        self.process_aux_sections(cf, primary = True)
+        # its rule sections are processed by load_aux_config()
+        self._primary_cf = cf
+        return True
 
     def process_primary_section(self, cf):
         log.trace('process_primary_section(%s)', cf.filename)
@@ -343,11 +700,68 @@ class Config:
         self.http_proxy = cf.get(self.primary_section, 'http_proxy', self.http_proxy)
         self.https_proxy = cf.get(self.primary_section, 'https_proxy', self.https_proxy)
         # number of fetcher threads
-        self.fetch_threads = cf.getint(self.primary_section, 'fetch_threads',
-                                       self.fetch_threads)
+        self.fetch_engine = self.primary_option(cf.get, 'fetch_engine',
+                                                allowed = self._fetch_engines)
+        self.fetch_threads = self.primary_option(cf.getint, 'fetch_threads')
+        self.fetch_threads_max = self.primary_option(cf.getint, 'fetch_threads_max')
+        self.fetch_scale_wait = self.primary_option(cf.getfloat, 'fetch_scale_wait')
+        self.fetch_scale_idle = self.primary_option(cf.getfloat, 'fetch_scale_idle')
+        self.fetch_process = self.primary_option(cf.getbool, 'fetch_process')
+        self.fetch_connections = self.primary_option(cf.getint, 'fetch_connections')
         # fetch delay in seconds
-        self.fetch_delay = cf.getint(self.primary_section, 'fetch_delay', self.fetch_delay)
-        self.auto_reload = cf.getbool(self.primary_section, 'auto_reload', self.auto_reload)
+        self.fetch_delay = self.primary_option(cf.getint, 'fetch_delay')
+        # fetch limits
+        self.fetch_rate = self.primary_option(cf.getsize, 'fetch_rate')
+        self.fetch_host_limit = self.primary_option(cf.getint, 'fetch_host_limit')
+        # fetch timeouts, retries and circuit breakers
+        self.fetch_connect_timeout = self.primary_option(cf.getint,
+                                                         'fetch_connect_timeout')
+        self.fetch_read_timeout = self.primary_option(cf.getint, 'fetch_read_timeout')
+        self.fetch_retries = self.primary_option(cf.getint, 'fetch_retries')
+        self.fetch_backoff = self.primary_option(cf.getint, 'fetch_backoff')
+        self.fetch_backoff_max = self.primary_option(cf.getint, 'fetch_backoff_max')
+        self.fetch_breaker_failures = self.primary_option(cf.getint,
+                                                          'fetch_breaker_failures')
+        self.fetch_breaker_cooloff = self.primary_option(cf.getint,
+                                                         'fetch_breaker_cooloff')
+        self.fetch_blocksize = self.primary_option(cf.getsize, 'fetch_blocksize')
+        self.fetch_queue_size = self.primary_option(cf.getint, 'fetch_queue_size')
+        self.fetch_queue_overflow = self.primary_option(cf.get, 'fetch_queue_overflow',
+                                                allowed = journal.OVERFLOW_POLICIES)
+        self.fetch_journal = cf.get(self.primary_section, 'fetch_journal',
+                                    self.fetch_journal)
+        self.fetch_order = self.primary_option(cf.get, 'fetch_order',
+                                               allowed = self._fetch_orders)
+        self.fetch_request_bonus = self.primary_option(cf.getint, 'fetch_request_bonus')
+        self.fetch_track_size = self.primary_option(cf.getint, 'fetch_track_size')
+        self.fetch_offpeak_hours = cf.get(self.primary_section, 'fetch_offpeak_hours',
+                                          self.fetch_offpeak_hours)
+        self.fetch_mirror_select = self.primary_option(cf.getbool, 'fetch_mirror_select')
+        self.fetch_mirror_stats = cf.get(self.primary_section, 'fetch_mirror_stats',
+                                         self.fetch_mirror_stats)
+        self.fast_io = self.primary_option(cf.getbool, 'fast_io')
+        self.warmup = cf.getlist(self.primary_section, 'warmup', self.warmup)
+        self.canonicalize = cf.getlist(self.primary_section, 'canonicalize', self.canonicalize)
+        for step in self.canonicalize:
+            if step not in canonical.STEPS:
+                log.error('invalid canonicalize step <%s>: ignored (allowed: %s)',
+                          step, strlist(canonical.STEPS))
+        self.canonicalize = [step for step in self.canonicalize if step in canonical.STEPS]
+        self.warmup_tail = self.primary_option(cf.getsize, 'warmup_tail')
+        self.warmup_urls = self.primary_option(cf.getint, 'warmup_urls')
+        self.simulate_cache_size = self.primary_option(cf.getsize, 'simulate_cache_size')
+        self.simulate_max_object_size = self.primary_option(cf.getsize,
+                                                            'simulate_max_object_size')
+        self.simulate_processes = self.primary_option(cf.getint, 'simulate_processes')
+        self.resolver_socket = cf.get(self.primary_section, 'resolver_socket',
+                                      self.resolver_socket)
+        self.rewrite_cache_size = self.primary_option(cf.getint, 'rewrite_cache_size')
+        self.rewrite_cache_compact = self.primary_option(cf.getbool, 'rewrite_cache_compact')
+        self.trace_memory = self.primary_option(cf.getbool, 'trace_memory')
+        self.slow_request = self.primary_option(cf.getint, 'slow_request')
+        self.traffic_top = self.primary_option(cf.getint, 'traffic_top')
+        self.traffic_precision = self.primary_option(cf.getint, 'traffic_precision')
+        self.auto_reload = self.primary_option(cf.getbool, 'auto_reload')
         self.protocol = cf.get(self.primary_section, 'protocol', self.protocol)
         # includes
         self.include = cf.getlist(self.primary_section, 'include', self.include)
@@ -358,12 +772,30 @@ class Config:
         self.sysloglevel = logsetup.loglevel(cf.get(self.primary_section, 'sysloglevel',
                                                     self.sysloglevel))
         # profiling
-        self.profile = cf.getbool(self.primary_section, 'profile', self.profile)
+        self.profile = self.primary_option(cf.getbool, 'profile')
         self.profiledir = cf.get(self.primary_section, 'profiledir', self.profiledir)
-        # reset logging setup
-        logsetup.logsetup(self.loglevel, self.logfile, self.sysloglevel)
+        self.sample_rate = self.primary_option(cf.getint, 'sample_rate')
+        self.sample_interval = self.primary_option(cf.getint, 'sample_interval')
+
+    def primary_option(self, get, option, **kwargs):
+        """ return an option of the primary section, or its current value, if
+            the option is invalid: counted as error, a reload fails
+        """
+        value = getattr(self, option)
+        try:
+            return get(self.primary_section, option, value, **kwargs)
+        except (configfile.ConfigFileError, ValueError) as e:
+            log.error('%s:%s: %s', self.primary_section, option, e)
+            self._rule_errors += 1
+            return value
 
     def load_aux_config(self):
+        """ load the auxiliary config files into the new ruleset, and switch
+            to it, returns False, if the previous ruleset is kept due to errors
+        """
+        # rule sections of the primary config file
+        self.process_aux_sections(self._primary_cf, primary = True)
+        self._primary_cf = None
         # load auxiliary config files
         for include in self.include:
             log.trace('include(%s)', include)
@@ -373,7 +805,40 @@ class Config:
                     cf = configfile.ConfigFile(self.defaults(), cfgfile)
                 except configfile.ConfigFileError as e:
                     log.error(e)
+                    self._rule_errors += 1
+                    continue
                 self.process_aux_sections(cf)
+        self._rules.canonical = self.canonicalizer(self._rules)
+        return self.switch_ruleset()
+
+    def canonicalizer(self, rules):
+        """ return the canonicalizer of the rewrite cache keys, or None: it
+            strips the query parameters of prefix rules as well, thus the
+            variants of an URL share a cache entry
+        """
+        sections = rules.section_dict.values()
+        filters = []
+        if any(section.query_filter is not None and section.prefix for section in sections):
+            # all prefixes: a longer one without filter takes precedence
+            filters = [(prefix, section.query_filter)
+                       for section in sections for prefix in section.prefix]
+        if self.canonicalize or filters:
+            return canonical.Canonicalizer(self.canonicalize, filters)
+
+    def switch_ruleset(self):
+        """ replace the ruleset with the new one by a single reference
+            assignment, unless the new one has errors, and the old one is usable
+            (on reload, this applies to the staged copy of the config)
+        """
+        rules, self._rules = self._rules, None
+        if self._rule_errors and self.ruleset.section_dict:
+            log.error('%s errors in config files: keeping the previous ruleset',
+                      self._rule_errors)
+            return False
+        self.ruleset = rules
+        self.section_dict = rules.section_dict
+        log.debug('switched to ruleset with %s sections', len(rules.section_dict))
+        return True
 
     def process_aux_sections(self, cf, primary = False):
         log.trace('process_aux_sections(%s, primary = %s)', cf.filename, primary)
@@ -388,25 +853,126 @@ class Config:
 
     def process_section(self, cf, section):
         log.trace('process_section(%s: %s)', section, cf.items(section))
-        if section in self.section_dict:
+        rules = self._rules
+        if section in rules.section_dict:
             log.error('section [%s] already processed from %s: ignored',
-                      section, self.section_dict[section].cfgfile)
+                      section, rules.section_dict[section].cfgfile)
             return
         match = cf.getlist(section, 'match', splitter = '\n', vars = self.defaults())
-        match = [(arg, re.compile(arg, re.IGNORECASE)) for arg in match]
+        try:
+            match = [(arg, re.compile(arg, re.IGNORECASE)) for arg in match]
+        except re.error as e:
+            log.error('invalid match parameter in section [%s] of %s: %s',
+                      section, cf.filename, e)
+            self._rule_errors += 1
+            return
+        prefix = cf.getlist(section, 'prefix', splitter = '\n', vars = self.defaults())
         replace = cf.get(section, 'replace', vars = self.defaults())
-        fetch = cf.getbool(section, 'fetch', False)
-        if match and replace:
-            par = dict(match = match,
+        try:
+            fetch = cf.getbool(section, 'fetch', False)
+            fetch_rate = cf.getsize(section, 'fetch_rate', 0)
+            fetch_min_requests = cf.getint(section, 'fetch_min_requests', 1)
+            fetch_min_mirrors = cf.getint(section, 'fetch_min_mirrors', 0)
+            fetch_min_size = cf.getsize(section, 'fetch_min_size', 0)
+            fetch_max_size = cf.getsize(section, 'fetch_max_size', 0)
+        except (configfile.ConfigFileError, ValueError) as e:
+            log.error('%s in section [%s] of %s: section ignored', e, section, cf.filename)
+            self._rule_errors += 1
+            return
+        # content type prefixes, as expected by str.startswith()
+        fetch_types = tuple(t.lower() for t in cf.getlist(section, 'fetch_types'))
+        fetch_deny_types = tuple(t.lower() for t in cf.getlist(section, 'fetch_deny_types'))
+        # query parameters to remove from the rewritten URL, and from the
+        # rewrite cache key of prefix rules
+        strip_params = cf.getlist(section, 'strip_params')
+        keep_params = cf.getlist(section, 'keep_params')
+        query_filter = None
+        if strip_params or keep_params:
+            query_filter = canonical.QueryFilter(strip_params, keep_params)
+        if (match or prefix) and replace:
+            # prefix rules insert the rest of the URL in place of \1
+            head, sep, tail = replace.partition('\\1')
+            # bytes variants of the rules for fast_io, URLs are ASCII in practice
+            bmatch = [re.compile(arg.encode(), re.IGNORECASE) for arg, regexp in match]
+            par = dict(name = section,
+                       match = match,
+                       prefix = prefix,
                        replace = replace,
+                       prefix_replace = (head, tail),
+                       bmatch = bmatch,
+                       breplace = replace.encode(),
+                       prefix_breplace = (head.encode(), tail.encode()),
                        fetch = fetch,
+                       fetch_rate = fetch_rate,
+                       fetch_min_requests = fetch_min_requests,
+                       fetch_min_mirrors = fetch_min_mirrors,
+                       fetch_min_size = fetch_min_size,
+                       fetch_max_size = fetch_max_size,
+                       fetch_types = fetch_types,
+                       fetch_deny_types = fetch_deny_types,
+                       query_filter = query_filter,
                        cfgfile = cf.filename,
                        cfgtime = os.stat(cf.filename).st_mtime)
             rec = record.recordfactory('Section', **par)
-            self.section_dict[section] = rec
+            rules.section_dict[section] = rec
+            for arg in prefix:
+                # prefixes match case insensitive, like regular expressions
+                old = rules.prefix_trie.add(arg.lower(), rec)
+                if old is not None:
+                    log.error('prefix %s of section [%s] defined in [%s] already: ignored',
+                              arg, section, old.name)
+                    rules.prefix_trie.add(arg.lower(), old)
+                else:
+                    rules.prefix_btrie.add(arg.lower().encode(), rec)
         else:
-            log.error('invalid match/replace parameter in section [%s] of %s',
+            log.error('invalid match/prefix/replace parameter in section [%s] of %s',
                       section, cf.filename)
+            self._rule_errors += 1
+
+    @staticmethod
+    def clean(section, newurl):
+        """ return section and newurl without the query parameters, that
+            section strips (str and bytes), the canonicalizer stripped them
+            from URLs of prefix rules already
+        """
+        if section.query_filter is not None:
+            newurl = section.query_filter(newurl)
+        return section, newurl
+
+    def rewrite(self, url):
+        """ return (section, newurl) of the rule matching url, or None
+            prefix rules take precedence, the longest prefix wins, otherwise
+            the first matching regular expression in section order applies
+            url is expected in canonical form, see ruleset.canonical
+        """
+        # a reload might switch the ruleset meanwhile
+        rules = self.ruleset
+        found = rules.prefix_trie.match(url.lower())
+        if found is not None:
+            section, n = found
+            head, tail = section.prefix_replace
+            return self.clean(section, head + url[n:] + tail)
+        for name, section in rules.section_dict.items():
+            for match, regexp in section.match:
+                newurl, n = regexp.subn(section.replace, url)
+                if n:
+                    return self.clean(section, newurl)
+        return None
+
+    def rewrite_bytes(self, url):
+        """ bytes variant of rewrite() """
+        rules = self.ruleset
+        found = rules.prefix_btrie.match(url.lower())
+        if found is not None:
+            section, n = found
+            head, tail = section.prefix_breplace
+            return self.clean(section, head + url[n:] + tail)
+        for name, section in rules.section_dict.items():
+            for regexp in section.bmatch:
+                newurl, n = regexp.subn(section.breplace, url)
+                if n:
+                    return self.clean(section, newurl)
+        return None
 
     def check_sections_reload(self):
         if self.check_cfgfile_reload(self.cfgfile, self.cfgtime):
@@ -423,13 +989,15 @@ class Config:
             log.error('auto_reload: stat failed: %s', e)
             return True
         else:
-            if mtime > cfgtime:
+            if mtime > max(cfgtime, self._failtime):
                 log.info('auto_reload: change detected in %s', cfgfile)
                 return True
         return False
 
     def create_special_vars(self):
         self._include_list = strlist(self.include)
+        self._warmup_list = strlist(self.warmup)
+        self._canonicalize_list = strlist(self.canonicalize)
         self._loglevel_list = strlist(logsetup.loglevel_list)
         self._loglevel_str = logsetup.loglevel_str(self.loglevel)
         self._sysloglevel_str = logsetup.loglevel_str(self.sysloglevel)
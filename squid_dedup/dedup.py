@@ -7,20 +7,102 @@
 # StoreID redirector, see http://wiki.squid-cache.org/Features/StoreID
 
 import sys
+import time
 import select
 import logging
 
+from policy import FetchPolicy
+from lib import linereader
+from lib import accesslog
+from lib import profile
+from lib import histogram
+from lib import sketch
+from lib import urlcache
+
 log = logging.getLogger('dedup')
 
 DEDUP_TIMEOUT = 0.5
+# warm-up: match this many URLs, then yield to the request processing
+WARMUP_BATCH = 64
+WARMUP_PAUSE = 0.01
+# request latency stages (in microseconds): cache lookup or match of the URL,
+# reply write and flush, post-reply work (logging, fetch feeding, protocol),
+# and total: from reading the request until its reply was flushed
+LOOKUP, MATCH, REPLY, POST, TOTAL = STAGES = ('lookup', 'match', 'reply', 'post', 'total')
 
 class Dedup:
     """ deduplicate squid proxy urls """
-    def __init__(self, config):
-        self._config = config
+
+    # stdin reader of the bytes path: keeps partial lines across reloads
+    _reader = None
+    # request latency histograms per stage, kept across reloads
+    _latency = {stage: histogram.Histogram() for stage in STAGES}
+    # traffic sketches per section, kept across reloads (None: disabled)
+    _traffic = None
+
+    def __init__(self, config, pending = None, policy = None):
+        # requests to process first (e.g. unanswered by a resolver daemon)
+        self._pending = pending
         self._exiting = False
-        self._cache = {}
+        # note: the I/O mode takes effect on restart only
+        self._fast_io = config.fast_io
+        # fetch worker process, fed in place of a FetchPolicy
+        self._worker = policy
+        self.setup(config)
+
+    def setup(self, config):
+        """ (re)apply the settings of config, and start over with empty
+            rewrite caches for its ruleset
+        """
+        self._config = config
+        ruleset = config.ruleset
+        # rewrite caches: the oldest entries are evicted beyond rewrite_cache_size
+        size = config.rewrite_cache_size
+        if config.rewrite_cache_compact:
+            sections = list(ruleset.section_dict.values())
+            self._cache = urlcache.CompactCache(size, sections)
+            self._bcache = urlcache.CompactCache(size, sections, binary = True)
+        else:
+            self._cache = urlcache.FifoCache(size)
+            self._bcache = urlcache.FifoCache(size)
         self._protocol = config.protocol
+        self._slow = config.slow_request / 1000.0
+        # URL canonicalization: its result is the rewrite cache key
+        self._canonical = ruleset.canonical
+        self._bcanonical = None if ruleset.canonical is None else ruleset.canonical.bytes
+        self._policy = FetchPolicy(config) if self._worker is None else self._worker
+        self.setup_traffic(config)
+        # last, as the warm-up waits for it
+        self._ruleset = ruleset
+
+    @classmethod
+    def setup_traffic(cls, config):
+        """ start traffic sketches, if enabled, or their settings changed """
+        traffic = cls._traffic
+        if config.traffic_top <= 0:
+            traffic = None
+        elif traffic is None or (traffic.k, traffic.p) != (config.traffic_top,
+                                                           config.traffic_precision):
+            try:
+                traffic = sketch.Traffic(config.traffic_top, config.traffic_precision)
+            except ValueError as e:
+                log.error('traffic_precision: %s: traffic statistics disabled', e)
+                traffic = None
+        cls._traffic = traffic
+
+    @classmethod
+    def traffic(cls):
+        """ return the traffic statistics per section, or None, if disabled """
+        if cls._traffic is not None:
+            return cls._traffic.report()
+
+    def check_ruleset(self):
+        """ switch to a reloaded config, called by the dedup thread only,
+            thus requests are never served with a partially loaded config
+        """
+        if self._config.ruleset is not self._ruleset:
+            log.info('switching to the reloaded ruleset')
+            self.setup(self._config)
 
     def exit(self):
         self._exiting = True
@@ -30,26 +112,31 @@ class Dedup:
 
     def parse(self, url):
         #log.trace('parse: <%s>', url)
+        if self._canonical is not None:
+            url = self._canonical(url)
         try:
             return self._cache[url], True
         except KeyError:
-            for name, section in self._config.section_dict.items():
-                for match, regexp in section.match:
-                    newurl, n = regexp.subn(section.replace, url)
-                    if n:
-                        #log.trace('parse matched: %s: replacement: %s', match, newurl)
-                        self._cache[url] = (section, newurl)
-                        return (section, newurl), False
+            rule = self._config.rewrite(url)
+            if rule is not None:
+                #log.trace('parse matched: %s: replacement: %s', rule[0].name, rule[1])
+                self._cache[url] = rule
+                return rule, False
 
     def process(self, channel, url, options):
+        """ process a request, returns the reply args and the latency stages """
         #log.trace('process: channel %s, url: %s, options: %s', channel, url, options)
+        clock = time.perf_counter
         args = []
         if channel is not None:
             args.append(channel)
+        t = clock()
         try:
             (section, newurl), cached = self.parse(url)
         except TypeError:
-            newurl = None
+            section = newurl = None
+            cached = False
+        match = clock() - t
         if newurl:
             # rewrite URL
             args.extend(('OK', 'store-id=' + newurl))
@@ -57,9 +144,42 @@ class Dedup:
             # no error: just no rewrite
             args.append('ERR')
         # get the reply out of the door as quickly as possible
+        t = clock()
         self.stdout(*args)
+        flushed = clock()
         log.trace('out: %s', ' '.join(args))
-        # optional processing and logging
+        self.report(channel, url, section, newurl, options)
+        if newurl and self._traffic is not None:
+            self._traffic.update(section.name, url, newurl)
+        return args, (LOOKUP if cached else MATCH, match, flushed - t, flushed)
+
+    def account(self, url, start, stage, match, reply, flushed, post):
+        """ account the latency stages of a request in time.perf_counter() seconds:
+            read at start, reply flushed at flushed, post-reply work started at post
+            requests slower than slow_request are logged
+        """
+        end = time.perf_counter()
+        total = flushed - start
+        latency = self._latency
+        latency[stage].update(int(match * 1e6))
+        latency[REPLY].update(int(reply * 1e6))
+        latency[POST].update(int((end - post) * 1e6))
+        latency[TOTAL].update(int(total * 1e6))
+        if self._slow and (total > self._slow or end - post > self._slow):
+            if isinstance(url, bytes):
+                url = url.decode('utf-8', 'replace')
+            # wait: time spent on other requests of the batch, and in between
+            log.warning('slow request <%s>: %.1f ms, wait: %.1f, %s: %.1f, reply: %.1f, post: %.1f',
+                        url, total * 1e3, (total - match - reply) * 1e3, stage, match * 1e3,
+                        reply * 1e3, (end - post) * 1e3)
+
+    @classmethod
+    def latency(cls):
+        """ return the latency summaries of all stages """
+        return {stage: cls._latency[stage].summary() for stage in STAGES}
+
+    def report(self, channel, url, section, newurl, options):
+        """ log a processed request, and feed the fetcher """
         if log.isEnabledFor(logging.INFO):
             msg = []
             if channel is not None:
@@ -74,17 +194,177 @@ class Dedup:
                 msg.append('options <' + ' '.join(options) + '>')
             _log(', '.join(msg))
         # delay feeding the fetcher up to this point
-        if newurl is not None and not cached and section.fetch:
-            self._config.fetch_queue.put((newurl, url), block = False)
-        return args
+        if newurl is not None and section.fetch:
+            self._policy.request(section, newurl, url)
+
+    def parse_bytes(self, url):
+        """ bytes variant of parse(), returns (section, newurl, reply) or None """
+        if self._bcanonical is not None:
+            url = self._bcanonical(url)
+        try:
+            return self._bcache[url]
+        except KeyError:
+            return self.match_bytes(url)
+
+    def match_bytes(self, key):
+        """ match a canonical URL, and cache the result, returns (section,
+            newurl, reply) or None
+        """
+        rule = self._config.rewrite_bytes(key)
+        if rule is not None:
+            section, newurl = rule
+            rule = self._bcache[key] = (section, newurl, urlcache.REPLY + newurl)
+        return rule
 
+    def warmup(self):
+        """ fill the rewrite cache with the most frequent URLs of the warmup
+            files, in small batches, in order to not delay live requests
+        """
+        log.debug('warmup')
+        # after a reload, wait for the dedup thread to switch to the new ruleset
+        while self._ruleset is not self._config.ruleset and not self._exiting:
+            time.sleep(WARMUP_PAUSE)
+        start = time.time()
+        try:
+            urls = accesslog.top_urls(self._config.warmup, self._config.warmup_tail,
+                                   self._config.warmup_urls)
+        except OSError as e:
+            log.error('warmup failed: %s', e)
+            return
+        matched = 0
+        for i, url in enumerate(urls, 1):
+            if self._exiting:
+                break
+            if self._fast_io:
+                rule = self.parse_bytes(url)
+            else:
+                rule = self.parse(url.decode('utf-8', 'replace'))
+            if rule is not None:
+                matched += 1
+            if not i % WARMUP_BATCH:
+                time.sleep(WARMUP_PAUSE)
+        log.info('warmup: %s of %s URLs cached in %.1f sec.',
+                 matched, len(urls), time.time() - start)
+
+    @classmethod
+    def stdin_reader(cls):
+        if cls._reader is None:
+            cls._reader = linereader.LineReader(sys.stdin.fileno())
+        return cls._reader
+
+    def process_lines(self, lines, out, start = None):
+        """ process a batch of requests as bytes, and write all replies to out at once
+            start is the time.perf_counter() value, when the lines were read
+        """
+        clock = time.perf_counter
+        if start is None:
+            start = clock()
+        cache = self._bcache
+        bcanonical = self._bcanonical
+        replies = []
+        requests = []
+        for line in lines:
+            options = line.split()
+            channel = url = rule = None
+            stage = MATCH
+            t = clock()
+            try:
+                # pull out a decimal channel-ID, if available
+                if options[0].isdigit():
+                    channel = options.pop(0)
+                # an URL must be available for a valid request
+                url = options.pop(0)
+            except IndexError:
+                reply = b'ERR'
+            else:
+                key = url if bcanonical is None else bcanonical(url)
+                try:
+                    rule = cache[key]
+                    stage = LOOKUP
+                except KeyError:
+                    rule = self.match_bytes(key)
+                reply = b'ERR' if rule is None else rule[2]
+            if channel is not None:
+                reply = channel + b' ' + reply
+            replies.append(reply)
+            requests.append((line, channel, url, rule, options, stage, clock() - t))
+        # get the replies out of the door as quickly as possible
+        replies.append(b'')
+        t = clock()
+        out.write(b'\n'.join(replies))
+        out.flush()
+        flushed = clock()
+        # optional processing and logging: decode only, if needed
+        decode = lambda value: value.decode('utf-8', 'replace')
+        trace = log.isEnabledFor(logging.TRACE)
+        traffic = self._traffic
+        for (line, channel, url, rule, options, stage, match), reply in zip(requests, replies):
+            post = clock()
+            if trace:
+                log.trace('out: %s', decode(reply))
+            if channel is not None:
+                channel = decode(channel)
+            if url is None:
+                if channel is not None:
+                    log.error('channel %s, invalid input <%s>', channel, decode(line))
+                else:
+                    log.error('invalid input <%s>', decode(line))
+            elif rule is not None:
+                if traffic is not None:
+                    traffic.update(rule[0].name, url, rule[1])
+                if log.isEnabledFor(logging.INFO) or rule[0].fetch:
+                    self.report(channel, decode(url), rule[0], decode(rule[1]),
+                                [decode(option) for option in options])
+            elif log.isEnabledFor(logging.DEBUG):
+                self.report(channel, decode(url), None, None,
+                            [decode(option) for option in options])
+            if self._protocol:
+                try:
+                    open(self._protocol, 'ab').write(line + b'\n' + reply + b'\n')
+                except IOError as e:
+                    log.error('protocol logging error: %s', e)
+            if url is not None:
+                self.account(url, start, stage, match, flushed - t, flushed, post)
+
+    @profile.profile('dedup')
     def run(self):
         log.debug('running')
+        # requests, that were read as bytes already, continue that way
+        if self._fast_io or self._reader is not None:
+            self.run_bytes()
+        else:
+            self.run_text()
+        log.debug('finished')
+
+    def run_bytes(self):
+        """ read requests as bytes: no decoding, and no hidden line buffering """
+        out = sys.stdout.buffer
+        reader = self.stdin_reader()
+        if self._pending:
+            self.process_lines(self._pending, out)
+            self._pending = None
         while not self._exiting:
+            self._profiler.check()
+            self.check_ruleset()
+            if reader.wait(DEDUP_TIMEOUT):
+                start = time.perf_counter()
+                eof = not reader.fill()
+                lines = reader.lines()
+                if lines:
+                    self.process_lines(lines, out, start)
+                if eof:
+                    log.error('stdin closed. Ending the process.')
+                    break
+
+    def run_text(self):
+        while not self._exiting:
+            self._profiler.check()
+            self.check_ruleset()
             if sys.stdin in select.select([sys.stdin], [], [], DEDUP_TIMEOUT)[0]:
                 # we're explicitly using readline here, because
                 # that gives us the desired line buffered input
                 line = sys.stdin.readline()
+                start = time.perf_counter()
                 if line:
                     if line[-1] == '\n':
                         line = line[:-1]
@@ -106,15 +386,17 @@ class Dedup:
                         else:
                             log.error('invalid input <%s>', line)
                         self.stdout(*args)
+                        timing = None
                     else:
                         # process tokens
-                        args = self.process(channel, url, options)
+                        args, timing = self.process(channel, url, options)
                     if self._protocol:
                         try:
                             open(self._protocol, 'a').write(line + '\n' + ' '.join(args) + '\n')
                         except IOError as e:
                             log.error('protocol logging error: %s', e)
+                    if timing is not None:
+                        self.account(url, start, *timing, timing[-1])
                 else:
                     log.error('sys.stdin.readline() is false. Ending the process.')
                     break
-        log.debug('finished')
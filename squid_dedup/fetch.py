@@ -6,27 +6,111 @@
 
 import time
 import queue
+import random
 import urllib
+import urllib.parse
 import urllib.request
+import http.client
 import logging
-from collections import defaultdict
+import threading
+import email.utils
+from collections import defaultdict, OrderedDict
+
+from lib import ratelimit, sink, breaker, mirrors, profile
+from policy import FetchPolicy
 
 log = logging.getLogger('fetch')
 
-BLOCKSIZE = 8192
 QUEUE_TIMEOUT = 0.5
 
+# fetch results: FETCH_FAILED is permanent, FETCH_TRUNCATED and FETCH_ERROR are retried,
+# FETCH_SKIPPED objects are excluded by the section limits, FETCH_POSTPONED ones wait
+# for the off-peak hours
+(FETCH_OK, FETCH_FAILED, FETCH_TRUNCATED, FETCH_ABORTED, FETCH_ERROR,
+ FETCH_SKIPPED, FETCH_POSTPONED) = range(7)
+
+
+def retry_after(value):
+    """ convert a Retry-After header value (seconds or HTTP date) to seconds """
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def offpeak_hours(value):
+    """ convert an hour range (e.g. 22-6) to a (start, end) tuple """
+    start, end = (int(hour) for hour in value.split('-'))
+    if not (0 <= start < 24 and 0 <= end <= 24):
+        raise ValueError('hours out of range: %s' % value)
+    # it would postpone the objects forever
+    if start == end:
+        raise ValueError('empty hour range: %s (0-24: all day)' % value)
+    return start, end
+
+
+def offpeak_wait(hours, now = None):
+    """ seconds until the off-peak hours (start, end) begin, 0 within """
+    start, end = hours
+    t = time.localtime(now)
+    hour = t.tm_hour + t.tm_min / 60 + t.tm_sec / 3600
+    if start <= end:
+        inside = start <= hour < end
+    else:
+        inside = hour >= start or hour < end
+    if inside:
+        return 0
+    return (start - hour) % 24 * 3600
+
+
 class Fetch:
 
-    _done = defaultdict(set)
+    # fetched objects and their source URLs, up to fetch_track_size objects
+    _done = OrderedDict()
+    _done_size = 0
+    _attempts = defaultdict(int)
+
+    # bandwidth and concurrency limits, shared by all fetch threads
+    _bucket = ratelimit.TokenBucket(0)
+    _section_buckets = {}
+    _slots = ratelimit.HostSlots(0)
+
+    # per origin host circuit breakers
+    _breakers = breaker.CircuitBreakers(0, 0)
+
+    # transfer statistics per origin host, for choosing the fastest mirror
+    _mirrors = mirrors.MirrorStats()
+
+    # off-peak hours (start, end) for oversized objects, or None
+    _offpeak = None
+
+    # throttling statistics
+    _stats_lock = threading.Lock()
+    _stats = defaultdict(float)
 
     """ fetch objects from queue """
     def __init__(self, config, queue):
-        self._config = config
         self._queue = queue
         self._exiting = False
+        # the item in process, if any
+        self.item = None
+        self.setup(config)
 
+    def setup(self, config):
+        """ (re)apply the fetch settings of config """
+        self._config = config
         self._delay = config.fetch_delay
+        self._connect_timeout = config.fetch_connect_timeout
+        self._read_timeout = config.fetch_read_timeout
+        self._retries = config.fetch_retries
+        self._backoff = config.fetch_backoff
+        self._backoff_max = config.fetch_backoff_max
+        self._mirror_select = config.fetch_mirror_select
+        self._sink = sink.DiscardSink(config.fetch_blocksize)
 
         # prepare proxies
         proxies = {}
@@ -39,50 +123,338 @@ class Fetch:
             opener = urllib.request.build_opener(proxy_support)
             urllib.request.install_opener(opener)
 
+    @classmethod
+    def configure(cls, config):
+        """ (re)configure limits shared by all fetch threads """
+        cls._bucket.configure(config.fetch_rate)
+        cls._done_size = config.fetch_track_size
+        cls._slots.limit = config.fetch_host_limit
+        cls._breakers.threshold = config.fetch_breaker_failures
+        cls._breakers.cooloff = config.fetch_breaker_cooloff
+        buckets = {}
+        for name, section in config.section_dict.items():
+            if section.fetch and section.fetch_rate:
+                bucket = cls._section_buckets.get(name)
+                if bucket is None:
+                    bucket = ratelimit.TokenBucket(section.fetch_rate)
+                else:
+                    bucket.configure(section.fetch_rate)
+                buckets[name] = bucket
+        cls._section_buckets = buckets
+        cls._offpeak = None
+        if config.fetch_offpeak_hours:
+            try:
+                cls._offpeak = offpeak_hours(config.fetch_offpeak_hours)
+            except ValueError as e:
+                log.error('invalid fetch_offpeak_hours <%s>: %s',
+                          config.fetch_offpeak_hours, e)
+        if (config.fetch_mirror_stats or None) != cls._mirrors.path:
+            cls._mirrors = mirrors.MirrorStats(config.fetch_mirror_stats)
+        log.debug('configure: %s, %s, %s, %s, %s', cls._bucket, cls._slots,
+                  cls._breakers, cls._mirrors, buckets)
+
+    @classmethod
+    def account(cls, **kwargs):
+        with cls._stats_lock:
+            for key, value in kwargs.items():
+                cls._stats[key] += value
+
+    @classmethod
+    def stats(cls):
+        with cls._stats_lock:
+            return dict(cls._stats)
+
     def exit(self):
         self._exiting = True
 
+    def throttle(self, nbytes, bucket):
+        """ apply global and section bandwidth limits """
+        waited = Fetch._bucket.consume(nbytes)
+        if bucket is not None:
+            waited += bucket.consume(nbytes)
+        return waited
+
+    @profile.profile('fetch')
     def run(self, name):
         log.debug('%s: running', name)
         while not self._exiting:
+            self._profiler.check()
             try:
-                newurl, url = self._queue.get(timeout = QUEUE_TIMEOUT)
+                item = self._queue.get(timeout = QUEUE_TIMEOUT)
             except queue.Empty:
                 continue
-            log.debug('%s: %s, %s', name, newurl, url)
-            if newurl in Fetch._done:
-                Fetch._done[newurl].add(url)
-                log.debug('%s: %s is fetched already: %s', name, url, newurl)
-                log.trace('%s: %s', Fetch._done[newurl])
-                continue
-            Fetch._done[newurl].add(url)
-            time.sleep(self._delay)
-            try:
-                response = urllib.request.urlopen(url)
-            except urllib.error.URLError as e:
-                log.error('%s: open <%s> failed: %s', name, url, e)
-            else:
-                # check, if object is cached already
-                header = response.info()
-                log.trace('%s: %s\n%s', name, url, header)
-                try:
-                    xcache = header['X-Cache']
-                except KeyError:
-                    pass
-                else:
-                    if xcache.startswith('HIT'):
-                        log.debug('%s: %s is cached already', name, url)
-                        continue
-                # object isn't fetched already, do it now
-                log.debug('%s: fetching %s', name, url)
-                while not self._exiting:
-                    try:
-                        data = response.read(BLOCKSIZE)
-                    except Exception as e:
-                        log.error('%s: read <%s> failed: %s', name, url, e)
-                    else:
-                        if not data:
-                            break
-                if not self._exiting:
-                    log.info('%s: <%s> fetched', name, url)
+            self.item = item
+            if self.process(name, item):
+                # keep unfinished items in the journal, when exiting
+                self._queue.done(item)
+            self.item = None
         log.debug('%s: finished', name)
+
+    def process(self, name, item):
+        """ process a queue item, returns True, if finished """
+        newurl, url, section = item[:3]
+        if self.seen(name, newurl, url):
+            return True
+        time.sleep(self._delay)
+        url = self.select(name, newurl, url, section)
+        host = urllib.parse.urlsplit(url).hostname
+        if not Fetch._breakers.allow(host):
+            return self.defer(name, item, host)
+        # limit concurrent fetches per origin host
+        waited = self.acquire_slot(host)
+        if waited is None:
+            return self.abort(item)
+        try:
+            ret = self.fetch(name, url, section, waited)
+        finally:
+            Fetch._slots.release(host)
+        return self.finish(name, item, host, ret)
+
+    def seen(self, name, newurl, url):
+        """ register url as source of newurl, returns True, if fetched already """
+        log.debug('%s: %s, %s', name, newurl, url)
+        done = Fetch._done
+        urls = done.get(newurl)
+        if urls is not None:
+            urls.add(url)
+            log.debug('%s: %s is fetched already: %s', name, url, newurl)
+            log.trace('%s: %s', name, urls)
+            return True
+        done[newurl] = {url}
+        if Fetch._done_size and len(done) > Fetch._done_size:
+            done.popitem(last = False)
+        return False
+
+    def select(self, name, newurl, url, section):
+        """ choose the fastest known mirror of newurl, that matches section """
+        if not self._mirror_select:
+            return url
+        urls = FetchPolicy.mirrors(newurl) | Fetch._done.get(newurl, set())
+        urls.discard(url)
+        if not urls:
+            return url
+        candidates = [(urllib.parse.urlsplit(url).hostname, url)]
+        for mirror in urls:
+            host = urllib.parse.urlsplit(mirror).hostname
+            if (not Fetch._breakers.remaining(host) and
+                    self.matches(section, newurl, mirror)):
+                candidates.append((host, mirror))
+        mirror = Fetch._mirrors.best(candidates, url)
+        if mirror != url:
+            log.debug('%s: fetch <%s> from mirror <%s>', name, url, mirror)
+            self.account(mirror_selected = 1)
+        return mirror
+
+    def matches(self, section, newurl, url):
+        """ check, if url is rewritten to newurl by section """
+        canonical = self._config.ruleset.canonical
+        if canonical is not None:
+            url = canonical(url)
+        rule = self._config.rewrite(url)
+        return rule is not None and rule[0].name == section and rule[1] == newurl
+
+    def finish(self, name, item, host, ret):
+        """ evaluate a fetch result, returns True, if item is finished """
+        if ret in (FETCH_TRUNCATED, FETCH_ERROR):
+            Fetch._breakers.failure(host)
+            return self.retry(name, item, host)
+        if ret == FETCH_ABORTED:
+            return self.abort(item)
+        # the host responded: even a permanent failure is a sign of life
+        Fetch._breakers.success(host)
+        Fetch._attempts.pop(item[0], None)
+        if ret == FETCH_POSTPONED:
+            return self.postpone(name, item)
+        return True
+
+    def abort(self, item):
+        """ put an item back into the queue, that is left unfinished by an
+            exiting fetcher, it stays in the journal
+        """
+        Fetch._done.pop(item[0], None)
+        self._queue.requeue(item)
+        return False
+
+    def unfinished(self):
+        """ items in process, that a terminated fetcher left behind, apart
+            from the item, that it might have crashed on
+        """
+        return []
+
+    def admit(self, name, url, section, length, ctype):
+        """ check the response header of url against the limits of section
+            returns None, if the object is to be fetched, or the fetch result
+        """
+        section = self._config.section_dict.get(section)
+        if section is None:
+            return None
+        if ctype:
+            ctype = ctype.split(';', 1)[0].strip().lower()
+            if ((section.fetch_types and not ctype.startswith(section.fetch_types)) or
+                    (section.fetch_deny_types and ctype.startswith(section.fetch_deny_types))):
+                log.info('%s: <%s> skipped: content type %s', name, url, ctype)
+                self.account(skipped = 1)
+                return FETCH_SKIPPED
+        if length is None:
+            return None
+        if length < section.fetch_min_size:
+            log.info('%s: <%s> skipped: %s bytes', name, url, length)
+            self.account(skipped = 1)
+            return FETCH_SKIPPED
+        if section.fetch_max_size and length > section.fetch_max_size:
+            if Fetch._offpeak is None:
+                log.info('%s: <%s> skipped: %s bytes', name, url, length)
+                self.account(skipped = 1)
+                return FETCH_SKIPPED
+            if offpeak_wait(Fetch._offpeak):
+                return FETCH_POSTPONED
+        return None
+
+    def postpone(self, name, item):
+        """ queue an oversized item again for the off-peak hours, with the lowest priority """
+        delay = offpeak_wait(Fetch._offpeak)
+        log.info('%s: <%s> postponed for %.0fs until off-peak hours', name, item[1], delay)
+        self.account(postponed = 1)
+        Fetch._done.pop(item[0], None)
+        self._queue.requeue(item[:-1] + (0, ), delay)
+        return False
+
+    def retry(self, name, item, host):
+        """ queue a failed item again after a backoff delay, or give it up """
+        newurl = item[0]
+        Fetch._attempts[newurl] += 1
+        attempt = Fetch._attempts[newurl]
+        if attempt > self._retries:
+            log.error('%s: <%s> failed %s times: given up', name, newurl, attempt)
+            Fetch._attempts.pop(newurl, None)
+            self.account(given_up = 1)
+            # finish the item, before a later request may queue it again
+            self._queue.done(item)
+            Fetch._done.pop(newurl, None)
+            FetchPolicy.release(newurl)
+            return False
+        delay = max(self.backoff(attempt), Fetch._breakers.remaining(host))
+        log.info('%s: retry <%s> in %.0fs (%s of %s)', name, item[1], delay,
+                 attempt, self._retries)
+        self.account(retried = 1)
+        Fetch._done.pop(newurl, None)
+        self._queue.requeue(item, delay)
+        return False
+
+    def backoff(self, attempt):
+        """ exponential backoff delay with jitter """
+        delay = min(self._backoff_max, self._backoff * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def defer(self, name, item, host):
+        """ postpone an item, while the circuit breaker of its host is open """
+        # a trial fetch might be under way, if the remaining time is 0
+        delay = Fetch._breakers.remaining(host) or Fetch._breakers.cooloff / 10
+        log.debug('%s: %s unavailable: defer <%s> for %.1fs', name, host, item[1], delay)
+        self.account(deferred = 1)
+        Fetch._done.pop(item[0], None)
+        self._queue.requeue(item, delay)
+        return False
+
+    def http_error(self, name, url, status, retry):
+        """ evaluate an HTTP error status, returns the fetch result """
+        log.error('%s: open <%s> failed: HTTP status %s', name, url, status)
+        if status in (429, 503) and retry:
+            seconds = retry_after(retry)
+            if seconds:
+                host = urllib.parse.urlsplit(url).hostname
+                log.info('%s: %s asks to retry after %.0fs', name, host, seconds)
+                Fetch._breakers.trip(host, seconds)
+        if status >= 500 or status in (408, 429):
+            return FETCH_ERROR
+        return FETCH_FAILED
+
+    def acquire_slot(self, host):
+        """ wait for a fetch slot of host, returns the time spent waiting,
+            or None, if exiting
+        """
+        if Fetch._slots.acquire(host, timeout = 0):
+            return 0.0
+        start = time.monotonic()
+        while not Fetch._slots.acquire(host, timeout = QUEUE_TIMEOUT):
+            if self._exiting:
+                return None
+        return time.monotonic() - start
+
+    def fetch(self, name, url, section, host_wait):
+        """ fetch a single url, applying section limits and bandwidth limits """
+        bucket = Fetch._section_buckets.get(section)
+        if host_wait:
+            log.debug('%s: waited %.3fs for a fetch slot', name, host_wait)
+            self.account(host_wait = host_wait, host_throttled = 1)
+        start = time.monotonic()
+        try:
+            response = urllib.request.urlopen(url, timeout = self._connect_timeout)
+        except urllib.error.HTTPError as e:
+            e.close()
+            return self.http_error(name, url, e.code, e.headers['Retry-After'])
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            log.error('%s: open <%s> failed: %s', name, url, e)
+            return FETCH_ERROR
+        latency = time.monotonic() - start
+        # switch from connect to read timeout
+        sock = getattr(getattr(response.fp, 'raw', None), '_sock', None)
+        if sock is not None:
+            sock.settimeout(self._read_timeout)
+        # check, if object is cached already
+        header = response.info()
+        log.trace('%s: %s\n%s', name, url, header)
+        # note: missing headers evaluate to None, instead of raising KeyError
+        xcache = header['X-Cache']
+        if xcache is not None and xcache.startswith('HIT'):
+            log.debug('%s: %s is cached already', name, url)
+            response.close()
+            return FETCH_OK
+        try:
+            length = int(header['Content-Length'])
+        except (TypeError, ValueError):
+            length = None
+        ret = self.admit(name, url, section, length, header['Content-Type'])
+        if ret is not None:
+            response.close()
+            return ret
+        # object isn't fetched already, do it now
+        log.debug('%s: fetching %s', name, url)
+        rate_wait = 0.0
+        def progress(n):
+            nonlocal rate_wait
+            rate_wait += self.throttle(n, bucket)
+            return not self._exiting
+        ret = FETCH_OK
+        try:
+            self._sink.drain(response, progress)
+        except Exception as e:
+            log.error('%s: read <%s> failed: %s', name, url, e)
+            ret = FETCH_TRUNCATED
+        finally:
+            response.close()
+        return self.complete(name, url, ret, self._sink.nbytes, length,
+                             latency, self._sink.elapsed, rate_wait)
+
+    def complete(self, name, url, ret, nbytes, length, latency, elapsed, rate_wait):
+        """ account and log a finished transfer, returns the fetch result """
+        self.account(fetched = 1, fetched_bytes = nbytes, fetch_time = elapsed)
+        if rate_wait:
+            log.debug('%s: <%s> throttled for %.3fs', name, url, rate_wait)
+            self.account(rate_wait = rate_wait, rate_throttled = 1)
+        if self._exiting:
+            return FETCH_ABORTED
+        if length is not None and nbytes < length:
+            log.error('%s: <%s> truncated: %s of %s bytes', name, url, nbytes, length)
+            ret = FETCH_TRUNCATED
+        if ret == FETCH_TRUNCATED:
+            self.account(truncated = 1)
+        else:
+            log.info('%s: <%s> fetched: %s bytes, %.1f kB/s', name, url, nbytes,
+                     nbytes / elapsed / 1024 if elapsed else 0.0)
+            # throttled time doesn't count for the mirror throughput
+            elapsed -= rate_wait
+            Fetch._mirrors.update(urllib.parse.urlsplit(url).hostname, latency,
+                                  nbytes / elapsed if nbytes >= mirrors.MIN_BYTES
+                                  and elapsed > 0 else None)
+        return ret
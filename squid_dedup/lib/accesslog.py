@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# extract URLs from squid access.log files (native, common and combined
+# format), or plain URL lists (one URL per line), as bytes
+
+import os
+import collections
+
+# read this many bytes from the end of a file
+TAIL_SIZE = 16 << 20
+# return this many URLs at most
+MAX_URLS = 10000
+
+
+def tail(path, size = TAIL_SIZE):
+    """yield the lines of the last size bytes of a file (0: whole file)
+       a partial first line is skipped
+    """
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        start = max(0, end - size) if size else 0
+        f.seek(start)
+        if start:
+            f.readline()
+        for line in f:
+            yield line
+
+
+def url(line):
+    """return the first URL of a line, or None
+       native format:   time elapsed client code/status bytes method URL ...
+       common format:   client ident user [date] "method URL proto" status bytes
+    """
+    for field in line.split():
+        if b'://' in field:
+            return field.strip(b'"')
+    return None
+
+
+def parse(line):
+    """return (timestamp, method, URL, status, size) of an access.log line,
+       or None, if the line can't be parsed, the timestamp of common format
+       lines is None
+    """
+    try:
+        if b'"' in line:
+            head, request, tail = line.split(b'"', 3)[:3]
+            method, url = request.split()[:2]
+            status, size = tail.split()[:2]
+            ts = None
+        else:
+            fields = line.split()
+            ts = float(fields[0])
+            status = fields[3].rpartition(b'/')[2]
+            size, method, url = fields[4:7]
+        return ts, method, url, int(status), int(size)
+    except (ValueError, IndexError):
+        return None
+
+
+def top_urls(paths, size = TAIL_SIZE, count = MAX_URLS):
+    """return the count most frequent URLs of the tails of all files, most
+       frequent first, OSErrors are passed on
+    """
+    counter = collections.Counter()
+    for path in paths:
+        counter.update(u for u in map(url, tail(path, size)) if u is not None)
+    return [u for u, n in counter.most_common(count)]
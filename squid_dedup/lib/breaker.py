@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import time
+import threading
+
+
+class Circuit:
+    """state of a single circuit"""
+    __slots__ = ('failures', 'until', 'trial')
+
+    def __init__(self):
+        self.failures = 0
+        # open until this (monotonic) time
+        self.until = 0.0
+        # start time of a trial request under way (half open state)
+        self.trial = 0.0
+
+
+class CircuitBreakers:
+    """thread safe circuit breakers, keyed by an arbitrary hashable (e.g. host)
+       a circuit opens after threshold consecutive failures, and rejects
+       requests for cooloff seconds, then a single trial request is allowed:
+       success closes the circuit, failure opens it again
+       a threshold of 0 disables the breakers, but trip() still works
+    """
+    def __init__(self, threshold, cooloff):
+        self._lock = threading.Lock()
+        self._circuits = {}
+        self.threshold = threshold
+        self.cooloff = cooloff
+
+    def allow(self, key):
+        """check, if a request for key is allowed"""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or not circuit.until:
+                return True
+            now = time.monotonic()
+            # a trial, that didn't report back in time, is given up
+            if now < circuit.until or now < circuit.trial + self.cooloff:
+                return False
+            circuit.trial = now
+            return True
+
+    def success(self, key):
+        with self._lock:
+            self._circuits.pop(key, None)
+
+    def failure(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                circuit = self._circuits[key] = Circuit()
+            circuit.failures += 1
+            if circuit.trial or (self.threshold and circuit.failures >= self.threshold):
+                circuit.until = time.monotonic() + self.cooloff
+                circuit.trial = 0.0
+
+    def trip(self, key, seconds):
+        """open the circuit of key for at least seconds, e.g. for Retry-After"""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                circuit = self._circuits[key] = Circuit()
+            circuit.until = max(circuit.until, time.monotonic() + seconds)
+            circuit.trial = 0.0
+
+    def remaining(self, key):
+        """seconds, until the circuit of key allows a trial request"""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or not circuit.until:
+                return 0.0
+            return max(0.0, circuit.until - time.monotonic())
+
+    def opened(self):
+        """list of keys with an open circuit"""
+        with self._lock:
+            return [key for key, circuit in self._circuits.items() if circuit.until]
+
+    def __repr__(self):
+        return '%s(threshold = %s, cooloff = %s)' % (self.__class__.__name__,
+                                                     self.threshold, self.cooloff)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import collections
+
+
+class LRUCache:
+    """model of a size limited LRU object cache: keeps keys and sizes only
+       objects larger than max_object_size (0: size) are never cached
+    """
+    def __init__(self, size, max_object_size = 0):
+        # key: object size, least recently used first
+        self._objects = collections.OrderedDict()
+        self.size = size
+        self.max_object_size = max_object_size or size
+        self.used = 0
+        self.evicted = 0
+
+    def request(self, key, size):
+        """account a request of an object, returns True on a hit"""
+        objects = self._objects
+        if key in objects:
+            objects.move_to_end(key)
+            return True
+        if size > self.max_object_size:
+            return False
+        objects[key] = size
+        self.used += size
+        while self.used > self.size:
+            key, size = objects.popitem(last = False)
+            self.used -= size
+            self.evicted += 1
+        return False
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __repr__(self):
+        return '%s(size = %s, used = %s, objects = %s, evicted = %s)' % (
+                self.__class__.__name__, self.size, self.used,
+                len(self._objects), self.evicted)
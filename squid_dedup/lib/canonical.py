@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# URL canonicalization: variants of an URL, that address the same object
+# (case of scheme and host, default ports, repeated slashes, percent-encoding,
+# volatile query parameters), are reduced to a single form
+
+import re
+import fnmatch
+
+from lib import trie
+
+# canonicalization steps
+HOST, PORT, SLASHES, PERCENT = STEPS = ('host', 'port', 'slashes', 'percent')
+
+DEFAULT_PORTS = {'http': '80', 'https': '443', 'ftp': '21'}
+# percent-encoded characters, that don't need to be encoded (RFC 3986)
+UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+URL_RE = re.compile(r'([a-zA-Z][a-zA-Z0-9+.\-]*://)([^/?#]*)(.*)', re.DOTALL)
+SLASHES_RE = re.compile(r'//+')
+PERCENT_RE = re.compile(r'%[0-9a-fA-F]{2}')
+# lowercase scheme and host without port or user info: a canonical URL, unless
+# the rest contains // or %
+CLEAN_RE = re.compile(r'[a-z][a-z0-9+.\-]*://[^/?#A-Z:@]*(?=[/?#]|$)')
+BCLEAN_RE = re.compile(CLEAN_RE.pattern.encode())
+
+
+def _percent(m):
+    """decode an unreserved character, uppercase the hex digits otherwise"""
+    c = chr(int(m.group()[1:], 16))
+    return c if c in UNRESERVED else m.group().upper()
+
+
+class Canonicalizer:
+    """canonicalize URLs with a selection of STEPS:
+       host: lowercase scheme and host
+       port: drop the default port of the scheme, and empty ports
+       slashes: collapse repeated slashes of the path
+       percent: decode percent-encoded unreserved characters, and uppercase
+       the hex digits of the others
+       URLs, that don't look like absolute URLs, are returned unchanged
+       filters are (prefix, QueryFilter or None) pairs, the filter of the
+       longest prefix of a canonical URL applies to its query, the first of
+       equal prefixes wins (prefixes are compared case insensitive)
+    """
+    def __init__(self, steps = STEPS, filters = ()):
+        for step in steps:
+            if step not in STEPS:
+                raise ValueError('invalid canonicalization step <%s>' % step)
+        self.steps = tuple(step for step in STEPS if step in steps)
+        self._host = HOST in steps
+        self._port = PORT in steps
+        self._slashes = SLASHES in steps
+        self._percent = PERCENT in steps
+        self._filters = self._bfilters = None
+        if filters:
+            self._filters, self._bfilters = trie.PrefixTrie(), trie.PrefixTrie()
+        for prefix, qf in filters:
+            prefix = prefix.lower()
+            found = self._filters.match(prefix)
+            if found is None or found[1] < len(prefix):
+                self._filters.add(prefix, qf)
+                self._bfilters.add(prefix.encode(), qf)
+
+    def __call__(self, url):
+        """return the canonical form of url (str)"""
+        if self.steps:
+            m = CLEAN_RE.match(url)
+            if m is None or url.find('%', m.end()) >= 0 or url.find('//', m.end()) >= 0:
+                url = self.canonical(url)
+        if self._filters is not None and '?' in url:
+            found = self._filters.match(url.lower())
+            if found is not None and found[0] is not None:
+                url = found[0](url)
+        return url
+
+    def bytes(self, url):
+        """bytes variant of __call__(): latin-1 maps each byte to a character"""
+        if self.steps:
+            m = BCLEAN_RE.match(url)
+            if m is None or url.find(b'%', m.end()) >= 0 or url.find(b'//', m.end()) >= 0:
+                url = self.canonical(url.decode('latin-1')).encode('latin-1')
+        if self._bfilters is not None and b'?' in url:
+            found = self._bfilters.match(url.lower())
+            if found is not None and found[0] is not None:
+                url = found[0](url)
+        return url
+
+    def canonical(self, url):
+        """canonicalize url (str), the hard way"""
+        m = URL_RE.match(url)
+        if m is None:
+            return url
+        scheme, authority, rest = m.groups()
+        if self._host:
+            scheme = scheme.lower()
+            userinfo, at, host = authority.rpartition('@')
+            authority = userinfo + at + host.lower()
+        if self._port:
+            host, colon, port = authority.rpartition(':')
+            # the port follows the last colon, IPv6 addresses are enclosed in brackets
+            if colon and (not port or port == DEFAULT_PORTS.get(scheme[:-3].lower())):
+                authority = host
+        if (self._slashes or self._percent) and ('%' in rest or '//' in rest):
+            path, sep, query = rest.partition('?')
+            if self._slashes:
+                path = SLASHES_RE.sub('/', path)
+            if self._percent:
+                path = PERCENT_RE.sub(_percent, path)
+                query = PERCENT_RE.sub(_percent, query)
+            rest = path + sep + query
+        return scheme + authority + rest
+
+
+class QueryFilter:
+    """remove query parameters of an URL (str or bytes): all parameters, whose
+       names match a pattern of strip, and unless keep is empty, all, that
+       don't match a pattern of keep (shell style patterns, e.g. utm_*)
+    """
+    def __init__(self, strip = (), keep = ()):
+        self.strip = tuple(strip)
+        self.keep = tuple(keep)
+        self._strip = self._compile(self.strip)
+        self._keep = self._compile(self.keep)
+        self._bstrip = self._compile(self.strip, bytes)
+        self._bkeep = self._compile(self.keep, bytes)
+
+    @staticmethod
+    def _compile(patterns, type = str):
+        if not patterns:
+            return None
+        regex = '|'.join(fnmatch.translate(pattern) for pattern in patterns)
+        if type is bytes:
+            regex = regex.encode('utf-8')
+        return re.compile(regex)
+
+    def __call__(self, url):
+        if isinstance(url, bytes):
+            sep, amp, eq = b'?', b'&', b'='
+            strip, keep = self._bstrip, self._bkeep
+        else:
+            sep, amp, eq = '?', '&', '='
+            strip, keep = self._strip, self._keep
+        head, sep, query = url.partition(sep)
+        if not query:
+            return url
+        params = []
+        for param in query.split(amp):
+            name = param.partition(eq)[0]
+            if strip is not None and strip.match(name):
+                continue
+            if keep is not None and not keep.match(name):
+                continue
+            params.append(param)
+        if not params:
+            return head
+        return head + sep + amp.join(params)
@@ -92,6 +92,25 @@ class ConfigFile(configparser.ConfigParser):
             value = float(super().get(section, option, **kwargs))
         return value
 
+    def getsize(self, section, option, default = None, **kwargs):
+        """ convert a size value with an optional k, M, G or T suffix (base 1024) """
+        value = default
+        if self.has_option(section, option):
+            value = super().get(section, option, **kwargs).strip()
+            factor = 1
+            unit = value[-1:].upper()
+            if unit in self._size_units:
+                factor = self._size_units[unit]
+                value = value[:-1].strip()
+            try:
+                value = int(float(value) * factor)
+            except ValueError:
+                raise ConfigFileError('invalid size value <%s> for %s:%s' % (
+                                      value, section, option))
+        return value
+
+    _size_units = dict(K = 1 << 10, M = 1 << 20, G = 1 << 30, T = 1 << 40)
+
     def _cleanup_defaults(self, defaults):
         """ConfigParser doesn't allow non string defaults mapping values"""
         if defaults is not None:
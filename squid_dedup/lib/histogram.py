@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# values below 2**SUB_BITS are counted exactly, larger values in
+# 2**(SUB_BITS - 1) buckets per power of 2 (relative error < 6.25%)
+SUB_BITS = 5
+# values from 2**MAX_BITS on are counted in the last bucket
+MAX_BITS = 32
+
+
+class Histogram:
+    """fixed bucket, log-linear histogram of non-negative integers
+       an update costs a bit_length(), a shift and a list increment
+    """
+    def __init__(self, sub_bits = SUB_BITS, max_bits = MAX_BITS):
+        self._sub = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self._last = self.index((1 << max_bits) - 1)
+        self.counts = [0] * (self._last + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        """return the bucket index of value"""
+        e = value.bit_length() - self._sub
+        if e <= 0:
+            return value
+        return e * self._half + (value >> e)
+
+    def bounds(self, index):
+        """return the lowest and highest value of bucket index"""
+        e = max(index // self._half - 1, 0)
+        m = index - e * self._half
+        return m << e, ((m + 1) << e) - 1
+
+    def update(self, value):
+        index = self.index(value)
+        if index > self._last:
+            index = self._last
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """return the upper bound of the q-th percentile (0 <= q <= 100)"""
+        if not self.count:
+            return 0
+        rank = q * self.count / 100.0
+        n = 0
+        for index, count in enumerate(self.counts):
+            n += count
+            if count and n >= rank:
+                return min(self.bounds(index)[1], self.max)
+        return self.max
+
+    def summary(self):
+        """return count, mean, p50, p90, p99 and max"""
+        return dict(count = self.count,
+                    mean = self.total // self.count if self.count else 0,
+                    p50 = self.percentile(50),
+                    p90 = self.percentile(90),
+                    p99 = self.percentile(99),
+                    max = self.max)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s = %s' % item for item in self.summary().items()))
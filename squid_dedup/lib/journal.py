@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import json
+import time
+import queue
+import fcntl
+import heapq
+import logging
+import itertools
+import collections
+
+log = logging.getLogger('journal')
+
+# max. number of journal slots, that are probed for a free one
+MAX_SLOTS = 256
+# compact the journal, if it contains at least COMPACT_MIN records,
+# and more than COMPACT_RATIO times the number of pending items
+COMPACT_MIN = 1000
+COMPACT_RATIO = 4
+# rebuild the heaps of drop-lowest-priority candidates, and of priority queues,
+# if they contain more than HEAP_RATIO times the number of queued items plus
+# HEAP_MIN entries
+HEAP_MIN = 1000
+HEAP_RATIO = 2
+
+# overflow policies of bounded queues
+REJECT = 'reject'
+DROP_OLDEST = 'drop-oldest'
+DROP_LOWEST = 'drop-lowest-priority'
+OVERFLOW_POLICIES = (REJECT, DROP_OLDEST, DROP_LOWEST)
+
+
+class JournalError(Exception):
+    pass
+
+
+class JournalQueue(queue.Queue):
+    """a FIFO queue, that keeps its items in an append-only journal file
+       items are JSON serializable sequences, identified by item[0]
+       items are put into the queue as usual, and are marked as finished
+       by calling done(item), pending items survive a restart
+       with prefix None, the queue operates in memory only
+
+       items are coalesced by key: putting a key, that is pending already,
+       is a no-op, apart from raising the priority of a priority queue,
+       the pending item is kept as is, e.g. with the URL of its first
+       request: further URLs of a key are tracked by the fetch policy
+       (see FetchPolicy.mirrors())
+       with a maxsize, put() never blocks, but applies the overflow policy,
+       when the queue is full: reject raises queue.Full, drop-oldest and
+       drop-lowest-priority discard a queued item (or the new one, if it
+       has the lowest priority), the priority is the last element of an item
+       ondrop is called with the key of each dropped item, e.g. to allow
+       queueing it again later
+
+       Because squid runs many helper processes concurrently, each queue
+       claims the first unlocked journal slot <prefix>.<n>, thus after a
+       restart, every journal is resumed by one of the new processes.
+    """
+    def __init__(self, prefix = None, maxsize = 0, overflow = REJECT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('invalid overflow policy: %s' % overflow)
+        self.prefix = prefix
+        self.filename = None
+        self.limit = maxsize
+        self.overflow = overflow
+        self.coalesced = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.ondrop = None
+        self._fd = None
+        self._lockfd = None
+        self._records = 0
+        # the queue bound is enforced by _put()
+        super().__init__(0)
+        if prefix is not None:
+            self._open()
+
+    def _init(self, maxsize):
+        self.queue = collections.OrderedDict()
+        # items handed out by get(), but not marked as done yet
+        self.inflight = collections.OrderedDict()
+        # heap of (due, seq, item): requeued items, waiting for their due time
+        self.deferred = []
+        self.deferseq = itertools.count()
+        self.deferkeys = set()
+        # heap of (priority, seq, key): victims of drop-lowest-priority,
+        # stale entries are skipped lazily
+        self.lowest = []
+        self.seq = itertools.count()
+        # put times of queued items, oldest first
+        self.stamps = collections.OrderedDict()
+
+    def _qsize(self):
+        self._promote()
+        return len(self.queue)
+
+    def _promote(self):
+        """move due deferred items into the queue"""
+        deferred = self.deferred
+        if deferred:
+            now = time.monotonic()
+            while deferred and deferred[0][0] <= now:
+                item = heapq.heappop(deferred)[2]
+                self.deferkeys.discard(item[0])
+                self._push(item)
+
+    def _put(self, item):
+        item = tuple(item)
+        key = item[0]
+        if key in self.inflight or key in self.deferkeys:
+            self.coalesced += 1
+            return
+        if key in self.queue:
+            self.coalesced += 1
+            # the queued item stays, priority queues might raise its priority
+            self._push(item)
+            return
+        if self.limit and self._qsize() >= self.limit:
+            if self.overflow == REJECT:
+                self.rejected += 1
+                raise queue.Full
+            if self.overflow == DROP_OLDEST:
+                victim = next(iter(self.queue.values()))
+            else:
+                victim = self._lowest()
+                if item[-1] < victim[-1]:
+                    log.debug('queue full: drop <%s>', key)
+                    self._dropped(key)
+                    return
+            log.debug('queue full: drop <%s>', victim[0])
+            self._remove(victim[0])
+            self._write('-', victim[0])
+            self._dropped(victim[0])
+        self._push(item)
+        self._write('+', item)
+        self.stamps[key] = time.monotonic()
+
+    def _dropped(self, key):
+        self.dropped += 1
+        if self.ondrop is not None:
+            self.ondrop(key)
+
+    def _push(self, item):
+        """add item to the queue, unless its key is queued already"""
+        if item[0] not in self.queue:
+            self.queue[item[0]] = item
+            self._track(item)
+
+    def _track(self, item):
+        """remember a queued item as drop-lowest-priority candidate"""
+        heapq.heappush(self.lowest, (item[-1], next(self.seq), item[0]))
+        if len(self.lowest) > HEAP_RATIO * len(self.queue) + HEAP_MIN:
+            self.lowest = [(item[-1], next(self.seq), item[0])
+                           for item in self.queue.values()]
+            heapq.heapify(self.lowest)
+
+    def _lowest(self):
+        """return the queued item with the lowest priority, the oldest one
+           of equal priority items
+        """
+        lowest = self.lowest
+        while True:
+            prio, seq, key = lowest[0]
+            item = self.queue.get(key)
+            if item is not None and item[-1] == prio:
+                return item
+            heapq.heappop(lowest)
+
+    def _remove(self, key):
+        del self.queue[key]
+        self.stamps.pop(key, None)
+
+    def _get(self):
+        key, item = self.queue.popitem(last = False)
+        self.stamps.pop(key, None)
+        self.inflight[key] = item
+        return item
+
+    def done(self, item):
+        """mark item as finished"""
+        with self.mutex:
+            self.inflight.pop(item[0], None)
+            self._write('-', item[0])
+            self._check_compact()
+
+    def requeue(self, item, delay = 0):
+        """put an unfinished item, handed out by get(), back into the queue,
+           optionally after delay seconds
+           note: the item is still journaled, and isn't written again
+        """
+        with self.mutex:
+            self.inflight.pop(item[0], None)
+            item = tuple(item)
+            if delay > 0:
+                heapq.heappush(self.deferred,
+                               (time.monotonic() + delay, next(self.deferseq), item))
+                self.deferkeys.add(item[0])
+            else:
+                self._push(item)
+                self.not_empty.notify()
+
+    def reprioritize(self, key, priority):
+        """FIFO queues ignore priorities"""
+        return False
+
+    def pending(self):
+        """return all unfinished items, in flight items first"""
+        with self.mutex:
+            return self._pending()
+
+    def _pending(self):
+        return (list(self.inflight.values()) + list(self.queue.values()) +
+                [entry[2] for entry in sorted(self.deferred)])
+
+    def stats(self):
+        """return queue depths, the wait time of the oldest put item in
+           seconds, and overflow counters
+        """
+        with self.mutex:
+            return dict(depth = self._qsize(), inflight = len(self.inflight),
+                        deferred = len(self.deferred), limit = self.limit,
+                        wait = round(self._wait(), 3),
+                        coalesced = self.coalesced, dropped = self.dropped,
+                        rejected = self.rejected)
+
+    def _wait(self):
+        for stamp in self.stamps.values():
+            return time.monotonic() - stamp
+        return 0.0
+
+    def __repr__(self):
+        return '%s(%s, pending = %s)' % (self.__class__.__name__,
+                                         self.filename, self.qsize())
+
+    def close(self):
+        with self.mutex:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+            if self._lockfd is not None:
+                self._lockfd.close()
+                self._lockfd = None
+
+    def _open(self):
+        dirname = os.path.dirname(self.prefix)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for slot in range(MAX_SLOTS):
+            filename = '%s.%d' % (self.prefix, slot)
+            lockfd = open(filename + '.lock', 'a')
+            try:
+                fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lockfd.close()
+                continue
+            self.filename = filename
+            self._lockfd = lockfd
+            break
+        else:
+            raise JournalError('no free journal slot for %s' % self.prefix)
+        with self.mutex:
+            self._replay()
+            # rewrite the journal with pending items only
+            self._compact()
+        log.info('%s: resumed %s pending items', self.filename, self._qsize())
+
+    def _replay(self):
+        try:
+            fd = open(self.filename, 'r', encoding = 'utf8')
+        except FileNotFoundError:
+            return
+        items = []
+        # a done record finishes all preceding items with the same key
+        done = {}
+        with fd:
+            for ln, line in enumerate(fd, 1):
+                try:
+                    op, value = json.loads(line)
+                except ValueError:
+                    # a truncated last line is expected after a crash
+                    log.warning('%s:%s: invalid record ignored', self.filename, ln)
+                    continue
+                if op == '+':
+                    items.append(tuple(value))
+                elif op == '-':
+                    done[value] = len(items)
+        for i, item in enumerate(items):
+            if i >= done.get(item[0], 0):
+                self._push(item)
+
+    def _write(self, op, value):
+        if self._fd is not None:
+            self._fd.write(json.dumps((op, value)) + '\n')
+            self._fd.flush()
+            self._records += 1
+
+    def _check_compact(self):
+        if (self._fd is not None and self._records >= COMPACT_MIN and
+            self._records > COMPACT_RATIO * (self._qsize() + len(self.inflight) +
+                                             len(self.deferred))):
+            self._compact()
+
+    def _compact(self):
+        """atomically replace the journal with the pending items"""
+        pending = self._pending()
+        log.debug('%s: compact %s records to %s',
+                  self.filename, self._records, len(pending))
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w', encoding = 'utf8') as fd:
+            for item in pending:
+                fd.write(json.dumps(('+', item)) + '\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpname, self.filename)
+        if self._fd is not None:
+            self._fd.close()
+        self._fd = open(self.filename, 'a', encoding = 'utf8')
+        self._records = len(pending)
+
+
+class JournalPriorityQueue(JournalQueue):
+    """a JournalQueue, that returns the item with the highest priority first
+       the priority is the last element of an item, items with equal
+       priority are returned in FIFO order
+       putting an already queued key again keeps the queued item,
+       but raises its priority, if higher
+    """
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        # heap of (-priority, seq, key), stale entries are skipped lazily
+        self.heap = []
+        self.queue = {}
+
+    def _qsize(self):
+        self._promote()
+        return len(self.queue)
+
+    def _push(self, item):
+        key = item[0]
+        prio = item[-1]
+        queued = self.queue.get(key)
+        if queued is not None:
+            if prio <= queued[-1]:
+                return
+            item = queued[:-1] + (prio, )
+        self.queue[key] = item
+        heapq.heappush(self.heap, (-prio, next(self.seq), key))
+        if len(self.heap) > HEAP_RATIO * len(self.queue) + HEAP_MIN:
+            # drop the stale entries of raised priorities
+            self.heap = [(-item[-1], next(self.seq), item[0])
+                         for item in self.queue.values()]
+            heapq.heapify(self.heap)
+        self._track(item)
+
+    def _get(self):
+        while True:
+            prio, seq, key = heapq.heappop(self.heap)
+            item = self.queue.get(key)
+            if item is not None and -prio == item[-1]:
+                del self.queue[key]
+                self.stamps.pop(key, None)
+                self.inflight[key] = item
+                return item
+
+    def reprioritize(self, key, priority):
+        """raise the priority of a queued item, returns False, if not queued"""
+        # most calls don't raise the priority: check without locking
+        item = self.queue.get(key)
+        if item is None:
+            return False
+        if priority <= item[-1]:
+            return True
+        with self.mutex:
+            item = self.queue.get(key)
+            if item is None:
+                return False
+            self._push(item[:-1] + (priority, ))
+            return True
+
+    def _pending(self):
+        return (list(self.inflight.values()) +
+                sorted(self.queue.values(), key = lambda item: item[-1], reverse = True) +
+                [entry[2] for entry in sorted(self.deferred)])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import io
+import select
+
+BLOCKSIZE = 65536
+
+
+class LineReader:
+    """read newline terminated lines from a file descriptor as bytes
+       data is read into a reusable buffer, lines are split with find(),
+       no decoding takes place, and nothing is buffered behind the back
+       of select(), hence wait() never misses complete lines
+    """
+    def __init__(self, fd, blocksize = BLOCKSIZE):
+        self._fd = fd
+        self._file = io.FileIO(fd, 'rb', closefd = False)
+        self._chunk = bytearray(blocksize)
+        self._view = memoryview(self._chunk)
+        # data read, but not returned by lines() yet
+        self._buffer = bytearray()
+        self.eof = False
+
+    def fileno(self):
+        return self._fd
+
+    def wait(self, timeout):
+        """wait for input, returns False on timeout"""
+        return bool(select.select([self._fd], [], [], timeout)[0])
+
+    def fill(self):
+        """read available data, returns the number of bytes read, 0 on EOF,
+           or None, if no data is available from a non-blocking fd
+        """
+        n = self._file.readinto(self._chunk)
+        if n:
+            self._buffer += self._view[:n]
+        elif n is not None:
+            self.eof = True
+        return n
+
+    def lines(self):
+        """return a list of all complete lines without line terminators,
+           at EOF, an unterminated last line is returned as well
+        """
+        buffer = self._buffer
+        if self.eof:
+            if not buffer:
+                return []
+            end = len(buffer)
+        else:
+            end = buffer.rfind(b'\n')
+            if end < 0:
+                return []
+        with memoryview(buffer) as view:
+            data = bytes(view[:end])
+        del buffer[:end + 1]
+        return data.split(b'\n')
+
+    def __repr__(self):
+        return '%s(fd = %s, pending = %s)' % (self.__class__.__name__,
+                                             self._fd, len(self._buffer))
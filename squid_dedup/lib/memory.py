@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# memory accounting: approximate sizes of data structures, process memory,
+# and tracemalloc snapshot differences
+
+import os
+import sys
+import resource
+import itertools
+import tracemalloc
+
+# containers with more items are estimated from this many items
+SAMPLE = 1000
+# tracemalloc: frames per traceback, and number of differences reported
+TRACE_FRAMES = 1
+TRACE_TOP = 10
+
+CONTAINERS = (list, tuple, set, frozenset)
+
+
+def size(obj, sample = SAMPLE, _seen = None):
+    """return the approximate size of obj in bytes, including the items of
+       containers (dicts, lists, tuples, sets, and their subclasses), where
+       large ones are extrapolated from their first sample items
+       objects referenced repeatedly are counted once
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    total = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = itertools.chain.from_iterable(obj.items())
+        n = 2 * len(obj)
+    elif isinstance(obj, CONTAINERS) or type(obj).__name__ == 'deque':
+        items = obj
+        n = len(obj)
+    else:
+        return total
+    if not n:
+        return total
+    counted = 0
+    itemsize = 0
+    for item in itertools.islice(items, 2 * sample):
+        itemsize += size(item, sample, _seen)
+        counted += 1
+    return total + itemsize * n // counted
+
+
+def rss():
+    """return the resident set size of the process in bytes, where
+       unavailable, the max. resident set size is returned
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Tracer:
+    """trace memory allocations with tracemalloc, and report the differences
+       between subsequent snapshots (allocations cost about twice the time)
+    """
+    def __init__(self, frames = TRACE_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def diff(self, top = TRACE_TOP):
+        """return the top statistic differences to the previous snapshot"""
+        snapshot = self.snapshot()
+        stats = snapshot.compare_to(self._snapshot, 'lineno')
+        self._snapshot = snapshot
+        return stats[:top]
+
+    def stop(self):
+        tracemalloc.stop()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import json
+import logging
+import threading
+import collections
+
+log = logging.getLogger('mirrors')
+
+# weight of a new measurement in the moving averages
+ALPHA = 0.3
+# max. number of hosts kept in the table
+MAX_HOSTS = 1000
+# transfers smaller than this don't tell much about throughput
+MIN_BYTES = 65536
+# nominal object size, used for ranking hosts
+SCORE_SIZE = 1 << 20
+
+
+class MirrorStats:
+    """thread safe table of transfer statistics per host
+       latency (seconds until the response header arrived) and throughput
+       (bytes per second) are kept as exponentially weighted moving averages
+       with a path, the table is loaded from and saved to a JSON file,
+       helper processes sharing a file simply overwrite each others results
+    """
+    def __init__(self, path = None, alpha = ALPHA, size = MAX_HOSTS):
+        self._lock = threading.Lock()
+        # host: [latency, throughput]
+        self._hosts = collections.OrderedDict()
+        self.alpha = alpha
+        self.size = size
+        self.path = None
+        if path:
+            self.load(path)
+
+    def update(self, host, latency = None, throughput = None):
+        """account a measurement of host, None values are ignored"""
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = self._hosts[host] = [latency, throughput]
+                if len(self._hosts) > self.size:
+                    self._hosts.popitem(last = False)
+                return
+            self._hosts.move_to_end(host)
+            for i, value in enumerate((latency, throughput)):
+                if value is not None:
+                    if entry[i] is None:
+                        entry[i] = value
+                    else:
+                        entry[i] += self.alpha * (value - entry[i])
+
+    def get(self, host):
+        """return (latency, throughput) of host, or None, if unknown"""
+        with self._lock:
+            entry = self._hosts.get(host)
+            return None if entry is None else tuple(entry)
+
+    def score(self, host):
+        """estimated time in seconds to fetch SCORE_SIZE bytes from host,
+           or None, if the host wasn't measured yet
+        """
+        entry = self.get(host)
+        if entry is None:
+            return None
+        latency, throughput = entry
+        if not throughput:
+            return None
+        return (latency or 0.0) + SCORE_SIZE / throughput
+
+    def best(self, candidates, preferred = None):
+        """return the fastest of candidates (host, value) pairs
+           unknown hosts score best, to get them measured, ties go to preferred
+        """
+        def rank(candidate):
+            host, value = candidate
+            return (self.score(host) or 0.0, value != preferred)
+        return min(candidates, key = rank)[1]
+
+    def load(self, path):
+        """replace the table with the contents of path"""
+        self.path = path
+        try:
+            with open(path, 'r', encoding = 'utf8') as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error('%s: cannot load mirror statistics: %s', path, e)
+            return
+        with self._lock:
+            self._hosts.clear()
+            for host, entry in data.items():
+                try:
+                    latency, throughput = entry
+                except (TypeError, ValueError):
+                    continue
+                self._hosts[host] = [latency, throughput]
+        log.debug('%s: loaded statistics of %s hosts', path, len(self._hosts))
+
+    def save(self):
+        """write the table to path atomically"""
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._hosts)
+        tmpname = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmpname, 'w', encoding = 'utf8') as fd:
+                fd.write(data)
+            os.replace(tmpname, self.path)
+        except OSError as e:
+            log.error('%s: cannot save mirror statistics: %s', self.path, e)
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __repr__(self):
+        return '%s(path = %r, hosts = %s)' % (self.__class__.__name__,
+                                             self.path, len(self._hosts))
@@ -11,46 +11,129 @@
 # note: zypper install python-pyprof2calltree python-gprof2dot
 
 import os
+import logging
 import datetime
 import cProfile
-from string import Template
+import functools
+import itertools
+import threading
 
+log = logging.getLogger('profile')
 
-def profile(fn = None, sorting = 'cumulative'):
-    """conditional profiling decorator function
-       this is testing for a self._config.profile attribute of the wrapped method,
-       most useful for Process.run methods, as those cannot be profiled easily, otherwise.
-       fn is a filename or None for printing stats to stdout, it will be saved to config.profiledir
-       fn may contain $date and $time macros, and will have .pstats extension appended, if missing
-       sorting specifies the sorting method, when fn is None
+# timestamp of a profiling window, as used in pstats file names
+STAMPFORMAT = '%Y%m%d-%H%M%S'
+
+# runcall() sequence numbers: keep the pstats files of repeated calls apart
+_calls = itertools.count(1)
+
+# thread id: name of the threads running a decorated method (see lib/sampler)
+threads = {}
+
+
+class Window:
+    """process wide profiling window
+       cProfile profiles a single thread only, hence each thread follows the
+       window with its own Profiler, and dumps its own pstats file
+    """
+    # timestamp of the open window, None: closed
+    stamp = None
+    directory = '.'
+
+    @classmethod
+    def start(cls, directory):
+        if cls.stamp is None:
+            try:
+                os.makedirs(directory, exist_ok = True)
+            except OSError as e:
+                log.error('profile directory %s: %s', directory, e)
+                return
+            cls.directory = directory
+            cls.stamp = datetime.datetime.now().strftime(STAMPFORMAT)
+            log.info('profiling window %s opened', cls.stamp)
+
+    @classmethod
+    def stop(cls):
+        if cls.stamp is not None:
+            log.info('profiling window %s closed', cls.stamp)
+            cls.stamp = None
+
+    @classmethod
+    def toggle(cls, directory):
+        if cls.stamp is None:
+            cls.start(directory)
+        else:
+            cls.stop()
+
+
+class Profiler:
+    """profile the calling thread, while a profiling window is open
+       check() is meant to be called regularly from the thread's main loop
+    """
+    def __init__(self, name):
+        self.name = name
+        self._profile = None
+        self._stamp = None
+
+    def check(self):
+        """follow the profiling window: start, stop, or restart profiling"""
+        stamp = Window.stamp
+        if stamp == self._stamp:
+            return
+        if self._profile is not None:
+            self.dump()
+        if stamp is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._stamp = stamp
+
+    def dump(self):
+        """stop profiling, and write <stamp>-<pid>-<name>-<thread id>.pstats"""
+        pr, self._profile = self._profile, None
+        pr.disable()
+        fn = os.path.join(Window.directory, '%s-%s-%s-%s.pstats' % (
+                          self._stamp, os.getpid(), self.name, threading.get_ident()))
+        try:
+            pr.dump_stats(fn)
+        except OSError as e:
+            log.error('profile %s: %s', fn, e)
+        else:
+            log.info('profile written to %s', fn)
+
+    def close(self):
+        if self._profile is not None:
+            self.dump()
+        self._stamp = None
+
+
+def profile(name):
+    """profiling decorator for thread run methods
+       the instance gets a Profiler as _profiler attribute, its main loop is
+       expected to call self._profiler.check() regularly
+       the thread is registered in threads under name, while running
     """
     def wrapper(f):
-        def wrapped_f(*args, **kwargs):
-            config = args[0]._config
-            if config.profile:
-                pr = cProfile.Profile()
-                pr.enable()
-                pr.runcall(f, *args, **kwargs)
-                pr.disable()
-                pr.create_stats()
-                if fn is None:
-                    pr.print_stats(sorting)
-                else:
-                    # this is a bit subtile: because fn is a non mutable string,
-                    # reassigning fn in this scope would lead to masking fn from
-                    # the outer scope, resulting in:
-                    # UnboundLocalError: local variable 'fn' referenced before assignment
-                    # solution: assign to a local var
-                    # see: http://stackoverflow.com/questions/8447947
-                    _fn = fn
-                    now = datetime.datetime.now()
-                    d = dict(date = now.strftime(config.dateformat),
-                             time = now.strftime(config.timeformat))
-                    _fn = Template(_fn).safe_substitute(d)
-                    if not _fn.endswith('.pstats'):
-                        _fn += '.pstats'
-                    pr.dump_stats(os.path.join(config.profiledir, _fn))
-            else:
-                f(*args, **kwargs)
+        @functools.wraps(f)
+        def wrapped_f(self, *args, **kwargs):
+            ident = threading.get_ident()
+            threads[ident] = name
+            self._profiler = Profiler(name)
+            self._profiler.check()
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self._profiler.close()
+                threads.pop(ident, None)
         return wrapped_f
     return wrapper
+
+
+def runcall(name, f, *args, **kwargs):
+    """call f, profiled, if a profiling window is open"""
+    if Window.stamp is None:
+        return f(*args, **kwargs)
+    profiler = Profiler('%s.%s' % (name, next(_calls)))
+    profiler.check()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        profiler.close()
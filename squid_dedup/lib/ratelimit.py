@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import time
+import threading
+from collections import defaultdict
+
+
+class TokenBucket:
+    """thread safe token bucket, limiting throughput to rate units per second
+       burst is the bucket capacity (default: one second worth of tokens)
+       a rate of 0 disables limiting
+    """
+    def __init__(self, rate, burst = None):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+        self._tokens = self._burst
+        self._stamp = time.monotonic()
+
+    def configure(self, rate, burst = None):
+        """change rate and burst on the fly"""
+        with self._lock:
+            self.rate = rate
+            self._burst = burst or rate
+
+    def reserve(self, n):
+        """take n tokens out of the bucket without waiting
+           returns the time in seconds, the caller has to wait before
+           using them, useful for event loops, that can't sleep
+        """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            # a negative balance delays subsequent consumers
+            self._tokens -= n
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, n):
+        """take n tokens out of the bucket, sleep as long as necessary
+           returns the time in seconds spent waiting
+        """
+        wait = self.reserve(n)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def __repr__(self):
+        return '%s(rate = %s, burst = %s)' % (self.__class__.__name__,
+                                              self.rate, self._burst)
+
+
+class HostSlots:
+    """limit the number of concurrent users per host
+       a limit of 0 disables limiting
+    """
+    def __init__(self, limit):
+        self._cond = threading.Condition()
+        self._busy = defaultdict(int)
+        self.limit = limit
+
+    def acquire(self, host, timeout = None):
+        """acquire a slot for host, returns False on timeout"""
+        with self._cond:
+            if self.limit:
+                if not self._cond.wait_for(lambda: self._busy[host] < self.limit,
+                                           timeout):
+                    return False
+            self._busy[host] += 1
+            return True
+
+    def release(self, host):
+        with self._cond:
+            self._busy[host] -= 1
+            if self._busy[host] <= 0:
+                del self._busy[host]
+            self._cond.notify_all()
+
+    def busy(self, host):
+        with self._cond:
+            return self._busy.get(host, 0)
+
+    def __repr__(self):
+        return '%s(limit = %s)' % (self.__class__.__name__, self.limit)
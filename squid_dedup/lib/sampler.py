@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# statistical profiler: sample the stacks of registered threads, and write
+# them in collapsed format, as consumed by flamegraph.pl or speedscope:
+# flamegraph.pl samples.folded > samples.svg
+
+import os
+import sys
+import time
+import logging
+import datetime
+import collections
+
+log = logging.getLogger('sampler')
+
+# samples per second
+RATE = 49
+# write a file every INTERVAL seconds
+INTERVAL = 60
+# max. share of CPU time spent sampling: the rate is lowered accordingly
+MAX_OVERHEAD = 0.01
+# timestamp of a file, as used in file names
+STAMPFORMAT = '%Y%m%d-%H%M%S'
+
+
+class Sampler:
+    """sample the stacks of the threads in threads (thread id: name) rate
+       times per second, and write the aggregated collapsed stacks to
+       directory every interval seconds
+    """
+    def __init__(self, threads, directory, rate = RATE, interval = INTERVAL):
+        self._threads = threads
+        self._directory = directory
+        self._period = 1.0 / rate
+        self._interval = interval
+        self._exiting = False
+        # (thread name, code objects, outermost first): count
+        self._stacks = collections.Counter()
+        # code object: frame label
+        self._labels = {}
+        self.samples = 0
+        # sampling time (thread CPU time)
+        self.cost = 0.0
+
+    def exit(self):
+        self._exiting = True
+
+    def sample(self):
+        """take a single sample of all registered threads"""
+        threads = self._threads
+        stacks = self._stacks
+        for ident, frame in sys._current_frames().items():
+            name = threads.get(ident)
+            if name is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            stacks[name, tuple(stack)] += 1
+        self.samples += 1
+
+    def label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            label = self._labels[code] = '%s (%s:%s)' % (
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            return label
+
+    def collapse(self):
+        """return the collapsed stacks sampled so far, and start over"""
+        stacks, self._stacks = self._stacks, collections.Counter()
+        lines = []
+        for (name, stack), count in stacks.items():
+            lines.append('%s;%s %s' % (name, ';'.join(map(self.label, stack)), count))
+        return lines
+
+    def write(self, start):
+        fn = os.path.join(self._directory, '%s-%s-samples.folded' % (
+                          datetime.datetime.fromtimestamp(start).strftime(STAMPFORMAT),
+                          os.getpid()))
+        lines = self.collapse()
+        if not lines:
+            self.samples = 0
+            self.cost = 0.0
+            return
+        lines.append('')
+        try:
+            os.makedirs(self._directory, exist_ok = True)
+            with open(fn, 'w') as f:
+                f.write('\n'.join(lines))
+        except OSError as e:
+            log.error('sampler %s: %s', fn, e)
+        else:
+            log.info('%s samples written to %s, overhead: %.2f%%', self.samples, fn,
+                     100.0 * self.cost / max(time.time() - start, self._period))
+        self.samples = 0
+        self.cost = 0.0
+
+    def run(self):
+        log.debug('running')
+        start = time.time()
+        while not self._exiting:
+            t = time.thread_time()
+            self.sample()
+            cost = time.thread_time() - t
+            self.cost += cost
+            # stay within MAX_OVERHEAD, if sampling is slow
+            time.sleep(max(self._period, cost / MAX_OVERHEAD))
+            if time.time() - start >= self._interval:
+                self.write(start)
+                start = time.time()
+        self.write(start)
+        log.debug('finished')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import time
+
+BLOCKSIZE = 65536
+
+
+class DiscardSink:
+    """read file like objects into a reusable buffer, and discard the data
+       this avoids allocating a new bytes object for every block read
+       statistics of the last drain() call:
+         nbytes: number of bytes read
+         elapsed: time spent in seconds
+    """
+    def __init__(self, blocksize = BLOCKSIZE):
+        self.buffer = bytearray(blocksize)
+        self.nbytes = 0
+        self.elapsed = 0.0
+
+    def drain(self, fd, callback = None):
+        """read fd until EOF, returns the number of bytes read
+           callback(n) is called after each block of n bytes,
+           a false return value stops reading
+           exceptions from fd are passed on to the caller, with
+           nbytes and elapsed reflecting the state up to the failure
+        """
+        readinto = fd.readinto
+        buffer = self.buffer
+        self.nbytes = 0
+        start = time.monotonic()
+        try:
+            while True:
+                n = readinto(buffer)
+                if not n:
+                    break
+                self.nbytes += n
+                if callback is not None and not callback(n):
+                    break
+        finally:
+            self.elapsed = time.monotonic() - start
+        return self.nbytes
+
+    def throughput(self):
+        """bytes per second of the last drain() call"""
+        if self.elapsed:
+            return self.nbytes / self.elapsed
+        return 0.0
+
+    def __repr__(self):
+        return '%s(blocksize = %s)' % (self.__class__.__name__, len(self.buffer))
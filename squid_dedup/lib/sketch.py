@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# streaming sketches in constant memory: the most frequent keys of a stream
+# (Space-Saving), and the number of distinct keys (HyperLogLog)
+
+import math
+import operator
+
+# keys are hashed with hash(): str and bytes only, the seed differs per process
+HASH_MASK = (1 << 64) - 1
+HASH_BITS = 64
+# HyperLogLog precision range: 2**p registers
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+class TopK:
+    """heavy hitters: count the k most frequent keys of a stream (Space-Saving
+       with batched eviction), up to 2 * k keys are tracked, then the less
+       frequent half is evicted at once. A key entering later starts with the
+       highest evicted count, thus counts are overestimated by at most their
+       error, and a key counted more than that error is among the top keys
+    """
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # highest count evicted so far
+        self.floor = 0
+        self.total = 0
+
+    def update(self, key, n = 1):
+        self.total += n
+        counts = self.counts
+        try:
+            counts[key] += n
+        except KeyError:
+            counts[key] = self.floor + n
+            if self.floor:
+                self.errors[key] = self.floor
+            if len(counts) >= 2 * self.k:
+                self.evict()
+
+    def evict(self):
+        """keep the k most frequent keys"""
+        ranked = sorted(self.counts.items(), key = operator.itemgetter(1), reverse = True)
+        self.floor = max(self.floor, ranked[self.k][1])
+        self.counts = dict(ranked[:self.k])
+        errors = self.errors
+        self.errors = {key: errors[key] for key in self.counts if key in errors}
+
+    def top(self, n = None):
+        """return (key, count, error) of the n (default: k) most frequent keys"""
+        ranked = sorted(self.counts.items(), key = operator.itemgetter(1), reverse = True)
+        return [(key, count, self.errors.get(key, 0))
+                for key, count in ranked[:n or self.k]]
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class HyperLogLog:
+    """count distinct keys in 2**p bytes with a standard error of about
+       1.04 / sqrt(2**p) (1.6% with p = 12)
+    """
+    def __init__(self, p = 12):
+        check_precision(p)
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self._alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, key):
+        x = hash(key) & HASH_MASK
+        j = x & (self.m - 1)
+        # position of the leftmost 1 bit of the remaining bits
+        rank = HASH_BITS - self.p - (x >> self.p).bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self):
+        m = self.m
+        estimate = self._alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            # small range: linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class Traffic:
+    """per section sketches of the requests: top rewritten objects, top
+       origin hosts, and the number of distinct requested URLs
+    """
+    def __init__(self, k, p = 12):
+        check_precision(p)
+        self.k = k
+        self.p = p
+        # section name: (objects, origins, urls)
+        self.sections = {}
+
+    def update(self, name, url, newurl):
+        """account a request of url (str or bytes), rewritten to newurl"""
+        try:
+            objects, origins, urls = self.sections[name]
+        except KeyError:
+            objects, origins, urls = self.sections[name] = (
+                TopK(self.k), TopK(self.k), HyperLogLog(self.p))
+        objects.update(newurl)
+        origins.update(host(url))
+        urls.add(url)
+
+    def report(self):
+        """return a dict of section name: dict(requests, urls, objects, origins)"""
+        decode = lambda key: key.decode('utf-8', 'replace') if isinstance(key, bytes) else key
+        ret = {}
+        for name, (objects, origins, urls) in list(self.sections.items()):
+            ret[name] = dict(requests = objects.total, urls = urls.count(),
+                             objects = [(decode(key), count, error)
+                                        for key, count, error in objects.top()],
+                             origins = [(decode(key), count, error)
+                                        for key, count, error in origins.top()])
+        return ret
+
+
+def host(url):
+    """return the host part of an URL (str or bytes)"""
+    sep = b'/' if isinstance(url, bytes) else '/'
+    parts = url.split(sep, 3)
+    return parts[2] if len(parts) > 2 else url
+
+
+def check_precision(p):
+    if not MIN_PRECISION <= p <= MAX_PRECISION:
+        raise ValueError('precision %s out of range %s..%s' % (p, MIN_PRECISION, MAX_PRECISION))
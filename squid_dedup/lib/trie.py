@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# key of the value of a node, that terminates a prefix (nodes are keyed
+# by characters of str prefixes, or by integers of bytes prefixes)
+VALUE = None
+
+
+class PrefixTrie:
+    """map literal prefixes to values, and find the longest prefix of a key
+       in O(length of the prefix), without regard to the number of prefixes
+       works with str and bytes keys alike, but don't mix them
+    """
+    def __init__(self):
+        self._root = {}
+        self._len = 0
+
+    def add(self, prefix, value):
+        """add prefix with value, returns the replaced value or None"""
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        old = node.get(VALUE)
+        if VALUE not in node:
+            self._len += 1
+        node[VALUE] = value
+        return old
+
+    def match(self, key):
+        """return (value, length) of the longest prefix of key, or None"""
+        node = self._root
+        found = None
+        n = 0
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                break
+            n += 1
+            if VALUE in node:
+                found = node[VALUE], n
+        return found
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '%s(prefixes = %s)' % (self.__class__.__name__, self._len)
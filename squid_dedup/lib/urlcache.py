@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# rewrite caches: map URLs to their rules, (section, newurl) for str URLs,
+# and (section, newurl, reply) for bytes URLs, bounded in the number of entries
+
+import zlib
+import collections
+
+from lib import memory
+
+# reply prefix of bytes rules
+REPLY = b'OK store-id='
+# compact values: CRC-32 of the URL, section index, and suffix length
+INDEX_BITS = 16
+SUFFIX_BITS = 16
+INDEX_MASK = (1 << INDEX_BITS) - 1
+SUFFIX_MASK = (1 << SUFFIX_BITS) - 1
+CHECK_SHIFT = INDEX_BITS + SUFFIX_BITS
+
+
+class FifoCache(collections.OrderedDict):
+    """OrderedDict, that evicts its oldest entries beyond size (0: unlimited)
+       lookups are plain dict lookups
+    """
+    def __init__(self, size = 0):
+        super().__init__()
+        self.size = size
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.size and len(self) > self.size:
+            self.popitem(last = False)
+
+
+class CompactCache:
+    """rewrite cache in a fraction of the memory of a FifoCache: the key of an
+       URL is its hash(), verified with its CRC-32 on lookup, a mismatch counts
+       as a collision and a miss. If newurl consists of the head of the
+       replacement template of its section, a suffix of the URL, and the tail
+       of the template (as with prefix rules, and most match rules), the value
+       is a single int of the CRC-32, the section index and the suffix length,
+       and the rule is rebuilt on lookup. Other values are kept as they are.
+       Entries are kept in two generations of up to size / 2 entries: a hit in
+       the old one moves the entry to the current one, and the old one is
+       dropped, when the current one is full (approximate LRU)
+    """
+    def __init__(self, size, sections, binary = False):
+        self.size = size
+        self._half = (size + 1) // 2
+        # binary: bytes URLs and rules with reply
+        self._binary = binary
+        self._index = {}
+        self._templates = []
+        for i, section in enumerate(sections):
+            head, tail = section.prefix_breplace if binary else section.prefix_replace
+            self._index[section.name] = i
+            self._templates.append((section, head, tail))
+        self._new = {}
+        self._old = {}
+        self.collisions = 0
+
+    def _check(self, url):
+        if self._binary:
+            return zlib.crc32(url)
+        return zlib.crc32(url.encode('utf-8', 'surrogatepass'))
+
+    def __getitem__(self, url):
+        key = hash(url)
+        try:
+            value = self._new[key]
+        except KeyError:
+            # raises KeyError on a miss
+            value = self._old.pop(key)
+            self._store(key, value)
+        if type(value) is int:
+            if value >> CHECK_SHIFT != self._check(url):
+                self.collisions += 1
+                raise KeyError(url)
+            section, head, tail = self._templates[(value >> SUFFIX_BITS) & INDEX_MASK]
+            newurl = head + url[len(url) - (value & SUFFIX_MASK):] + tail
+        else:
+            check, section, newurl = value
+            if check != self._check(url):
+                self.collisions += 1
+                raise KeyError(url)
+        if self._binary:
+            return section, newurl, REPLY + newurl
+        return section, newurl
+
+    def __setitem__(self, url, rule):
+        """cache rule (the reply of bytes rules is rebuilt from newurl)"""
+        section, newurl = rule[:2]
+        check = self._check(url)
+        value = (check, section, newurl)
+        i = self._index.get(section.name)
+        if i is not None and i <= INDEX_MASK and self._templates[i][0] is section:
+            head, tail = self._templates[i][1:]
+            end = len(newurl) - len(tail)
+            if (newurl.startswith(head) and newurl.endswith(tail) and end >= len(head) and
+                    end - len(head) <= SUFFIX_MASK and url.endswith(newurl[len(head):end])):
+                value = check << CHECK_SHIFT | i << SUFFIX_BITS | end - len(head)
+        self._store(hash(url), value)
+
+    def _store(self, key, value):
+        new = self._new
+        new[key] = value
+        if self._half and len(new) >= self._half:
+            self._old, self._new = new, {}
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    def __sizeof__(self):
+        # accounted by memory.size()
+        return object.__sizeof__(self) + memory.size(self._new) + memory.size(self._old)
@@ -19,6 +19,12 @@ log = logging.getLogger('main')
 from config import Config
 from dedup import Dedup
 from fetch import Fetch
+from policy import FetchPolicy
+from resolver import Resolver, Client
+from simulate import Simulator
+from worker import FetchWorker, Feed
+from pool import FetchPool
+from lib import profile, sampler, memory, urlcache
 
 MAIN_DELAY = 0.5
 JOIN_TIMEOUT = 1.0
@@ -30,6 +36,19 @@ class Main(object):
         self._threads = []
         self._exiting = False
         self._reload = False
+        self._stats = False
+        # thin client of a resolver daemon
+        self._client = None
+        # requests, a failed resolver daemon left unanswered
+        self._pending = None
+        # fetch worker process
+        self._worker = None
+        # fetch threads, surviving reloads
+        self._pool = None
+        # statistical profiler (sampler, thread)
+        self._sampler = None
+        # memory allocation tracer
+        self._tracer = memory.Tracer() if self._config.trace_memory else None
 
         # signal handling
         for sig, action in (
@@ -37,6 +56,8 @@ class Main(object):
             (signal.SIGQUIT, self.shutdown),
             (signal.SIGTERM, self.shutdown),
             (signal.SIGHUP, lambda s, f: setattr(self, '_reload', True)),
+            (signal.SIGUSR1, lambda s, f: setattr(self, '_stats', True)),
+            (signal.SIGUSR2, self.toggle_profile),
             (signal.SIGPIPE, signal.SIG_IGN),
         ):
             try:
@@ -48,23 +69,74 @@ class Main(object):
 
     def shutdown(self, sig = None, frame = None):
         log.debug('shutdown(%s, sig: %s)', os.getpid(), sig)
+        # signal handler: the main loop stops threads and worker on exit
         self._exiting = True
+        if self._client is not None:
+            self._client.exit()
+
+    def stop(self):
+        log.debug('stop')
         self.stop_threads()
+        if self._pool is not None:
+            # fetches in progress end with the pool
+            self._pool.exit()
+            Fetch._mirrors.save()
+        if self._worker is not None:
+            self._worker.exit()
+            self._worker = None
+        if self._config.daemon:
+            Resolver.close()
+
+    def toggle_profile(self, sig, frame):
+        profile.Window.toggle(self._config.profiledir)
+        if self._worker is not None:
+            self._worker.signal(sig)
 
     def start_threads(self):
         log.debug('start_threads')
-        # dedup thread
-        dedup = Dedup(self._config)
-        t = threading.Thread(target = dedup.run, daemon = True)
-        t.start()
-        self._threads.append((dedup, t))
-
-        # fetcher threads
-        for i in range(self._config.fetch_threads):
-            fetch = Fetch(self._config, self._config.fetch_queue)
-            t = threading.Thread(target = fetch.run, args = (t.name, ), daemon = True)
+        if self._config.fetch_worker:
+            # feed thread of a fetch worker process, ends with the helper
+            feed = Feed(self._config)
+            t = threading.Thread(target = feed.run, daemon = True)
+            t.start()
+            self._threads.append((feed, t))
+        else:
+            # dedup thread, serving squid, or the thin clients of a resolver daemon
+            dedup = (Resolver if self._config.daemon else Dedup)(self._config, self._pending,
+                                                                 self._worker)
+            self._pending = None
+            t = threading.Thread(target = dedup.run, daemon = True)
+            t.start()
+            self._threads.append((dedup, t))
+            self.start_warmup()
+
+        # fetcher threads, unless run by a fetch worker process
+        if self._worker is None:
+            self._pool = FetchPool(self._config, self._config.fetch_queue, t.name)
+        self.start_sampler()
+
+    def start_warmup(self):
+        if self._config.warmup:
+            # fill the rewrite cache in the background, stops with dedup
+            dedup = self._threads[0][0]
+            w = threading.Thread(target = dedup.warmup, daemon = True)
+            w.start()
+            self._threads.append((dedup, w))
+
+    def start_sampler(self):
+        if self._config.sample_rate > 0:
+            s = sampler.Sampler(profile.threads, self._config.profiledir,
+                                self._config.sample_rate, self._config.sample_interval)
+            t = threading.Thread(target = s.run, daemon = True)
             t.start()
-            self._threads.append((fetch, t))
+            self._sampler = (s, t)
+
+    def stop_sampler(self):
+        if self._sampler is not None:
+            s, t = self._sampler
+            s.exit()
+            t.join(timeout = JOIN_TIMEOUT)
+            self._sampler = None
 
     def stop_threads(self):
         log.debug('stop_threads')
@@ -73,26 +145,151 @@ class Main(object):
         for p, t in self._threads:
             t.join(timeout = JOIN_TIMEOUT)
         self._threads = []
+        self.stop_sampler()
+        Fetch._mirrors.save()
+
+    def reload(self):
+        """ reload the config, while the dedup thread keeps serving squid:
+            it switches to the new ruleset by itself, a config, that failed
+            to load, leaves the current one in place
+        """
+        if not self._config.reload():
+            return
+        # drop finished warm-up threads
+        self._threads[1:] = [(p, t) for p, t in self._threads[1:] if t.is_alive()]
+        if not self._config.fetch_worker:
+            self.start_warmup()
+        if self._pool is not None:
+            self._pool.configure(self._config)
+        if self._worker is not None:
+            self._worker.signal(signal.SIGHUP)
+        self.stop_sampler()
+        self.start_sampler()
+        log.trace(self._config)
+
+    def log_stats(self):
+        if self._worker is not None:
+            # the worker logs its fetch statistics itself
+            log.info('fetch worker stats: %s', self._worker.stats())
+            self._worker.signal(signal.SIGUSR1)
+        else:
+            log.info('fetch pool stats: %s', self._pool.stats())
+            log.info('fetch stats: %s', Fetch.stats())
+            log.info('fetch breakers open: %s', Fetch._breakers.opened())
+            log.info('fetch policy stats: %s', FetchPolicy.stats())
+            log.info('fetch queue stats: %s', self._config.fetch_queue.stats())
+        if not self._config.fetch_worker:
+            for stage, summary in Dedup.latency().items():
+                log.info('request latency (us) %s: %s', stage, summary)
+            self.log_traffic()
+        self.log_memory()
+
+    def log_traffic(self):
+        """ log the traffic statistics of each section: requests, distinct
+            URLs, and the top objects and origins with their counts (and
+            their max. overestimation)
+        """
+        traffic = Dedup.traffic()
+        if traffic is None:
+            return
+        fmt = lambda top: ', '.join('%s: %s' % (key, count) if not error else
+                                    '%s: %s (-%s)' % (key, count, error)
+                                    for key, count, error in top)
+        for name, stats in traffic.items():
+            log.info('traffic [%s]: %s requests, ~%s distinct URLs',
+                     name, stats['requests'], stats['urls'])
+            log.info('traffic [%s] top objects: %s', name, fmt(stats['objects']))
+            log.info('traffic [%s] top origins: %s', name, fmt(stats['origins']))
+
+    def log_memory(self):
+        """ log the approximate size of data structures, that grow with the
+            requests, and the allocation differences since the last call,
+            if tracing memory
+        """
+        structures = [('fetch done', Fetch._done), ('fetch attempts', Fetch._attempts),
+                      ('fetch policy', FetchPolicy._seen),
+                      ('fetch queue', self._config.fetch_queue.queue)]
+        if self._threads and isinstance(self._threads[0][0], Dedup):
+            dedup = self._threads[0][0]
+            structures[:0] = [('rewrite cache', dedup._cache),
+                              ('rewrite cache (bytes)', dedup._bcache)]
+            if isinstance(dedup._bcache, urlcache.CompactCache):
+                log.info('rewrite cache collisions: %s', dedup._cache.collisions +
+                         dedup._bcache.collisions)
+            if Dedup._traffic is not None:
+                # the attributes of each sketch
+                sections = list(Dedup._traffic.sections.values())
+                structures.append(('traffic sketches',
+                                   [vars(s) for sketches in sections for s in sketches]))
+        for name, obj in structures:
+            try:
+                n, size = len(obj), memory.size(obj)
+                log.info('memory %s: %s entries, ~%s bytes (~%s per entry)',
+                         name, n, size, size // n if n else 0)
+            except RuntimeError:
+                # changed by another thread meanwhile
+                log.info('memory %s: %s entries, busy', name, len(obj))
+        log.info('memory rss: %s bytes', memory.rss())
+        if self._tracer is not None:
+            for stat in self._tracer.diff():
+                log.info('memory diff: %s', stat)
+
+    def run_client(self):
+        """ relay requests to the resolver daemon, returns False, if requests
+            have to be processed locally
+        """
+        self._client = Client(self._config)
+        if not self._client.connect():
+            self._client = None
+            return False
+        if self._client.run() or self._exiting:
+            return True
+        log.warning('processing requests locally')
+        self._pending = list(self._client.pending)
+        self._client = None
+        return False
 
     def run(self):
         """ main loop """
         ret = 0
         log.info('running (%s)', os.getpid())
+        if self._config.simulate:
+            return Simulator(self._config, self._config.simulate).run()
+        worker = self._config.fetch_worker
+        if self._config.thin_client():
+            if self.run_client():
+                log.info('finished (%s)', os.getpid())
+                return ret
+            self._config.load_aux_config()
+        if self._config.fetch_process and not worker:
+            # the worker sets up the fetch queue itself
+            self._worker = FetchWorker(self._config)
+            self._worker.start()
+        else:
+            self._config.setup_fetch_queue()
         self.start_threads()
         while not self._exiting:
             time.sleep(MAIN_DELAY)
-            if self._config.auto_reload and self._config.check_sections_reload():
+            # the helper reloads its worker
+            if (self._config.auto_reload and not worker and
+                    self._config.check_sections_reload()):
                 self._reload = True
                 log.info('reload config')
             if self._reload:
-                self.stop_threads()
-                self._config.reload()
-                self.start_threads()
-                log.trace(self._config)
+                self.reload()
                 self._reload = False
-            if not self._threads[0][1].is_alive():
+            if self._worker is not None and not self._exiting:
+                self._worker.check()
+            if self._pool is not None and not self._exiting:
+                self._pool.check()
+            if self._stats:
+                self.log_stats()
+                self._stats = False
+            # the first thread serves squid, or feeds the fetch worker
+            if self._threads and not self._threads[0][1].is_alive():
                log.error('dedup thread terminated. Exiting')
                self.shutdown()
+        self.stop()
         log.info('finished (%s)', os.getpid())
         return ret
 
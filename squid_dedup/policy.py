@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import time
+import queue
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger('policy')
+
+
+class Popularity:
+    """ request statistics of a rewritten object """
+    __slots__ = ('requests', 'mirrors', 'last', 'queued')
+
+    def __init__(self):
+        self.requests = 0
+        self.mirrors = set()
+        self.last = 0.0
+        self.queued = False
+
+
+class FetchPolicy:
+    """ decide, which objects are worth fetching, and how urgently
+
+        an object is queued for fetching, as soon as it was requested
+        fetch_min_requests times, or from fetch_min_mirrors distinct URLs
+        the priority is the time of the last request, advanced by
+        fetch_request_bonus seconds for each additional request and mirror
+        an object, that is dropped from the queue, or given up, is released,
+        and queued again with the next request
+    """
+
+    # shared by all dedup instances: survives reloads
+    _seen = OrderedDict()
+
+    def __init__(self, config):
+        self._config = config
+        self._queue = config.fetch_queue
+        self._bonus = config.fetch_request_bonus
+        self._size = config.fetch_track_size
+        self._queue.ondrop = self.release
+
+    def priority(self, entry):
+        return entry.last + self._bonus * (entry.requests + len(entry.mirrors) - 2)
+
+    def request(self, section, newurl, url):
+        """ account a request of newurl via url, and feed the fetch queue """
+        try:
+            entry = self._seen[newurl]
+        except KeyError:
+            entry = self._seen[newurl] = Popularity()
+            if len(self._seen) > self._size:
+                self._seen.popitem(last = False)
+        else:
+            self._seen.move_to_end(newurl)
+        entry.requests += 1
+        entry.mirrors.add(url)
+        entry.last = time.time()
+        if entry.queued:
+            # raise the priority of a still pending object
+            self._queue.reprioritize(newurl, self.priority(entry))
+        elif (entry.requests >= section.fetch_min_requests or
+              (section.fetch_min_mirrors and
+               len(entry.mirrors) >= section.fetch_min_mirrors)):
+            priority = self.priority(entry)
+            log.debug('queue <%s>: requests: %s, mirrors: %s, priority: %.0f',
+                      newurl, entry.requests, len(entry.mirrors), priority)
+            # the queue might drop the item right away, and release it
+            entry.queued = True
+            try:
+                self._queue.put((newurl, url, section.name, priority), block = False)
+            except queue.Full:
+                # try again with the next request
+                log.debug('fetch queue full: <%s> rejected', newurl)
+                entry.queued = False
+
+    @classmethod
+    def release(cls, newurl):
+        """ newurl left the fetch queue unfetched: queue it again on request """
+        entry = cls._seen.get(newurl)
+        if entry is not None:
+            entry.queued = False
+
+    @classmethod
+    def mirrors(cls, newurl):
+        """ return the set of URLs, newurl was requested with """
+        entry = cls._seen.get(newurl)
+        return set() if entry is None else set(entry.mirrors)
+
+    @classmethod
+    def stats(cls):
+        return dict(tracked = len(cls._seen))
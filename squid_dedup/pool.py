@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# fetch pool: supervises the fetch threads, restarts crashed ones, and grows
+# and shrinks their number with the backlog of the fetch queue, it survives
+# config reloads, thus fetches in progress aren't interrupted
+
+import time
+import logging
+import threading
+
+from fetch import Fetch
+from afetch import AsyncFetch
+
+log = logging.getLogger('pool')
+
+JOIN_TIMEOUT = 1.0
+
+
+class FetchPool:
+    """ keep between fetch_threads and fetch_threads_max fetch threads
+        running: one is added, while queued items wait longer than
+        fetch_scale_wait seconds, and there are more of them than threads
+        (at most one each fetch_scale_wait seconds), one is retired after
+        fetch_scale_idle seconds without backlog
+    """
+    def __init__(self, config, queue, name):
+        self._queue = queue
+        # name passed to the fetch threads
+        self._name = name
+        self._engine = None
+        # (fetch, thread) of the active fetch threads
+        self._workers = []
+        # retired fetch threads put their current item back into the queue
+        self._retired = []
+        # last time, the queue had a backlog, and the pool grew
+        self._idle = self._grown = time.monotonic()
+        self.restarted = 0
+        self.grown = 0
+        self.shrunk = 0
+        self.configure(config)
+
+    def configure(self, config):
+        """ apply config: thread settings are updated in place, the number
+            of threads is adjusted, the engine is replaced, if changed, or
+            if the number of connections of the asyncio engine changed
+        """
+        Fetch.configure(config)
+        self._config = config
+        if config.fetch_engine == 'asyncio':
+            # a single thread handles all fetches concurrently
+            engine, self._min, self._max = AsyncFetch, 1, 1
+        else:
+            engine = Fetch
+            self._min = config.fetch_threads
+            self._max = max(self._min, config.fetch_threads_max)
+        self._wait = config.fetch_scale_wait
+        self._idle_time = config.fetch_scale_idle
+        # the asyncio engine sizes its connections on start
+        if engine is not self._engine or (
+                engine is AsyncFetch and self._workers and
+                self._workers[0][0]._connections != config.fetch_connections):
+            self._engine = engine
+            while self._workers:
+                self.retire()
+        for fetch, t in self._workers:
+            fetch.setup(config)
+        while len(self._workers) < self._min:
+            self.start()
+        while len(self._workers) > self._max:
+            self.retire()
+        log.debug('configure: %s', self.stats())
+
+    def start(self):
+        fetch = self._engine(self._config, self._queue)
+        t = threading.Thread(target = fetch.run, args = (self._name, ), daemon = True)
+        t.start()
+        self._workers.append((fetch, t))
+
+    def retire(self):
+        """ let the youngest thread put its current item back, and exit """
+        fetch, t = self._workers.pop()
+        fetch.exit()
+        self._retired.append((fetch, t))
+
+    def check(self):
+        """ replace crashed threads, and scale with the backlog """
+        self._retired = [(fetch, t) for fetch, t in self._retired if t.is_alive()]
+        for i, (fetch, t) in enumerate(self._workers):
+            if not t.is_alive():
+                log.error('%s terminated: restarting', t.name)
+                self.restarted += 1
+                item = fetch.item
+                if item is not None:
+                    # might crash the fetcher again
+                    log.error('%s: processing <%s> failed: dropped', t.name, item[1])
+                    self._queue.done(item)
+                for item in fetch.unfinished():
+                    fetch.abort(item)
+                del self._workers[i]
+                self.start()
+                break
+        stats = self._queue.stats()
+        now = time.monotonic()
+        n = len(self._workers)
+        if stats['depth']:
+            self._idle = now
+            if (n < self._max and stats['depth'] > n and stats['wait'] >= self._wait and
+                    now - self._grown >= self._wait):
+                log.info('fetch queue: %s items, waiting %.0fs: %s fetch threads',
+                         stats['depth'], stats['wait'], n + 1)
+                self.grown += 1
+                self._grown = now
+                self.start()
+        elif n > self._min and now - self._idle >= self._idle_time:
+            log.info('fetch queue idle: %s fetch threads', n - 1)
+            self.shrunk += 1
+            self.retire()
+            self._idle = now
+
+    def exit(self):
+        for fetch, t in self._workers + self._retired:
+            fetch.exit()
+        for fetch, t in self._workers + self._retired:
+            t.join(timeout = JOIN_TIMEOUT)
+        self._workers = []
+        self._retired = []
+
+    def stats(self):
+        return dict(threads = len(self._workers), retiring = len(self._retired),
+                    min = self._min, max = self._max, restarted = self.restarted,
+                    grown = self.grown, shrunk = self.shrunk)
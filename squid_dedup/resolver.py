@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# resolver daemon: a single process owns the ruleset, the rewrite cache and
+# the fetch pipeline, and serves the squid helpers (thin clients) over a unix
+# socket, clients relay squid requests and replies verbatim, line by line
+
+import os
+import sys
+import time
+import select
+import socket
+import logging
+import selectors
+import collections
+
+from dedup import Dedup, DEDUP_TIMEOUT
+from lib import linereader
+from lib import profile
+
+log = logging.getLogger('resolver')
+
+LISTEN_BACKLOG = 128
+# max. bytes of replies kept for a client, that doesn't read them
+MAX_OUTPUT = 1 << 20
+
+
+class Output:
+    """ reply buffer of a non-blocking client connection """
+    def __init__(self, conn):
+        self._conn = conn
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+
+    def flush(self):
+        """ send as much of the buffer as possible without blocking """
+        if self.buffer:
+            try:
+                n = self._conn.send(self.buffer)
+            except BlockingIOError:
+                return
+            del self.buffer[:n]
+
+
+class Resolver(Dedup):
+    """ serve dedup requests of thin clients over a unix socket """
+
+    # listening socket and client connections survive reloads
+    _listener = None
+    _clients = {}
+
+    @classmethod
+    def listen(cls, path):
+        if cls._listener is not None:
+            return cls._listener
+        if os.path.exists(path):
+            # a stale socket of a crashed daemon is replaced,
+            # a running daemon is left alone
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError('another resolver daemon is serving %s' % path)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        os.chmod(path, 0o660)
+        listener.listen(LISTEN_BACKLOG)
+        cls._listener = listener
+        log.info('serving %s', path)
+        return listener
+
+    @classmethod
+    def close(cls):
+        """ close all connections, and remove the socket """
+        for conn, (reader, out) in cls._clients.items():
+            conn.close()
+        cls._clients.clear()
+        if cls._listener is not None:
+            path = cls._listener.getsockname()
+            cls._listener.close()
+            cls._listener = None
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @profile.profile('resolver')
+    def run(self):
+        log.debug('running')
+        try:
+            listener = self.listen(self._config.resolver_socket)
+        except OSError as e:
+            log.error('resolver socket %s: %s', self._config.resolver_socket, e)
+            return
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        for conn, (reader, out) in self._clients.items():
+            selector.register(conn, self.events(out))
+        while not self._exiting:
+            self._profiler.check()
+            self.check_ruleset()
+            for key, mask in selector.select(DEDUP_TIMEOUT):
+                conn = key.fileobj
+                if conn is listener:
+                    self.accept(listener, selector)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.send(conn, selector)
+                if mask & selectors.EVENT_READ and conn in self._clients:
+                    self.serve(conn, selector)
+        selector.close()
+        log.debug('finished')
+
+    def accept(self, listener, selector):
+        try:
+            conn, addr = listener.accept()
+        except OSError as e:
+            log.error('accept failed: %s', e)
+            return
+        # replies are buffered, a slow client must not block the others
+        conn.setblocking(False)
+        self._clients[conn] = (linereader.LineReader(conn.fileno()), Output(conn))
+        selector.register(conn, selectors.EVENT_READ)
+        log.debug('client %s connected (%s clients)', conn.fileno(), len(self._clients))
+
+    def serve(self, conn, selector):
+        reader, out = self._clients[conn]
+        start = time.perf_counter()
+        try:
+            eof = reader.fill() == 0
+            lines = reader.lines()
+            if lines:
+                self.process_lines(lines, out, start)
+        except OSError as e:
+            log.error('client %s: %s', conn.fileno(), e)
+            eof = True
+        if not eof and len(out.buffer) > MAX_OUTPUT:
+            log.error('client %s: %s bytes of replies unread: dropped',
+                      conn.fileno(), len(out.buffer))
+            eof = True
+        if eof:
+            self.disconnect(conn, selector)
+        else:
+            self.watch(conn, out, selector)
+
+    def send(self, conn, selector):
+        """ send buffered replies, when the client is ready to receive them """
+        reader, out = self._clients[conn]
+        try:
+            out.flush()
+        except OSError as e:
+            log.error('client %s: %s', conn.fileno(), e)
+            self.disconnect(conn, selector)
+        else:
+            self.watch(conn, out, selector)
+
+    @staticmethod
+    def events(out):
+        if out.buffer:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def watch(self, conn, out, selector):
+        """ wait for the client to receive, while replies are buffered """
+        events = self.events(out)
+        if selector.get_key(conn).events != events:
+            selector.modify(conn, events)
+
+    def disconnect(self, conn, selector):
+        log.debug('client %s disconnected', conn.fileno())
+        selector.unregister(conn)
+        del self._clients[conn]
+        conn.close()
+
+
+class Client:
+    """ thin client: relay squid requests to the resolver daemon """
+    def __init__(self, config):
+        self._config = config
+        self._exiting = False
+        self._sock = None
+        # requests, that weren't answered yet
+        self.pending = collections.deque()
+
+    def exit(self):
+        self._exiting = True
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._config.resolver_socket)
+        except OSError as e:
+            log.info('resolver %s unavailable: %s', self._config.resolver_socket, e)
+            sock.close()
+            return False
+        self._sock = sock
+        log.debug('connected to %s', self._config.resolver_socket)
+        return True
+
+    def run(self):
+        """ relay requests until stdin is closed, returns True, or False,
+            if the resolver failed, with the unanswered requests in pending
+        """
+        stdin = Dedup.stdin_reader()
+        replies = linereader.LineReader(self._sock.fileno())
+        out = sys.stdout.buffer
+        try:
+            while not self._exiting and not (stdin.eof and not self.pending):
+                rlist = [replies] if stdin.eof else [stdin, replies]
+                rlist = select.select(rlist, [], [], DEDUP_TIMEOUT)[0]
+                if stdin in rlist:
+                    stdin.fill()
+                    lines = stdin.lines()
+                    if lines:
+                        self.pending.extend(lines)
+                        lines.append(b'')
+                        self._sock.sendall(b'\n'.join(lines))
+                if replies in rlist:
+                    if not replies.fill():
+                        raise OSError('connection closed')
+                    lines = replies.lines()
+                    if len(lines) > len(self.pending):
+                        log.error('resolver %s: %s unexpected replies dropped',
+                                  self._config.resolver_socket,
+                                  len(lines) - len(self.pending))
+                        del lines[len(self.pending):]
+                    if lines:
+                        for line in lines:
+                            self.pending.popleft()
+                        lines.append(b'')
+                        out.write(b'\n'.join(lines))
+                        out.flush()
+        except OSError as e:
+            log.error('resolver %s failed: %s', self._config.resolver_socket, e)
+            return False
+        finally:
+            self._sock.close()
+        return True
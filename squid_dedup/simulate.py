@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# offline savings simulator: replay squid access.log files through the
+# ruleset, and model a squid cache with and without store-id rewriting
+#
+# access.log files are split into chunks, that are parsed and matched by
+# worker processes, while the cache models are fed in log order by the
+# main process, only successful GET requests (status 200) are considered,
+# partial responses (status 206) are reported separately, as they don't
+# tell the object size
+
+import os
+import gzip
+import time
+import logging
+import collections
+import multiprocessing
+
+from dedup import Dedup
+from lib import accesslog, cachesim
+
+log = logging.getLogger('simulate')
+
+# uncompressed files are split into chunks of this size
+CHUNK_SIZE = 16 << 20
+# number of mirrors in the report
+REPORT_MIRRORS = 20
+# requests, that don't match any section, are reported as
+UNMATCHED = '-'
+# status of complete and partial responses
+OK, PARTIAL = 200, 206
+
+# the ruleset, inherited by the forked worker processes
+_dedup = None
+
+
+def chunks(paths, size = CHUNK_SIZE):
+    """ split files into (path, start, end) chunks, compressed files can't be split """
+    for path in paths:
+        if path.endswith('.gz'):
+            yield path, 0, None
+        else:
+            end = os.path.getsize(path)
+            for start in range(0, end, size):
+                yield path, start, min(start + size, end)
+
+
+def read_chunk(path, start, end):
+    """ yield the lines of a file, that start within start and end """
+    if end is None:
+        with gzip.open(path, 'rb') as f:
+            yield from f
+        return
+    with open(path, 'rb') as f:
+        if start:
+            # skip the line, that started in the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def match_chunk(chunk):
+    """ worker: parse a chunk, and match the URLs of successful GET requests
+        returns a list of (timestamp, url, host, section name, store-id, size,
+        status)
+    """
+    records = []
+    parse_bytes = _dedup.parse_bytes
+    try:
+        for line in read_chunk(*chunk):
+            request = accesslog.parse(line)
+            if request is None:
+                continue
+            ts, method, url, status, size = request
+            if method != b'GET' or status not in (OK, PARTIAL):
+                continue
+            host = url.split(b'/', 3)[2:3]
+            host = host[0].decode('utf-8', 'replace') if host else UNMATCHED
+            rule = parse_bytes(url)
+            if rule is None:
+                records.append((ts, url, host, None, url, size, status))
+            else:
+                records.append((ts, url, host, rule[0].name, rule[1], size, status))
+    except OSError as e:
+        log.error('%s: %s', chunk[0], e)
+    return records
+
+
+def sizestr(size):
+    """ format a byte count with a binary unit suffix """
+    for unit in ('', 'k', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    return ('%.0f%s' if unit == '' else '%.1f%s') % (size, unit)
+
+
+def percent(part, total):
+    return 100.0 * part / total if total else 0.0
+
+
+class Simulator:
+    """ compare a squid cache with and without store-id rewriting """
+
+    # requests, bytes, hits and hit bytes without and with store-id
+    STATS = 6
+
+    def __init__(self, config, paths):
+        self._config = config
+        self._paths = paths
+        self._plain = cachesim.LRUCache(config.simulate_cache_size,
+                                        config.simulate_max_object_size)
+        self._storeid = cachesim.LRUCache(config.simulate_cache_size,
+                                          config.simulate_max_object_size)
+        self._sections = collections.defaultdict(lambda: [0] * self.STATS)
+        self._mirrors = collections.defaultdict(lambda: [0] * self.STATS)
+        # section name: bytes, the fetcher would request
+        self._fetch = collections.Counter()
+        # section name: requests and bytes of partial responses
+        self._partial = collections.defaultdict(lambda: [0, 0])
+        self._first = self._last = None
+
+    def fetched(self, section, size):
+        """ would the fetcher request an object of size in section? """
+        if not section.fetch or size < section.fetch_min_size:
+            return False
+        if section.fetch_max_size and size > section.fetch_max_size:
+            return bool(self._config.fetch_offpeak_hours)
+        return True
+
+    def account(self, record):
+        ts, url, host, name, key, size, status = record
+        self.timespan(ts)
+        if status == PARTIAL:
+            # the cache models need the object size
+            stats = self._partial[name or UNMATCHED]
+            stats[0] += 1
+            stats[1] += size
+            return
+        plain = self._plain.request(url, size)
+        storeid = self._storeid.request(key, size)
+        for stats in (self._sections[name or UNMATCHED], self._mirrors[host]):
+            stats[0] += 1
+            stats[1] += size
+            if plain:
+                stats[2] += 1
+                stats[3] += size
+            if storeid:
+                stats[4] += 1
+                stats[5] += size
+        if not storeid and name is not None:
+            section = self._config.section_dict.get(name)
+            if section is not None and self.fetched(section, size):
+                self._fetch[name] += size
+
+    def timespan(self, ts):
+        if ts is not None:
+            if self._first is None or ts < self._first:
+                self._first = ts
+            if self._last is None or ts > self._last:
+                self._last = ts
+
+    def run(self):
+        global _dedup
+        _dedup = Dedup(self._config)
+        processes = self._config.simulate_processes or os.cpu_count()
+        log.info('simulate %s with %s processes', ', '.join(self._paths), processes)
+        start = time.time()
+        requests = 0
+        try:
+            # workers inherit the ruleset: no need to pickle it
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                for records in pool.imap(match_chunk, chunks(self._paths)):
+                    for record in records:
+                        self.account(record)
+                    requests += len(records)
+        except OSError as e:
+            log.error('simulate failed: %s', e)
+            return 1
+        log.info('simulated %s requests in %.1f sec.: %s, %s',
+                 requests, time.time() - start, self._plain, self._storeid)
+        self.report()
+        return 0
+
+    def table(self, title, rows):
+        print('%-32s %10s %10s %7s %7s %10s %10s %10s' % (
+              title, 'requests', 'bytes', 'hit%', 'sid%', 'hit', 'sid hit', 'saved'))
+        for name, (requests, size, hits, hitsize, sidhits, sidsize) in rows:
+            print('%-32s %10d %10s %6.1f%% %6.1f%% %10s %10s %10s' % (
+                  name[:32], requests, sizestr(size), percent(hits, requests),
+                  percent(sidhits, requests), sizestr(hitsize), sizestr(sidsize),
+                  sizestr(sidsize - hitsize)))
+        print()
+
+    def report(self):
+        """ print hit ratios and bytes served from the cache without and with
+            store-id (sid), and the bytes saved by store-id, per section and mirror,
+            and the partial responses per section
+        """
+        total = [sum(column) for column in zip(*self._sections.values())] or [0] * self.STATS
+        sections = sorted(self._sections.items(), key = lambda item: -item[1][1])
+        self.table('section', sections + [('total', total)])
+        mirrors = sorted(self._mirrors.items(), key = lambda item: -item[1][5])
+        self.table('mirror (top %s)' % REPORT_MIRRORS, mirrors[:REPORT_MIRRORS])
+        if self._fetch:
+            span = (self._last - self._first) if self._first is not None else 0
+            print('%-32s %10s %10s' % ('fetch section', 'bytes', 'rate/s'))
+            for name, size in sorted(self._fetch.items(), key = lambda item: -item[1]):
+                rate = sizestr(size / span) if span else '-'
+                print('%-32s %10s %10s' % (name[:32], sizestr(size), rate))
+            print()
+        if self._partial:
+            print('%-32s %10s %10s' % ('partial (206) section', 'requests', 'bytes'))
+            for name, (requests, size) in sorted(self._partial.items(),
+                                                 key = lambda item: -item[1][1]):
+                print('%-32s %10d %10s' % (name[:32], requests, sizestr(size)))
+            print()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# helpers shared by the tests
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import record
+from config import Config
+
+
+def config(**kwargs):
+    """ return a config record with the fetch defaults, updated by kwargs """
+    cf = dict(fetch_queue = None, fetch_request_bonus = 60, fetch_track_size = 100,
+              fetch_connections = 4, fetch_rate = 0, fetch_host_limit = 0,
+              fetch_breaker_failures = 0, fetch_breaker_cooloff = 0,
+              section_dict = {}, fetch_delay = 0, fetch_connect_timeout = 10,
+              fetch_read_timeout = 10, fetch_retries = 0, fetch_backoff = 1,
+              fetch_backoff_max = 1, fetch_mirror_select = False,
+              fetch_mirror_stats = '', fetch_offpeak_hours = '', fetch_blocksize = 1024,
+              http_proxy = None, https_proxy = None, fetch_engine = 'threads',
+              fetch_threads = 1, fetch_threads_max = 0, fetch_scale_wait = 0,
+              fetch_scale_idle = 0)
+    cf.update(kwargs)
+    return record.recordfactory('Config', **cf)
+
+
+def wait_for(cond, timeout = 5.0):
+    """ wait until cond() is true, returns False on timeout """
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def load(cfgfile):
+    """ return a config loaded from cfgfile, without command line processing """
+    config = Config.__new__(Config)
+    for attr, value in Config.__dict__.items():
+        if not attr.startswith('__') and not callable(value):
+            config.__dict__[attr] = value
+    config.cfgfile = cfgfile
+    config.load_primary_config(cfgfile)
+    config.load_aux_config()
+    return config
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+"""
+Usage: soak.py [-uc][-n requests][-s size]
+       -n, --requests=n     number of synthetic requests [default: %(requests)s]
+       -s, --size=n         rewrite cache, fetch queue and tracking size
+                            [default: %(size)s]
+       -u, --unbounded      disable the bounds (0 sizes), for comparison
+       -c, --compact        keep the rewrite cache in its compact form
+
+Soak test: drive unique synthetic URLs through Dedup in batches, as squid
+would, and check, that the peak number of allocated memory blocks doesn't
+grow any further after the first half of the requests (by more than
+%(tolerance)s percent), where the bounds are reached already, given enough
+requests. Peaks are compared, as the compact rewrite cache drops half of its
+entries at once.
+The resident set size is reported as well, but might still grow a bit due
+to fragmentation. Not part of the unit tests, as it takes a while.
+"""
+
+import os
+import sys
+import time
+import getopt
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import memory
+
+REQUESTS = 2000000
+SIZE = 100000
+BATCH = 100
+# allowed growth of allocated blocks after the warm-up in percent
+TOLERANCE = 1
+
+PRIMARY = """\
+[global]
+include: %(tmpdir)s/*.conf
+logfile: -
+loglevel: WARNING
+sysloglevel:
+auto_reload: false
+fetch_delay: 0
+rewrite_cache_size: %(size)s
+rewrite_cache_compact: %(compact)s
+fetch_queue_size: %(size)s
+fetch_track_size: %(size)s
+"""
+
+SECTIONS = """\
+[soak]
+prefix: http://mirror1.example.com/pub/
+        http://mirror2.example.com/pub/
+replace: http://soak.%%(intdomain)s/\\1
+fetch: true
+
+[soak_cdn]
+match: http:\\/\\/[a-z0-9]+\\.cdn\\.example\\.org\\/(.*)
+replace: http://cdn.%%(intdomain)s/\\1
+fetch: true
+"""
+
+HOSTS = (b'http://mirror1.example.com/pub/', b'http://mirror2.example.com/pub/',
+         b'http://a1.cdn.example.org/', b'http://b2.cdn.example.org/',
+         b'http://other.example.net/')
+
+
+class Sink:
+    """ stdout replacement: discard replies """
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def requests(n):
+    """ yield batches of unique synthetic request lines """
+    batch = []
+    for i in range(n):
+        batch.append(b'%d %sdist/%d/pkg-%d.rpm ip=10.0.0.1 method=GET' % (
+                     i % 10, HOSTS[i % len(HOSTS)], i % 97, i))
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def soak(n, size, compact = False):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        primary = os.path.join(tmpdir, 'soak.cfg')
+        with open(primary, 'w') as f:
+            f.write(PRIMARY % dict(tmpdir = tmpdir, size = size, compact = compact))
+        with open(os.path.join(tmpdir, 'soak.conf'), 'w') as f:
+            f.write(SECTIONS)
+        # Config processes the command line
+        sys.argv[1:] = ['-c', primary]
+        from config import Config
+        from dedup import Dedup
+        config = Config()
+        config.setup_fetch_queue()
+        dedup = Dedup(config)
+        sink = Sink()
+        warm = None
+        # peak allocated blocks of the first and second half
+        peaks = [0, 0]
+        start = time.time()
+        for i, batch in enumerate(requests(n), 1):
+            dedup.process_lines(batch, sink)
+            half = warm is not None
+            peaks[half] = max(peaks[half], sys.getallocatedblocks())
+            if warm is None and i * BATCH >= n // 2:
+                warm = memory.rss()
+        elapsed = time.time() - start
+        rss = memory.rss()
+        print('%s requests in %.1f sec. (%.0f/s)' % (n, elapsed, n / elapsed))
+        entries = len(dedup._bcache)
+        print('rewrite cache: %s entries, ~%s bytes per entry, fetch queue: %s' % (
+              entries, memory.size(dedup._bcache) // max(entries, 1),
+              config.fetch_queue.stats()))
+        print('peak allocated blocks until warm-up: %s, after: %s' % tuple(peaks))
+        print('rss after warm-up: %s, at the end: %s, growth: %s bytes' % (
+              warm, rss, rss - warm))
+        return 100.0 * (peaks[1] - peaks[0]) / peaks[0]
+
+
+if __name__ == '__main__':
+    n, size, compact = REQUESTS, SIZE, False
+    doc = __doc__ % dict(requests = REQUESTS, size = SIZE, tolerance = TOLERANCE)
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hucn:s:',
+                                      ('help', 'unbounded', 'compact', 'requests=', 'size='))
+    except getopt.error as msg:
+        print(msg, doc, file = sys.stderr)
+        sys.exit(2)
+    for opt, par in optlist:
+        if opt in ('-h', '--help'):
+            print(doc)
+            sys.exit(0)
+        elif opt in ('-u', '--unbounded'):
+            size = 0
+        elif opt in ('-c', '--compact'):
+            compact = True
+        elif opt in ('-n', '--requests'):
+            n = int(par)
+        elif opt in ('-s', '--size'):
+            size = int(par)
+    growth = soak(n, size, compact)
+    if size and growth > TOLERANCE:
+        print('FAILED: allocations grow by %.1f%% with bounded sizes' % growth)
+        sys.exit(1)
+    print('OK' if size else 'unbounded: no check')
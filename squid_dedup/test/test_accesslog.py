@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import accesslog
+
+NATIVE = (b'1760000000.123    412 10.0.0.1 TCP_MISS/200 52310 GET '
+          b'http://dl.example.com/a.rpm - HIER_DIRECT/1.2.3.4 application/x-rpm\n')
+COMMON = (b'10.0.0.1 - - [19/Oct/2026:06:00:00 +0200] "GET http://dl.example.com/b.rpm '
+          b'HTTP/1.1" 200 1234 "http://referer.example.com/" "zypper"\n')
+
+class TestAccessLog(TestCase):
+
+    def write(self, data):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        os.write(fd, data)
+        os.close(fd)
+        return path
+
+    def test_url(self):
+        self.assertEqual(accesslog.url(NATIVE), b'http://dl.example.com/a.rpm')
+        self.assertEqual(accesslog.url(COMMON), b'http://dl.example.com/b.rpm')
+        self.assertEqual(accesslog.url(b'http://dl.example.com/c.rpm\n'),
+                         b'http://dl.example.com/c.rpm')
+        self.assertIsNone(accesslog.url(b'1760000000.1 5 10.0.0.1 TCP_TUNNEL/200 0 '
+                                     b'CONNECT dl.example.com:443 -\n'))
+        self.assertIsNone(accesslog.url(b'\n'))
+
+    def test_parse(self):
+        self.assertEqual(accesslog.parse(NATIVE),
+                         (1760000000.123, b'GET', b'http://dl.example.com/a.rpm', 200, 52310))
+        self.assertEqual(accesslog.parse(COMMON),
+                         (None, b'GET', b'http://dl.example.com/b.rpm', 200, 1234))
+        for line in (b'', b'http://dl.example.com/c.rpm\n', b'1 2 10.0.0.1 NONE/000 - GET x\n',
+                     b'10.0.0.1 - - [date] "-" 400 0\n'):
+            self.assertIsNone(accesslog.parse(line))
+
+    def test_tail(self):
+        path = self.write(b'first line\nsecond\nthird\n')
+        self.assertEqual(list(accesslog.tail(path, 0)), [b'first line\n', b'second\n', b'third\n'])
+        # the partial first line is skipped
+        self.assertEqual(list(accesslog.tail(path, 10)), [b'third\n'])
+
+    def test_top_urls(self):
+        path1 = self.write(NATIVE + COMMON + NATIVE)
+        path2 = self.write(b'http://dl.example.com/c.rpm\n' + COMMON * 3)
+        self.assertEqual(accesslog.top_urls([path1, path2], 0, 2),
+                         [b'http://dl.example.com/b.rpm', b'http://dl.example.com/a.rpm'])
+        self.assertRaises(OSError, accesslog.top_urls, [path1 + '.missing'])
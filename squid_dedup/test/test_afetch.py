@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import asyncio
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import journal
+from lib import logsetup
+from fetch import Fetch, FETCH_OK, FETCH_ERROR, FETCH_TRUNCATED
+from fixtures import config
+import afetch
+
+CHUNKED = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+           b'4\r\nabcd\r\n3;name=value\r\nefg\r\n0\r\nX-Trailer: 1\r\n\r\n')
+
+
+def response(body, **header):
+    head = ''.join('%s: %s\r\n' % (key.replace('_', '-'), value)
+                   for key, value in header.items())
+    return b'HTTP/1.1 200 OK\r\n' + head.encode() + b'\r\n' + body
+
+
+async def hangup(reader, writer):
+    """ close the connection after the previous response """
+
+
+class Server:
+    """ a local server, that replies with scripted responses in turn, and
+        records the requests and the number of connections
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while self.responses:
+                request = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    request.append(line.decode().rstrip())
+                if not request:
+                    break
+                self.requests.append(request)
+                reply = self.responses.pop(0)
+                if reply is None:
+                    break
+                writer.write(reply)
+                await writer.drain()
+                if callable(self.responses[0] if self.responses else None):
+                    await self.responses.pop(0)(reader, writer)
+                    break
+        finally:
+            writer.close()
+
+
+class TestAsyncFetch(TestCase):
+
+    def setUp(self):
+        cf = config(fetch_blocksize = 4, fetch_connect_timeout = 2, fetch_read_timeout = 2)
+        Fetch.configure(cf)
+        self.fetch = afetch.AsyncFetch(cf, journal.JournalQueue())
+
+    def proxy(self, server):
+        self.fetch._proxies = dict(http = ('127.0.0.1', server.port),
+                                   https = ('127.0.0.1', server.port))
+
+    def run_server(self, responses, test):
+        """ run test(server) against a server with responses """
+        async def run():
+            server = await Server(responses).start()
+            try:
+                return await test(server)
+            finally:
+                for idle in self.fetch._idle.values():
+                    for conn in idle:
+                        self.fetch.close(conn)
+                self.fetch._idle.clear()
+                await server.close()
+        return asyncio.run(run())
+
+    def url(self, server, path = '/a'):
+        return 'http://127.0.0.1:%s%s' % (server.port, path)
+
+    def test_chunked(self):
+        async def test(server):
+            conn, status, header = await self.fetch.request(self.url(server))
+            sizes = [n async for n in self.fetch.body(conn[0], None, True)]
+            self.fetch.close(conn)
+            return sizes
+        self.assertEqual(self.run_server([CHUNKED], test), [4, 3])
+
+    def test_chunked_invalid(self):
+        async def test(server):
+            conn, status, header = await self.fetch.request(self.url(server))
+            with self.assertRaises(afetch.HTTPError):
+                async for n in self.fetch.body(conn[0], None, True):
+                    pass
+            self.fetch.close(conn)
+        self.run_server([b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nxyz\r\n'],
+                        test)
+
+    def test_truncated(self):
+        async def test(server):
+            return await self.fetch.fetch('test', self.url(server), 'pkg', 0)
+        # the server closes the connection after 4 of 10 bytes
+        ret = self.run_server([response(b'abcd', Content_Length = 10), hangup], test)
+        self.assertEqual(ret, FETCH_TRUNCATED)
+        self.assertEqual(self.fetch._idle, {})
+
+    def test_header(self):
+        async def test(server):
+            conn, status, header = await self.fetch.request(self.url(server, '/a?b=1'))
+            self.fetch.close(conn)
+            return status, header
+        reply = (b'HTTP/1.1 404 Not Found\r\nContent-Type:  text/html \r\n'
+                 b'X-Multi: a: b\r\n\r\n')
+        status, header = self.run_server([reply], test)
+        self.assertEqual(status, 404)
+        self.assertEqual(header, {'content-type': 'text/html', 'x-multi': 'a: b'})
+
+    def test_header_invalid(self):
+        async def test(server):
+            with self.assertRaises(afetch.HTTPError) as cm:
+                await self.fetch.request(self.url(server))
+            return str(cm.exception)
+        self.assertIn('invalid status line', self.run_server([b'HTTX 200 OK\r\n\r\n'], test))
+        self.assertIn('incomplete header',
+                      self.run_server([b'HTTP/1.1 200 OK\r\nServer: x\r\n'], test))
+
+    def test_keepalive(self):
+        async def test(server):
+            url = self.url(server)
+            rets = [await self.fetch.fetch('test', url, 'pkg', 0)
+                    for i in range(len(server.responses))]
+            return rets, server.connections, len(server.requests)
+        ok = response(b'abcdef', Content_Length = 6)
+        self.assertEqual(self.run_server([ok, ok, CHUNKED], test), ([FETCH_OK] * 3, 1, 3))
+        # unless the server closes the connection
+        close = response(b'abcdef', Content_Length = 6, Connection = 'close')
+        self.assertEqual(self.run_server([close, ok], test), ([FETCH_OK] * 2, 2, 2))
+
+    def test_keepalive_closed(self):
+        async def test(server):
+            url = self.url(server)
+            rets = [await self.fetch.fetch('test', url, 'pkg', 0) for i in range(2)]
+            return rets, server.connections
+        # the server drops the idle connection: the request is sent again
+        ok = response(b'abcdef', Content_Length = 6)
+        self.assertEqual(self.run_server([ok, None, ok], test), ([FETCH_OK] * 2, 2))
+
+    def test_proxy(self):
+        async def test(server):
+            self.proxy(server)
+            ret = await self.fetch.fetch('test', 'http://example.org/a?b=1', 'pkg', 0)
+            return ret, server.requests[0][:2]
+        self.assertEqual(self.run_server([response(b'', Content_Length = 0)], test),
+                         (FETCH_OK, ['GET http://example.org/a?b=1 HTTP/1.1',
+                                     'Host: example.org']))
+
+    def test_redirect(self):
+        async def test(server):
+            ret = await self.fetch.fetch('test', self.url(server), 'pkg', 0)
+            return ret, [request[0] for request in server.requests]
+        # relative and absolute locations are followed, like urllib does
+        moved = lambda status, location: (b'HTTP/1.1 %d Moved\r\nLocation: %s\r\n'
+                                          b'Content-Length: 0\r\n\r\n' % (status, location))
+        ok = response(b'abcdef', Content_Length = 6)
+        async def port(server):
+            server.responses[1] %= server.port
+            return await test(server)
+        responses = [moved(301, b'/b'), moved(307, b'http://127.0.0.1:%d/c'), ok]
+        self.assertEqual(self.run_server(responses, port),
+                         (FETCH_OK, ['GET /a HTTP/1.1', 'GET /b HTTP/1.1', 'GET /c HTTP/1.1']))
+        # up to MAX_REDIRECTS
+        afetch.MAX_REDIRECTS, saved = 1, afetch.MAX_REDIRECTS
+        try:
+            ret, requests = self.run_server([moved(302, b'/b'), moved(302, b'/c')], test)
+        finally:
+            afetch.MAX_REDIRECTS = saved
+        self.assertEqual((ret, len(requests)), (FETCH_ERROR, 2))
+
+    def test_host_slots(self):
+        async def test(server):
+            item = ('http://pkg/a', self.url(server), 'pkg', 0)
+            return await self.fetch.process('test', item)
+        Fetch._done.clear()
+        self.assertTrue(self.run_server([response(b'abcdef', Content_Length = 6)], test))
+        # the slot of an idle host is dropped
+        self.assertEqual(self.fetch._host_slots, {})
+
+    def test_connect(self):
+        hello = []
+        async def handshake(reader, writer):
+            # the client starts TLS through the tunnel
+            hello.append(await reader.read(1))
+        async def test(server):
+            self.proxy(server)
+            with self.assertRaises(afetch.ERRORS):
+                await self.fetch.request('https://example.org/a')
+            return server.requests
+        for start_tls in (True, False):
+            del hello[:]
+            afetch.START_TLS, saved = start_tls, afetch.START_TLS
+            try:
+                requests = self.run_server([b'HTTP/1.1 200 Connection established\r\n\r\n',
+                                            handshake], test)
+            finally:
+                afetch.START_TLS = saved
+            self.assertEqual(requests, [['CONNECT example.org:443 HTTP/1.1',
+                                         'Host: example.org:443']])
+            # a TLS handshake record
+            self.assertEqual(hello, [b'\x16'])
+
+    def test_connect_failed(self):
+        async def test(server):
+            self.proxy(server)
+            with self.assertRaises(afetch.HTTPError) as cm:
+                await self.fetch.request('https://example.org/a')
+            return str(cm.exception)
+        reply = b'HTTP/1.1 403 Forbidden\r\n\r\n'
+        self.assertEqual(self.run_server([reply], test),
+                         'proxy CONNECT failed: HTTP status 403')
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import time
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import breaker
+
+class TestCircuitBreakers(TestCase):
+
+    def test_open(self):
+        cb = breaker.CircuitBreakers(3, 60)
+        for i in range(2):
+            cb.failure('a')
+            self.assertTrue(cb.allow('a'))
+        cb.failure('a')
+        self.assertFalse(cb.allow('a'))
+        self.assertTrue(cb.allow('b'))
+        self.assertGreater(cb.remaining('a'), 59)
+        self.assertEqual(cb.remaining('b'), 0.0)
+        self.assertEqual(cb.opened(), ['a'])
+
+    def test_success_resets(self):
+        cb = breaker.CircuitBreakers(2, 60)
+        cb.failure('a')
+        cb.success('a')
+        cb.failure('a')
+        self.assertTrue(cb.allow('a'))
+
+    def test_half_open(self):
+        cb = breaker.CircuitBreakers(1, 0.05)
+        cb.failure('a')
+        self.assertFalse(cb.allow('a'))
+        time.sleep(0.06)
+        # a single trial request
+        self.assertTrue(cb.allow('a'))
+        self.assertFalse(cb.allow('a'))
+        # failing trial opens the circuit again
+        cb.failure('a')
+        self.assertFalse(cb.allow('a'))
+        time.sleep(0.06)
+        self.assertTrue(cb.allow('a'))
+        cb.success('a')
+        self.assertTrue(cb.allow('a'))
+        self.assertTrue(cb.allow('a'))
+
+    def test_trip(self):
+        cb = breaker.CircuitBreakers(0, 60)
+        for i in range(10):
+            cb.failure('a')
+        # disabled breakers
+        self.assertTrue(cb.allow('a'))
+        cb.trip('a', 120)
+        self.assertFalse(cb.allow('a'))
+        self.assertGreater(cb.remaining('a'), 119)
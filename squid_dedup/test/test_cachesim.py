@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import cachesim
+
+class TestLRUCache(TestCase):
+
+    def test_hits(self):
+        cache = cachesim.LRUCache(100)
+        self.assertFalse(cache.request('a', 10))
+        self.assertTrue(cache.request('a', 10))
+        self.assertFalse(cache.request('b', 10))
+        self.assertEqual((len(cache), cache.used), (2, 20))
+
+    def test_evict(self):
+        cache = cachesim.LRUCache(100)
+        for key in ('a', 'b', 'c'):
+            cache.request(key, 40)
+        # a was evicted, b is least recently used now
+        self.assertEqual((cache.used, cache.evicted), (80, 1))
+        self.assertTrue(cache.request('b', 40))
+        cache.request('d', 40)
+        self.assertTrue(cache.request('b', 40))
+        self.assertFalse(cache.request('c', 40))
+
+    def test_max_object_size(self):
+        cache = cachesim.LRUCache(100, 50)
+        self.assertFalse(cache.request('big', 60))
+        self.assertFalse(cache.request('big', 60))
+        self.assertEqual(len(cache), 0)
+        # objects larger than the cache aren't cached either
+        cache = cachesim.LRUCache(100)
+        cache.request('huge', 200)
+        self.assertEqual((len(cache), cache.evicted), (0, 0))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import canonical
+
+class TestCanonicalizer(TestCase):
+
+    def test_all(self):
+        canon = canonical.Canonicalizer()
+        self.assertEqual(canon('HTTP://Mirror.Example.COM:80//pub//%7euser/a%2fb%41.rpm?x=%7e%2f'),
+                         'http://mirror.example.com/pub/~user/a%2FbA.rpm?x=~%2F')
+        self.assertEqual(canon('https://mirror.example.com:443/a'), 'https://mirror.example.com/a')
+        self.assertEqual(canon('http://mirror.example.com:/a'), 'http://mirror.example.com/a')
+        # the query keeps its slashes, the path keeps its case
+        self.assertEqual(canon('http://example.com/A//b?u=http://x//y'),
+                         'http://example.com/A/b?u=http://x//y')
+
+    def test_unchanged(self):
+        canon = canonical.Canonicalizer()
+        for url in ('http://example.com/a/b.rpm', 'http://example.com:8080/a',
+                    'https://example.com:80/a', 'http://[::1]/a', 'http://user:Pw@host/a',
+                    'example.com:443', 'invalid'):
+            self.assertEqual(canon(url), url)
+        self.assertEqual(canon('http://[::1]:80/a'), 'http://[::1]/a')
+        self.assertEqual(canon('http://User@Host/a'), 'http://User@host/a')
+
+    def test_steps(self):
+        url = 'HTTP://Example.com:80//a%7e'
+        self.assertEqual(canonical.Canonicalizer([canonical.HOST])(url),
+                         'http://example.com:80//a%7e')
+        self.assertEqual(canonical.Canonicalizer(['port', 'slashes'])(url),
+                         'HTTP://Example.com/a%7e')
+        self.assertEqual(canonical.Canonicalizer(['percent']).steps, ('percent', ))
+        self.assertRaises(ValueError, canonical.Canonicalizer, ['case'])
+
+    def test_bytes(self):
+        canon = canonical.Canonicalizer()
+        self.assertEqual(canon.bytes(b'HTTP://Example.com:80//a%7e\xff'),
+                         b'http://example.com/a~\xff')
+
+    def test_filters(self):
+        qf = canonical.QueryFilter(strip = ['token'])
+        canon = canonical.Canonicalizer((), [('http://x/', qf), ('http://x/keep/', None),
+                                             ('HTTP://X/', None)])
+        self.assertEqual(canon('http://x/a?token=1&v=2'), 'http://x/a?v=2')
+        self.assertEqual(canon('http://X/a?token=1'), 'http://X/a')
+        self.assertEqual(canon.bytes(b'http://x/a?token=1&v=2'), b'http://x/a?v=2')
+        # a longer prefix without filter takes precedence
+        self.assertEqual(canon('http://x/keep/a?token=1'), 'http://x/keep/a?token=1')
+        self.assertEqual(canon('http://y/a?token=1'), 'http://y/a?token=1')
+        # after the canonicalization steps
+        canon = canonical.Canonicalizer(canonical.STEPS, [('http://x/', qf)])
+        self.assertEqual(canon('HTTP://X:80//a?token=1'), 'http://x/a')
+
+
+class TestQueryFilter(TestCase):
+
+    def test_strip(self):
+        qf = canonical.QueryFilter(strip = ['token', 'utm_*'])
+        self.assertEqual(qf('http://x/a?token=1&v=2&utm_source=z'), 'http://x/a?v=2')
+        self.assertEqual(qf('http://x/a?token=1'), 'http://x/a')
+        self.assertEqual(qf('http://x/a?tokens=1&flag'), 'http://x/a?tokens=1&flag')
+        self.assertEqual(qf('http://x/a'), 'http://x/a')
+        self.assertEqual(qf(b'http://x/a?token=1&v=2'), b'http://x/a?v=2')
+
+    def test_keep(self):
+        qf = canonical.QueryFilter(keep = ['v'])
+        self.assertEqual(qf('http://x/a?token=1&v=2&w=3'), 'http://x/a?v=2')
+        self.assertEqual(qf(b'http://x/a?mirror=3'), b'http://x/a')
+        qf = canonical.QueryFilter(strip = ['v*'], keep = ['v*', 'w'])
+        self.assertEqual(qf('http://x/a?v=2&w=3&x=4'), 'http://x/a?w=3')
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import logging
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import logsetup
+from config import Config
+from dedup import Dedup
+from fixtures import load
+
+PRIMARY = """\
+[global]
+include: %(include)s
+fetch_rate: %(rate)s
+logfile: -
+loglevel: WARNING
+sysloglevel: NONE
+"""
+
+SECTION = """\
+[%(name)s]
+match: ^http://%(name)s\\.org/(.*)
+replace: http://%(name)s.%%(intdomain)s/\\1
+%(option)s
+"""
+
+AUX = """\
+[pkg]
+match: %s
+replace: http://pkg.%%(intdomain)s/\\1
+"""
+
+
+class TestConfigSections(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cfgfile = os.path.join(self.tmpdir.name, 'squid-dedup.conf')
+        self.auxfile = os.path.join(self.tmpdir.name, 'pkg.conf')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        logsetup.logsetup(logging.WARN)
+
+    def write(self, rate, *sections):
+        with open(self.cfgfile, 'w') as f:
+            f.write(PRIMARY % dict(include = os.path.join(self.tmpdir.name, '*.conf'),
+                                   rate = rate))
+        with open(self.auxfile, 'w') as f:
+            for name, option in sections:
+                f.write(SECTION % dict(name = name, option = option))
+
+    def test_invalid_size(self):
+        # a section with an invalid size is skipped, the others apply
+        self.write('1M', ('a', 'fetch_max_size: 10X'), ('b', 'fetch_min_size: 1k'),
+                   ('c', 'fetch_rate: 1Q'))
+        config = load(self.cfgfile)
+        self.assertEqual(list(config.section_dict), ['b'])
+        self.assertEqual(config.section_dict['b'].fetch_min_size, 1024)
+        self.assertEqual(config.fetch_rate, 1 << 20)
+
+    def test_invalid_rate(self):
+        # an invalid global rate keeps the default
+        self.write('1Q', ('a', ''))
+        config = load(self.cfgfile)
+        self.assertEqual(config.fetch_rate, 0)
+        self.assertEqual(list(config.section_dict), ['a'])
+
+    def test_thin_client(self):
+        # thin clients load the ruleset on fallback only
+        self.write('0', ('a', ''))
+        with open(self.cfgfile, 'a') as f:
+            f.write('resolver_socket: %s\n' % os.path.join(self.tmpdir.name, 'sock'))
+            f.write(SECTION % dict(name = 'p', option = ''))
+        self.addCleanup(Config.section_dict.clear)
+        argv = sys.argv
+        sys.argv = ['squid-dedup', '-c', self.cfgfile]
+        try:
+            config = Config()
+        finally:
+            sys.argv = argv
+        self.assertTrue(config.thin_client())
+        self.assertEqual(list(config.section_dict), [])
+        config.load_aux_config()
+        self.assertEqual(list(config.section_dict), ['p', 'a'])
+
+
+class TestConfigReload(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cfgfile = os.path.join(self.tmpdir.name, 'squid-dedup.conf')
+        self.auxfile = os.path.join(self.tmpdir.name, 'pkg.conf')
+        self.write(r'^http://mirror\.org/(.*)', 'fetch_threads: 2')
+        self.config = load(self.cfgfile)
+        self.delay = self.config.fetch_delay
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        logsetup.logsetup(logging.WARN)
+
+    def write(self, match, *options):
+        with open(self.cfgfile, 'w') as f:
+            f.write(PRIMARY % dict(include = os.path.join(self.tmpdir.name, '*.conf'),
+                                   rate = 0))
+            for option in options:
+                f.write(option + '\n')
+        with open(self.auxfile, 'w') as f:
+            f.write(AUX % match)
+
+    def test_reload(self):
+        ruleset = self.config.ruleset
+        self.write(r'^http://other\.org/(.*)', 'fetch_threads: 3')
+        self.assertTrue(self.config.reload())
+        self.assertIsNot(self.config.ruleset, ruleset)
+        self.assertEqual(self.config.fetch_threads, 3)
+        self.assertIsNone(self.config.rewrite('http://mirror.org/a'))
+        self.assertEqual(self.config.rewrite('http://other.org/a')[1],
+                         'http://pkg.squid.internal/a')
+
+    def assertKept(self, ruleset):
+        """ the previous ruleset and settings still answer """
+        self.assertIs(self.config.ruleset, ruleset)
+        self.assertIs(self.config.section_dict, ruleset.section_dict)
+        self.assertEqual(self.config.fetch_threads, 2)
+        self.assertEqual(self.config.fetch_delay, self.delay)
+        self.assertEqual(self.config.rewrite('http://mirror.org/a')[1],
+                         'http://pkg.squid.internal/a')
+        self.assertIsNone(self.config.rewrite('http://other.org/a'))
+
+    def test_reload_failed(self):
+        ruleset = self.config.ruleset
+        # a broken regular expression, along with a changed setting
+        self.write(r'^http://other\.org/(.*', 'fetch_threads: 7')
+        self.assertFalse(self.config.reload())
+        self.assertKept(ruleset)
+
+    def test_reload_invalid_option(self):
+        ruleset = self.config.ruleset
+        # unparsable global options, along with a valid rule change
+        for option in ('fetch_threads: x', 'fetch_blocksize: 10X'):
+            self.write(r'^http://other\.org/(.*)', option, 'fetch_delay: 5')
+            self.assertFalse(self.config.reload())
+            self.assertKept(ruleset)
+        # so are unparsable section options
+        for option in ('fetch_min_requests: x', 'fetch_max_size: 10X'):
+            self.write(r'^http://other\.org/(.*)', 'fetch_threads: 2')
+            with open(self.auxfile, 'a') as f:
+                f.write(option + '\n')
+            self.assertFalse(self.config.reload())
+            self.assertKept(ruleset)
+
+    def test_strip_params(self):
+        with open(self.auxfile, 'a') as f:
+            f.write('\n[prefix]\nprefix: http://cdn.org/\nreplace: http://cdn.%(intdomain)s/\\1\n'
+                    'strip_params: token\n')
+        self.assertTrue(self.config.reload())
+        dedup = Dedup(self.config)
+        # the variants of an URL share a cache entry
+        for token in range(3):
+            url = 'http://cdn.org/a?token=%s&v=1' % token
+            (section, newurl), cached = dedup.parse(url)
+            self.assertEqual((newurl, cached), ('http://cdn.squid.internal/a?v=1', token > 0))
+            rule = dedup.parse_bytes(url.encode())
+            self.assertEqual(rule[1], b'http://cdn.squid.internal/a?v=1')
+        self.assertEqual((len(dedup._cache), len(dedup._bcache)), (1, 1))
+
+    def test_check_ruleset(self):
+        dedup = Dedup(self.config)
+        self.assertTrue(dedup.parse('http://mirror.org/a'))
+        self.write(r'^http://other\.org/(.*)', 'fetch_threads: 2')
+        self.assertTrue(self.config.reload())
+        # the dedup thread keeps its ruleset and cache until the next batch
+        self.assertIsNot(dedup._ruleset, self.config.ruleset)
+        self.assertEqual(len(dedup._cache), 1)
+        dedup.check_ruleset()
+        self.assertIs(dedup._ruleset, self.config.ruleset)
+        self.assertEqual(len(dedup._cache), 0)
+        self.assertIsNone(dedup.parse('http://mirror.org/a'))
@@ -47,6 +47,12 @@ bool_0: 0
 
 fail_int: 1.1
 fail_float: 1f6
+fail_size: 1X
+
+size_plain: 8192
+size_k: 64k
+size_m: 1.5M
+size_g: 2 G
 
 multiline:
     first
@@ -77,6 +83,20 @@ multiline:
                           cf.getint, 'global', 'fail_int')
         self.assertRaises(ValueError,
                           cf.getfloat, 'global', 'fail_float')
+        self.assertRaises(configfile.ConfigFileError,
+                          cf.getsize, 'global', 'fail_size')
+
+        # test size values
+        rval = cf.getsize('global', 'size_plain')
+        self.assertEqual(rval, 8192)
+        rval = cf.getsize('global', 'size_k')
+        self.assertEqual(rval, 64 * 1024)
+        rval = cf.getsize('global', 'size_m')
+        self.assertEqual(rval, 1536 * 1024)
+        rval = cf.getsize('global', 'size_g')
+        self.assertEqual(rval, 2 * 1024 ** 3)
+        rval = cf.getsize('global', 'undefined', 0)
+        self.assertEqual(rval, 0)
 
         # test bool values
         rval = cf.getbool('global', 'bool_true')
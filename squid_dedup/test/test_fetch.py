@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import time
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import logsetup
+from fetch import Fetch, offpeak_hours, offpeak_wait
+from fixtures import config
+
+
+def at(hour):
+    """ local time of today at hour """
+    t = time.localtime()
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hour, 0, 0, 0, 0, -1))
+
+
+class TestOffpeak(TestCase):
+
+    def tearDown(self):
+        Fetch.configure(config())
+
+    def test_hours(self):
+        self.assertEqual(offpeak_hours('22-6'), (22, 6))
+        self.assertEqual(offpeak_hours('0-24'), (0, 24))
+        for value in ('3-3', '0-0', '24-6', '1-25', '6', 'a-b'):
+            with self.assertRaises(ValueError):
+                offpeak_hours(value)
+
+    def test_wait(self):
+        self.assertEqual(offpeak_wait((1, 5), at(3)), 0)
+        self.assertEqual(offpeak_wait((1, 5), at(5)), 20 * 3600)
+        # across midnight
+        self.assertEqual(offpeak_wait((22, 6), at(23)), 0)
+        self.assertEqual(offpeak_wait((22, 6), at(2)), 0)
+        self.assertEqual(offpeak_wait((22, 6), at(6)), 16 * 3600)
+        # all day
+        for hour in (0, 12, 23):
+            self.assertEqual(offpeak_wait((0, 24), at(hour)), 0)
+
+    def test_configure(self):
+        # an empty range disables off-peak fetches, instead of postponing forever
+        Fetch.configure(config(fetch_offpeak_hours = '3-3'))
+        self.assertIsNone(Fetch._offpeak)
+        Fetch.configure(config(fetch_offpeak_hours = '22-6'))
+        self.assertEqual(Fetch._offpeak, (22, 6))
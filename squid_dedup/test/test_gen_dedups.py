@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import importlib
+import tempfile
+
+from unittest import TestCase, skipIf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from utils import gen_dedups
+
+OPENSUSE = b'''<html><body>
+<table><tr><td><a href="http://ignored.org/">HTTP</a></td></tr></table>
+<table summary="mirrors">
+<tr><td><img src="de.png" alt="de"/> Germany</td></tr>
+<tr><td>ftp.a.de</td><td><a href="http://ftp.a.de/opensuse">HTTP</a></td>
+    <td><a href="ftp://ftp.a.de/opensuse/">FTP</a></td></tr>
+<tr><td><img src="fr.png" alt="fr"/> France</td></tr>
+<tr><td>b.fr</td><td><a href="http://b.fr/opensuse/">HTTP</a></td></tr>
+</table></body></html>
+'''
+
+PACKMAN = b'''<html><body>
+<table class="mirrortable">
+<tr><th>Germany</th></tr>
+<tr><td><a href="http://a.de/packman/">http://a.de/packman/</a></td>
+    <td><a href="rsync://a.de/packman/">rsync://a.de/packman/</a></td></tr>
+</table>
+<table class="mirrortable">
+<tr><td><a href="http://b.org/packman/">http://b.org/packman/</a></td></tr>
+</table>
+<p><a href="http://c.org/packman/">http://c.org/packman/</a></p>
+</body></html>
+'''
+
+LINKS = b'''<html><body>
+<h3>Austria</h3>
+<a href="http://a.at/debian/">a.at</a> <a href="http://a.at/ubuntu/">a.at</a>
+<h3>Belgium</h3>
+<a href="http://b.be/pub/debian">b.be</a> <a href="https://c.be/debian/">c.be</a>
+</body></html>
+'''
+
+TEXT = b'''# mirrors
+http://a.org/fedora/linux/development/rawhide/Everything/x86_64/os/
+http://b.org/pub/development/rawhide/Everything/x86_64/os  # a comment
+http://c.org/elsewhere/
+http://a.org/fedora/linux/development/rawhide/Everything/x86_64/os/
+http://d.org/development/rawhide/Everything/x86_64/os/'''
+
+
+def source(name = 'test', **options):
+    options.setdefault('url', 'http://mirrors.org/list')
+    options.setdefault('replace', 'http://test.%(intdomain)s/\\1')
+    return gen_dedups.Source(name, **options)
+
+
+def extract(src, page, chunk = 7):
+    parser = gen_dedups.EXTRACTORS[src.extractor](src)
+    for i in range(0, len(page), chunk):
+        parser.feed(page[i:i + chunk])
+    return parser.close()
+
+
+class TestExtractors(TestCase):
+
+    @skipIf(gen_dedups.etree is None, 'lxml is not available')
+    def test_opensuse(self):
+        self.assertEqual(extract(source(extractor = 'opensuse'), OPENSUSE),
+                         [('http://ftp.a.de/opensuse/', 'Germany (de)'),
+                          ('http://b.fr/opensuse/', 'France (fr)')])
+
+    @skipIf(gen_dedups.etree is None, 'lxml is not available')
+    def test_packman(self):
+        self.assertEqual(extract(source(extractor = 'packman'), PACKMAN),
+                         [('http://a.de/packman/', 'Germany'),
+                          ('http://b.org/packman/', None)])
+
+    @skipIf(gen_dedups.etree is None, 'lxml is not available')
+    def test_links(self):
+        src = source(extractor = 'links', href = r'^http://[^/]+/(.+/)?debian/?$',
+                     country = 'h3')
+        self.assertEqual(extract(src, LINKS), [('http://a.at/debian/', 'Austria'),
+                                               ('http://b.be/pub/debian/', 'Belgium')])
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            gen_dedups.Extractor(source(extractor = 'text'))
+
+    def test_text(self):
+        src = source(extractor = 'text', strip = 'development/rawhide/Everything/x86_64/os/')
+        self.assertEqual(extract(src, TEXT), [('http://a.org/fedora/linux/', None),
+                                              ('http://b.org/pub/', None),
+                                              ('http://d.org/', None)])
+        # without strip path, all URLs are taken
+        self.assertEqual(len(extract(source(extractor = 'text'), TEXT)), 4)
+
+    def test_text_strip(self):
+        # the strip path matches with and without trailing slashes
+        page = b'http://a.org/x/os\nhttp://b.org/x/os/\nhttp://c.org/y/os/\n'
+        for strip in ('x/os', 'x/os/'):
+            self.assertEqual(extract(source(extractor = 'text', strip = strip), page),
+                             [('http://a.org/', None), ('http://b.org/', None)])
+
+
+class TestGenerate(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dedup = os.path.join(self.tmpdir.name, 'test.conf')
+        self.urls = [('http://a.org/', 'A'), ('http://b.org/', 'B')]
+        self.fetch = gen_dedups.fetch
+
+    def tearDown(self):
+        gen_dedups.fetch = self.fetch
+        self.tmpdir.cleanup()
+
+    def source(self, **options):
+        return source(extractor = 'text', dedup = self.dedup,
+                      page = os.path.join(self.tmpdir.name, 'test-mirrors'), **options)
+
+    def read(self):
+        with open(self.dedup) as f:
+            return f.read()
+
+    def test_rules(self):
+        data = '#\n# generated\n#\n[test]\nmatch:\n    # A\n'
+        self.assertEqual(gen_dedups.rules(data), ['[test]', 'match:', '    # A', ''])
+
+    def test_unchanged(self):
+        src = self.source()
+        self.assertEqual(gen_dedups.generate(src, self.urls, 0, False), gen_dedups.NO_ERR)
+        data = self.read()
+        self.assertIn('    # A\n    http://a\\.org/(.*)\n', data)
+        # a new timestamp alone leaves the dedup file alone
+        gen_dedups.generate(src, self.urls, 86400, False)
+        self.assertEqual(self.read(), data)
+        # unless forced
+        gen_dedups.generate(src, self.urls, 86400, True)
+        self.assertNotEqual(self.read(), data)
+        # changed rules replace it
+        src.prefix = True
+        gen_dedups.generate(src, self.urls, 86400, False)
+        self.assertIn('prefix:\n    # A\n    http://a.org/\n', self.read())
+
+    def test_atomic(self):
+        src = self.source()
+        gen_dedups.generate(src, self.urls, 0, False)
+        data = self.read()
+        # a failed write leaves the previous file, and no temporary file behind
+        os.mkdir(self.dedup + '.part')
+        src.prefix = True
+        self.assertEqual(gen_dedups.generate(src, self.urls, 0, False), gen_dedups.WRITE_ERR)
+        self.assertEqual(self.read(), data)
+        os.rmdir(self.dedup + '.part')
+        self.assertEqual(gen_dedups.generate(src, self.urls, 0, False), gen_dedups.NO_ERR)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['test.conf'])
+
+    def test_harvest_unchanged(self):
+        # the saved page of an unchanged mirror list is extracted again
+        src = self.source()
+        with open(src.page, 'wb') as f:
+            f.write(b'http://a.org/\nhttp://b.org/\n')
+        gen_dedups.generate(src, self.urls, 0, False)
+        gen_dedups.fetch = lambda source, parser, force: (gen_dedups.NO_ERR, None)
+        ret, urls, ts = gen_dedups.harvest(src, False)
+        self.assertEqual((ret, urls), (gen_dedups.NO_ERR, [('http://a.org/', None),
+                                                          ('http://b.org/', None)]))
+        self.assertEqual(ts, os.stat(src.page).st_mtime)
+        # a modified source option applies
+        src.prefix = True
+        gen_dedups.generate(src, urls, ts, False)
+        self.assertIn('prefix:\n    http://a.org/\n', self.read())
+
+
+class TestWrappers(TestCase):
+
+    def test_import(self):
+        # the wrappers are importable from the package (see console_scripts)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        try:
+            for name in ('gen_openSUSE_dedups', 'gen_packman_dedups'):
+                module = importlib.import_module('squid_dedup.utils.' + name)
+                self.assertEqual(module.OPTION_ERR, gen_dedups.OPTION_ERR)
+        finally:
+            del sys.path[0]
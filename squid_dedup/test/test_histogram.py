@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import histogram
+
+class TestHistogram(TestCase):
+
+    def test_buckets(self):
+        h = histogram.Histogram()
+        # small values are exact
+        for value in range(32):
+            self.assertEqual(h.bounds(h.index(value)), (value, value))
+        # buckets are contiguous, and the relative error is bounded
+        last = h.index(31)
+        for value in range(32, 5000):
+            index = h.index(value)
+            self.assertIn(index, (last, last + 1))
+            last = index
+        for value in (32, 4999, 10 ** 6, 2 ** 31 + 12345):
+            low, high = h.bounds(h.index(value))
+            self.assertLessEqual(low, value)
+            self.assertLessEqual(value, high)
+            self.assertLessEqual(high - low + 1, low / 16)
+
+    def test_update(self):
+        h = histogram.Histogram()
+        for value in range(1, 101):
+            h.update(value)
+        h.update(2 ** 40)
+        s = h.summary()
+        self.assertEqual((s['count'], s['max']), (101, 2 ** 40))
+        self.assertEqual(s['p50'], 51)
+        self.assertTrue(90 <= s['p90'] <= 95)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertEqual(histogram.Histogram().summary()['p99'], 0)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import time
+import queue
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import journal
+
+class TestJournalQueue(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.tmpdir.name, 'fetch')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def items(self, n):
+        return [('new%d' % i, 'url%d' % i, 'section') for i in range(n)]
+
+    def test_memory(self):
+        jq = journal.JournalQueue()
+        for item in self.items(3):
+            jq.put(item, block = False)
+        self.assertEqual(jq.qsize(), 3)
+        item = jq.get()
+        self.assertEqual(item, ('new0', 'url0', 'section'))
+        self.assertEqual(jq.pending()[0], item)
+        jq.done(item)
+        self.assertEqual(len(jq.pending()), 2)
+        jq.get(), jq.get()
+        self.assertRaises(queue.Empty, jq.get, timeout = 0)
+
+    def test_resume(self):
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual(jq.filename, self.prefix + '.0')
+        for item in self.items(5):
+            jq.put(item)
+        jq.done(jq.get())
+        # in flight, but unfinished
+        jq.get()
+        jq.done(jq.get())
+        jq.close()
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual([item[0] for item in jq.pending()],
+                         ['new1', 'new3', 'new4'])
+        jq.close()
+
+    def test_slots(self):
+        jq0 = journal.JournalQueue(self.prefix)
+        jq1 = journal.JournalQueue(self.prefix)
+        self.assertEqual(jq1.filename, self.prefix + '.1')
+        jq0.put(('a', 'b', 'c'))
+        jq0.close()
+        jq1.close()
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual(jq.pending(), [('a', 'b', 'c')])
+        jq.close()
+
+    def test_truncated(self):
+        jq = journal.JournalQueue(self.prefix)
+        jq.put(('a', 'b', 'c'))
+        jq.close()
+        with open(self.prefix + '.0', 'a') as fd:
+            fd.write('["+", ["x", ')
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual(jq.pending(), [('a', 'b', 'c')])
+        jq.close()
+
+    def test_compact(self):
+        jq = journal.JournalQueue(self.prefix)
+        n = journal.COMPACT_MIN
+        for item in self.items(n):
+            jq.put(item)
+        for i in range(n - 10):
+            jq.done(jq.get())
+        self.assertLess(jq._records, n)
+        with open(jq.filename) as fd:
+            self.assertLess(len(fd.readlines()), n)
+        jq.close()
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual(len(jq.pending()), 10)
+        self.assertEqual(jq.pending()[0][0], 'new%d' % (n - 10))
+        jq.close()
+
+    def test_wait(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass()
+            self.assertEqual(jq.stats()['wait'], 0)
+            jq.put(('a', 'url', 'section', 1))
+            time.sleep(0.05)
+            jq.put(('b', 'url', 'section', 2))
+            # the oldest item counts, regardless of the order of get()
+            self.assertGreaterEqual(jq.stats()['wait'], 0.05)
+            jq.get(), jq.get()
+            self.assertEqual(jq.stats()['wait'], 0)
+
+
+class TestJournalPriorityQueue(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.tmpdir.name, 'fetch')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_order(self):
+        jq = journal.JournalPriorityQueue()
+        for key, prio in (('a', 1), ('b', 3), ('c', 2), ('d', 3)):
+            jq.put((key, 'url', 'section', prio))
+        self.assertEqual([jq.get()[0] for i in range(4)], ['b', 'd', 'c', 'a'])
+
+    def test_coalesce(self):
+        jq = journal.JournalPriorityQueue()
+        jq.put(('a', 'url1', 'section', 1))
+        jq.put(('b', 'url1', 'section', 2))
+        jq.put(('a', 'url2', 'section', 5))
+        # lower priority is ignored
+        jq.put(('b', 'url2', 'section', 0))
+        self.assertEqual(jq.qsize(), 2)
+        self.assertEqual(jq.get(), ('a', 'url1', 'section', 5))
+        self.assertEqual(jq.get(), ('b', 'url1', 'section', 2))
+        self.assertRaises(queue.Empty, jq.get, timeout = 0)
+
+    def test_reprioritize(self):
+        jq = journal.JournalPriorityQueue()
+        jq.put(('a', 'url', 'section', 1))
+        jq.put(('b', 'url', 'section', 2))
+        self.assertTrue(jq.reprioritize('a', 3))
+        self.assertFalse(jq.reprioritize('c', 3))
+        self.assertEqual(jq.get()[0], 'a')
+        self.assertFalse(jq.reprioritize('a', 4))
+        self.assertFalse(journal.JournalQueue().reprioritize('a', 1))
+
+    def test_reprioritize_bounded(self):
+        jq = journal.JournalPriorityQueue()
+        for n in range(100):
+            jq.put(('x%d' % n, 'url', 'section', n))
+        for n in range(20000):
+            jq.reprioritize('x%d' % (n % 100), 100 + n)
+        self.assertLessEqual(len(jq.heap), journal.HEAP_RATIO * 100 + journal.HEAP_MIN)
+        self.assertLessEqual(len(jq.lowest), journal.HEAP_RATIO * 100 + journal.HEAP_MIN)
+        # the order follows the raised priorities
+        self.assertEqual([jq.get()[0] for i in range(3)], ['x99', 'x98', 'x97'])
+        # lower priorities don't add heap entries
+        size = len(jq.heap)
+        self.assertTrue(jq.reprioritize('x0', 0))
+        self.assertEqual(len(jq.heap), size)
+
+    def test_resume(self):
+        jq = journal.JournalPriorityQueue(self.prefix)
+        for key, prio in (('a', 1), ('b', 3), ('c', 2)):
+            jq.put((key, 'url', 'section', prio))
+        jq.done(jq.get())
+        jq.close()
+        jq = journal.JournalPriorityQueue(self.prefix)
+        self.assertEqual([item[0] for item in jq.pending()], ['c', 'a'])
+        jq.close()
+
+
+class TestJournalRequeue(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.tmpdir.name, 'fetch')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_requeue(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass()
+            jq.put(('a', 'url', 'section', 1))
+            item = jq.get()
+            jq.requeue(item)
+            self.assertEqual(jq.get(), item)
+
+    def test_deferred(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass()
+            jq.put(('a', 'url', 'section', 1))
+            item = jq.get()
+            jq.requeue(item, 0.1)
+            self.assertEqual(jq.qsize(), 0)
+            self.assertEqual(jq.pending(), [item])
+            self.assertRaises(queue.Empty, jq.get, timeout = 0)
+            self.assertEqual(jq.get(timeout = 1), item)
+
+    def test_resume(self):
+        jq = journal.JournalQueue(self.prefix)
+        jq.put(('a', 'url', 'section', 1))
+        jq.put(('b', 'url', 'section', 1))
+        jq.requeue(jq.get(), 60)
+        jq.requeue(jq.get())
+        jq.close()
+        # deferred items are resumed without delay, and without duplicates
+        jq = journal.JournalQueue(self.prefix)
+        self.assertEqual(jq.pending(), [('a', 'url', 'section', 1),
+                                        ('b', 'url', 'section', 1)])
+        jq.close()
+
+
+class TestJournalBounded(TestCase):
+
+    def test_coalesce(self):
+        jq = journal.JournalQueue()
+        jq.put(('a', 'url1', 'section', 1))
+        jq.put(('b', 'url1', 'section', 1))
+        jq.put(('a', 'url2', 'section', 2))
+        self.assertEqual(jq.qsize(), 2)
+        item = jq.get()
+        self.assertEqual(item, ('a', 'url1', 'section', 1))
+        # in flight and deferred keys are coalesced as well
+        jq.put(('a', 'url3', 'section', 1))
+        jq.requeue(item, 60)
+        jq.put(('a', 'url4', 'section', 1))
+        self.assertEqual(jq.qsize(), 1)
+        self.assertEqual(jq.stats()['coalesced'], 3)
+
+    def test_reject(self):
+        jq = journal.JournalQueue(maxsize = 2)
+        jq.put(('a', 'url', 'section', 1))
+        jq.put(('b', 'url', 'section', 1))
+        self.assertRaises(queue.Full, jq.put, ('c', 'url', 'section', 1))
+        # duplicates are coalesced, even if the queue is full
+        jq.put(('a', 'url', 'section', 1))
+        stats = jq.stats()
+        self.assertEqual((stats['depth'], stats['rejected'], stats['coalesced']), (2, 1, 1))
+
+    def test_drop_oldest(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass(maxsize = 2, overflow = journal.DROP_OLDEST)
+            for key in 'abc':
+                jq.put((key, 'url', 'section', 1))
+            self.assertEqual([item[0] for item in jq.pending()], ['b', 'c'])
+            self.assertEqual(jq.stats()['dropped'], 1)
+
+    def test_drop_lowest(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass(maxsize = 2, overflow = journal.DROP_LOWEST)
+            for key, prio in (('a', 2), ('b', 1), ('c', 3), ('d', 0)):
+                jq.put((key, 'url', 'section', prio))
+            # b is dropped for c, d is dropped right away
+            self.assertEqual(sorted(item[0] for item in jq.pending()), ['a', 'c'])
+            self.assertEqual(jq.stats()['dropped'], 2)
+
+    def test_ondrop(self):
+        for overflow in (journal.DROP_OLDEST, journal.DROP_LOWEST):
+            jq = journal.JournalQueue(maxsize = 1, overflow = overflow)
+            dropped = []
+            jq.ondrop = dropped.append
+            jq.put(('a', 'url', 'section', 1))
+            jq.put(('b', 'url', 'section', 2))
+            # the new item has the lowest priority
+            jq.put(('c', 'url', 'section', 0))
+            self.assertEqual(dropped, ['a', 'b'] if overflow == journal.DROP_OLDEST
+                             else ['a', 'c'])
+
+    def test_drop_lowest_stale(self):
+        for jqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            jq = jqclass(maxsize = 3, overflow = journal.DROP_LOWEST)
+            # handed out and raised items leave stale candidates behind
+            for n in range(5000):
+                jq.put(('x%d' % n, 'url', 'section', 0))
+                jq.get()
+            self.assertLess(len(jq.lowest), 2 * journal.HEAP_MIN)
+            jq.put(('a', 'url', 'section', 1))
+            jq.put(('b', 'url', 'section', 1))
+            jq.put(('c', 'url', 'section', 2))
+            # FIFO queues ignore priority changes
+            raised = jq.reprioritize('a', 3)
+            jq.put(('d', 'url', 'section', 2))
+            # the oldest of the lowest priority items is dropped
+            self.assertEqual(sorted(item[0] for item in jq.pending() if item[0] in 'abcd'),
+                             ['a', 'c', 'd'] if raised else ['b', 'c', 'd'])
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prefix = os.path.join(tmpdir, 'fetch')
+            jq = journal.JournalQueue(prefix, maxsize = 1, overflow = journal.DROP_OLDEST)
+            jq.put(('a', 'url', 'section', 1))
+            jq.put(('b', 'url', 'section', 1))
+            jq.close()
+            # dropped items are journaled as done
+            jq = journal.JournalQueue(prefix)
+            self.assertEqual(jq.pending(), [('b', 'url', 'section', 1)])
+            jq.close()
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, journal.JournalQueue, overflow = 'drop-all')
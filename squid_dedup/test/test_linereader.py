@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import linereader
+
+class TestLineReader(TestCase):
+
+    def setUp(self):
+        self.rfd, self.wfd = os.pipe()
+        self.reader = linereader.LineReader(self.rfd, blocksize = 8)
+
+    def tearDown(self):
+        os.close(self.rfd)
+        if self.wfd is not None:
+            os.close(self.wfd)
+
+    def read(self):
+        lines = []
+        while self.reader.wait(0):
+            if not self.reader.fill():
+                break
+            lines.extend(self.reader.lines())
+        return lines
+
+    def test_lines(self):
+        os.write(self.wfd, b'0 http://a/\n1 http://b/ x\n2 http')
+        self.assertEqual(self.read(), [b'0 http://a/', b'1 http://b/ x'])
+        # select() sees the rest of the line
+        os.write(self.wfd, b'://c/\n\n')
+        self.assertEqual(self.read(), [b'2 http://c/', b''])
+        self.assertEqual(self.read(), [])
+
+    def test_eof(self):
+        os.write(self.wfd, b'a\nb')
+        os.close(self.wfd)
+        self.wfd = None
+        self.assertEqual(self.read(), [b'a'])
+        self.assertTrue(self.reader.eof)
+        self.assertEqual(self.reader.lines(), [b'b'])
+        self.assertEqual(self.reader.lines(), [])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import collections
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import memory
+
+class TestMemory(TestCase):
+
+    def test_size(self):
+        self.assertEqual(memory.size(1), sys.getsizeof(1))
+        d = {'key%s' % i: 'x' * 100 + str(i) for i in range(100)}
+        exact = sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items())
+        self.assertEqual(memory.size(d), exact)
+        # large containers are extrapolated
+        self.assertAlmostEqual(memory.size(d, sample = 10), exact, delta = exact * 0.05)
+        # shared objects are counted once
+        shared = 'y' * 1000
+        self.assertLess(memory.size([shared] * 10), 10 * sys.getsizeof(shared))
+        od = collections.OrderedDict(a = [1, 2, 3])
+        self.assertGreater(memory.size(od), sys.getsizeof(od) + sys.getsizeof([1, 2, 3]))
+
+    def test_rss(self):
+        self.assertGreater(memory.rss(), 0)
+
+    def test_tracer(self):
+        tracer = memory.Tracer()
+        try:
+            data = [bytearray(1000) for i in range(1000)]
+            stats = tracer.diff()
+            self.assertTrue(stats)
+            self.assertGreaterEqual(stats[0].size_diff, 1000 * 1000)
+            self.assertIn('test_memory.py', str(stats[0].traceback))
+        finally:
+            tracer.stop()
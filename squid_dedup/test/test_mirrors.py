@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import mirrors
+
+class TestMirrorStats(TestCase):
+
+    def test_ewma(self):
+        ms = mirrors.MirrorStats(alpha = 0.5)
+        ms.update('a', 1.0, 1000.0)
+        ms.update('a', 0.0, None)
+        ms.update('a', None, 2000.0)
+        self.assertEqual(ms.get('a'), (0.5, 1500.0))
+        self.assertIsNone(ms.get('b'))
+
+    def test_best(self):
+        ms = mirrors.MirrorStats()
+        ms.update('slow', 0.1, 100000.0)
+        ms.update('fast', 0.1, 10000000.0)
+        self.assertLess(ms.score('fast'), ms.score('slow'))
+        candidates = [('slow', 's'), ('fast', 'f')]
+        self.assertEqual(ms.best(candidates, 's'), 'f')
+        # unknown hosts are tried first
+        self.assertEqual(ms.best(candidates + [('new', 'n')], 's'), 'n')
+        # ties go to the preferred candidate
+        self.assertEqual(ms.best([('x', 'x1'), ('y', 'y1')], 'y1'), 'y1')
+
+    def test_size(self):
+        ms = mirrors.MirrorStats(size = 2)
+        for host in ('a', 'b', 'a', 'c'):
+            ms.update(host, 0.1, 1000.0)
+        self.assertEqual(len(ms), 2)
+        self.assertIsNone(ms.get('b'))
+
+    def test_persist(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mirrors.json')
+            ms = mirrors.MirrorStats(path)
+            ms.update('a', 0.2, 5000.0)
+            ms.save()
+            self.assertEqual(os.listdir(tmpdir), ['mirrors.json'])
+            ms = mirrors.MirrorStats(path)
+            self.assertEqual(ms.get('a'), (0.2, 5000.0))
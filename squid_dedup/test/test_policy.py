@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import journal
+from lib import logsetup
+from lib import record
+from policy import FetchPolicy
+from fetch import Fetch, FETCH_ERROR
+from fixtures import config
+
+SECTION = record.recordfactory('Section', name = 'pkg', fetch_min_requests = 1,
+                               fetch_min_mirrors = 0)
+
+
+class TestFetchPolicy(TestCase):
+
+    def setUp(self):
+        FetchPolicy._seen.clear()
+        Fetch._done.clear()
+
+    def keys(self, fq):
+        return [item[0] for item in fq.pending()]
+
+    def test_dropped(self):
+        for fqclass in (journal.JournalQueue, journal.JournalPriorityQueue):
+            FetchPolicy._seen.clear()
+            fq = fqclass(maxsize = 1, overflow = journal.DROP_OLDEST)
+            policy = FetchPolicy(config(fetch_queue = fq))
+            policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+            policy.request(SECTION, 'http://pkg/b', 'http://mirror/b')
+            self.assertEqual(self.keys(fq), ['http://pkg/b'])
+            # the victim is queued again with its next request
+            policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+            self.assertEqual(self.keys(fq), ['http://pkg/a'])
+
+    def test_dropped_new(self):
+        fq = journal.JournalPriorityQueue(maxsize = 1, overflow = journal.DROP_LOWEST)
+        policy = FetchPolicy(config(fetch_queue = fq))
+        for i in range(3):
+            policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        # b has the lower priority, and is dropped right away
+        policy.request(SECTION, 'http://pkg/b', 'http://mirror/b')
+        self.assertEqual(self.keys(fq), ['http://pkg/a'])
+        self.assertFalse(FetchPolicy._seen['http://pkg/b'].queued)
+
+    def test_given_up(self):
+        fq = journal.JournalQueue()
+        cf = config(fetch_queue = fq)
+        policy = FetchPolicy(cf)
+        fetch = Fetch(cf, fq)
+        policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        item = fq.get()
+        self.assertFalse(fetch.seen('test', item[0], item[1]))
+        self.assertFalse(fetch.finish('test', item, 'mirror', FETCH_ERROR))
+        self.assertEqual(fq.pending(), [])
+        policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        self.assertEqual(self.keys(fq), ['http://pkg/a'])
+
+    def test_coalesced(self):
+        # the queued item keeps the URL of its first request, the policy
+        # tracks the mirrors of the object
+        fq = journal.JournalQueue()
+        policy = FetchPolicy(config(fetch_queue = fq))
+        policy.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        policy.request(SECTION, 'http://pkg/a', 'http://mirror/b')
+        fq.put(('http://pkg/a', 'http://mirror/c', 'pkg', 0))
+        self.assertEqual([item[:2] for item in fq.pending()],
+                         [('http://pkg/a', 'http://mirror/a')])
+        self.assertEqual(fq.stats()['coalesced'], 1)
+        self.assertEqual(FetchPolicy.mirrors('http://pkg/a'),
+                         {'http://mirror/a', 'http://mirror/b'})
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import time
+import queue
+import socket
+import threading
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import journal
+from lib import logsetup
+from fetch import Fetch
+from afetch import AsyncFetch
+from pool import FetchPool
+from fixtures import config, wait_for
+
+
+class Queue:
+    """ a fetch queue with a given backlog, that hands out scripted items """
+    def __init__(self):
+        self.items = []
+        self.depth = 0
+        self.wait = 0.0
+        self.done_items = []
+
+    def get(self, block = True, timeout = None):
+        if self.items:
+            return self.items.pop(0)
+        time.sleep(0.01)
+        raise queue.Empty
+
+    def done(self, item):
+        self.done_items.append(item)
+
+    def stats(self):
+        return dict(depth = self.depth, wait = self.wait)
+
+
+class TestFetchPool(TestCase):
+
+    def setUp(self):
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.exit()
+
+    def pool(self, cf, fq):
+        pool = FetchPool(cf, fq, 'test')
+        self.pools.append(pool)
+        return pool
+
+    def alive(self, pool):
+        return [t for fetch, t in pool._workers if t.is_alive()]
+
+    def test_restart(self):
+        fq = Queue()
+        pool = self.pool(config(fetch_threads = 2), fq)
+        # a malformed item crashes its fetch thread
+        fq.items.append(('bad', 'url'))
+        self.assertTrue(wait_for(lambda: len(self.alive(pool)) == 1))
+        pool.check()
+        self.assertEqual(pool.restarted, 1)
+        self.assertEqual(len(self.alive(pool)), 2)
+        # the item, it crashed on, is dropped
+        self.assertEqual(fq.done_items, [('bad', 'url')])
+
+    def test_grow(self):
+        fq = Queue()
+        pool = self.pool(config(fetch_threads_max = 3, fetch_scale_idle = 60), fq)
+        fq.depth, fq.wait = 5, 1.0
+        for i in range(4):
+            pool.check()
+        self.assertEqual((len(self.alive(pool)), pool.grown), (3, 2))
+        # no more threads than queued items
+        fq.depth = 3
+        pool.check()
+        self.assertEqual(len(pool._workers), 3)
+
+    def test_shrink(self):
+        fq = Queue()
+        pool = self.pool(config(fetch_threads_max = 3), fq)
+        fq.depth, fq.wait = 5, 1.0
+        pool.check(), pool.check()
+        fq.depth = 0
+        pool.check()
+        self.assertEqual((len(pool._workers), pool.shrunk), (2, 1))
+        pool.check()
+        self.assertEqual(len(pool._workers), 1)
+        # retired threads exit
+        self.assertTrue(wait_for(lambda: not any(t.is_alive() for f, t in pool._retired)))
+        pool.check()
+        self.assertEqual(pool.stats()['retiring'], 0)
+
+    def test_configure(self):
+        fq = Queue()
+        pool = self.pool(config(fetch_threads = 1), fq)
+        pool.configure(config(fetch_threads = 3))
+        self.assertEqual(len(self.alive(pool)), 3)
+        pool.configure(config(fetch_threads = 2))
+        self.assertEqual(len(pool._workers), 2)
+        pool.configure(config(fetch_engine = 'asyncio'))
+        self.assertEqual([type(fetch) for fetch, t in pool._workers], [AsyncFetch])
+        self.assertEqual(len(pool._retired), 3)
+        # the asyncio engine is kept, unless its connections change
+        fetch = pool._workers[0][0]
+        pool.configure(config(fetch_engine = 'asyncio'))
+        self.assertIs(pool._workers[0][0], fetch)
+        pool.configure(config(fetch_engine = 'asyncio', fetch_connections = 8))
+        self.assertIsNot(pool._workers[0][0], fetch)
+
+
+class TestFetchPoolRequeue(TestCase):
+
+    def setUp(self):
+        Fetch._done.clear()
+        self.stop = threading.Event()
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.url = 'http://127.0.0.1:%s/a' % self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.pool.exit()
+        self.stop.set()
+        self.server.close()
+
+    def trickle(self):
+        """ respond to a single request with a body, that never ends """
+        conn, addr = self.server.accept()
+        with conn:
+            conn.recv(4096)
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 1000000\r\n\r\n')
+            while not self.stop.wait(0.02):
+                try:
+                    conn.sendall(b'x' * 16)
+                except OSError:
+                    break
+
+    def test_cancelled(self):
+        # the server accepts the connection, but never responds
+        fq = journal.JournalQueue()
+        self.pool = FetchPool(config(fetch_engine = 'asyncio'), fq, 'test')
+        item = ('http://pkg/a', self.url, 'pkg', 1)
+        fq.put(item)
+        old = self.pool._workers[0]
+        self.assertTrue(wait_for(lambda: old[0].unfinished() == [item]))
+        self.pool.configure(config(fetch_engine = 'asyncio', fetch_connections = 8))
+        self.assertTrue(wait_for(lambda: not old[1].is_alive()))
+        # the item is back, and fetched by the new engine
+        new = self.pool._workers[0][0]
+        self.assertTrue(wait_for(lambda: new.unfinished() == [item]))
+        self.assertEqual(list(fq.inflight), ['http://pkg/a'])
+
+    def test_aborted(self):
+        for engine in ('threads', 'asyncio'):
+            Fetch._done.clear()
+            server = threading.Thread(target = self.trickle, daemon = True)
+            server.start()
+            fq = journal.JournalQueue()
+            self.pool = FetchPool(config(fetch_engine = engine, fetch_blocksize = 16), fq,
+                                  'test')
+            item = ('http://pkg/a', self.url, 'pkg', 1)
+            fq.put(item)
+            self.assertTrue(wait_for(lambda: fq.inflight))
+            # let the transfer begin
+            time.sleep(0.2)
+            old = self.pool._workers[0]
+            # an interrupted transfer is put back into the queue
+            self.pool.retire()
+            self.assertTrue(wait_for(lambda: not old[1].is_alive()))
+            self.assertEqual((fq.pending(), list(fq.inflight)), ([item], []))
+            self.pool.exit()
+            self.stop.set()
+            server.join()
+            self.stop.clear()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import pstats
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import profile
+
+
+def work(a, b = 1):
+    return a + b
+
+
+class TestProfile(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.profiledir = os.path.join(self.tmpdir.name, 'profile')
+
+    def tearDown(self):
+        profile.Window.stop()
+        self.tmpdir.cleanup()
+
+    def pstats(self):
+        if not os.path.isdir(self.profiledir):
+            return []
+        return sorted(os.listdir(self.profiledir))
+
+    def test_window(self):
+        self.assertIsNone(profile.Window.stamp)
+        profile.Window.toggle(self.profiledir)
+        stamp = profile.Window.stamp
+        self.assertIsNotNone(stamp)
+        self.assertTrue(os.path.isdir(self.profiledir))
+        # starting an open window keeps it
+        profile.Window.start(self.profiledir)
+        self.assertEqual(profile.Window.stamp, stamp)
+        profile.Window.toggle(self.profiledir)
+        self.assertIsNone(profile.Window.stamp)
+
+    def test_profiler(self):
+        profiler = profile.Profiler('test')
+        profiler.check()
+        self.assertIsNone(profiler._profile)
+        profile.Window.start(self.profiledir)
+        profiler.check()
+        work(1)
+        profile.Window.stop()
+        # closing the window dumps the stats
+        profiler.check()
+        self.assertIsNone(profiler._profile)
+        files = self.pstats()
+        self.assertEqual(len(files), 1)
+        stamp, pid, name, ident = files[0][:-len('.pstats')].rsplit('-', 3)
+        self.assertEqual((pid, name), (str(os.getpid()), 'test'))
+        stats = pstats.Stats(os.path.join(self.profiledir, files[0]))
+        self.assertIn('work', [func[2] for func in stats.stats])
+
+    def test_runcall(self):
+        # closed window: plain call
+        self.assertEqual(profile.runcall('work', work, 1, b = 2), 3)
+        self.assertEqual(self.pstats(), [])
+        profile.Window.start(self.profiledir)
+        self.assertEqual(profile.runcall('work', work, 2), 3)
+        files = self.pstats()
+        self.assertEqual(len(files), 1)
+        self.assertIn('-work.', files[0])
+
+    def test_decorator(self):
+        class Thread:
+            @profile.profile('thread')
+            def run(self, a):
+                self._profiler.check()
+                return work(a)
+
+        thread = Thread()
+        profile.Window.start(self.profiledir)
+        self.assertEqual(thread.run(1), 2)
+        self.assertIsInstance(thread._profiler, profile.Profiler)
+        self.assertEqual(len(self.pstats()), 1)
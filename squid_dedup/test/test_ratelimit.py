@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import time
+import threading
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import ratelimit
+
+class TestTokenBucket(TestCase):
+
+    def test_unlimited(self):
+        tb = ratelimit.TokenBucket(0)
+        self.assertEqual(tb.consume(1 << 30), 0.0)
+
+    def test_burst(self):
+        tb = ratelimit.TokenBucket(1000)
+        # a full bucket satisfies one second worth of tokens immediately
+        self.assertEqual(tb.consume(1000), 0.0)
+
+    def test_throttle(self):
+        tb = ratelimit.TokenBucket(10000, burst = 100)
+        start = time.monotonic()
+        waited = sum(tb.consume(500) for i in range(4))
+        elapsed = time.monotonic() - start
+        # 2000 tokens with a 100 token burst at 10000/s: ~0.19s
+        self.assertGreater(waited, 0.15)
+        self.assertGreater(elapsed, 0.15)
+        self.assertLess(elapsed, 1.0)
+
+    def test_reserve(self):
+        tb = ratelimit.TokenBucket(1000)
+        self.assertEqual(tb.reserve(1000), 0.0)
+        # reserving doesn't sleep, but tells how long to wait
+        start = time.monotonic()
+        wait = tb.reserve(500)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertGreater(wait, 0.4)
+        self.assertLessEqual(wait, 0.5)
+
+
+class TestHostSlots(TestCase):
+
+    def test_limit(self):
+        hs = ratelimit.HostSlots(2)
+        self.assertTrue(hs.acquire('a'))
+        self.assertTrue(hs.acquire('a'))
+        self.assertFalse(hs.acquire('a', timeout = 0.01))
+        self.assertTrue(hs.acquire('b', timeout = 0.01))
+        self.assertEqual(hs.busy('a'), 2)
+        hs.release('a')
+        self.assertTrue(hs.acquire('a', timeout = 0.01))
+        for host in ('a', 'a', 'b'):
+            hs.release(host)
+        self.assertEqual(hs.busy('a'), 0)
+
+    def test_wakeup(self):
+        hs = ratelimit.HostSlots(1)
+        hs.acquire('a')
+        t = threading.Timer(0.05, hs.release, ('a', ))
+        t.start()
+        self.assertTrue(hs.acquire('a', timeout = 2))
+        t.join()
+
+    def test_unlimited(self):
+        hs = ratelimit.HostSlots(0)
+        for i in range(100):
+            self.assertTrue(hs.acquire('a', timeout = 0))
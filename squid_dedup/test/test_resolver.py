@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import io
+import os
+import sys
+import socket
+import logging
+import tempfile
+import threading
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import linereader
+from lib import logsetup
+from lib import record
+from dedup import Dedup
+from fixtures import load, wait_for
+import resolver
+
+PRIMARY = """\
+[global]
+include: %(tmpdir)s/*.conf
+resolver_socket: %(tmpdir)s/resolver.sock
+logfile: -
+loglevel: WARNING
+sysloglevel: NONE
+
+[pkg]
+match: ^http://mirror\\.org/(.*)
+replace: http://pkg.%%(intdomain)s/\\1
+"""
+
+
+class TestResolver(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        cfgfile = os.path.join(self.tmpdir.name, 'squid-dedup.conf')
+        with open(cfgfile, 'w') as f:
+            f.write(PRIMARY % dict(tmpdir = self.tmpdir.name))
+        self.config = load(cfgfile)
+        self.resolver = resolver.Resolver(self.config)
+        self.thread = threading.Thread(target = self.resolver.run, daemon = True)
+        self.thread.start()
+        self.assertTrue(wait_for(lambda: os.path.exists(self.config.resolver_socket)))
+
+    def tearDown(self):
+        self.resolver.exit()
+        self.thread.join()
+        resolver.Resolver.close()
+        Dedup._reader = None
+        self.tmpdir.cleanup()
+        logsetup.logsetup(logging.WARN)
+
+    def relay(self, requests):
+        """ relay requests with a thin client, returns its output """
+        client = resolver.Client(self.config)
+        self.assertTrue(client.connect())
+        r, w = os.pipe()
+        os.write(w, requests)
+        os.close(w)
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        try:
+            Dedup._reader = linereader.LineReader(r)
+            self.assertTrue(client.run())
+            return sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdout = stdout
+            Dedup._reader = None
+            os.close(r)
+
+    def test_roundtrip(self):
+        replies = self.relay(b'0 http://mirror.org/a\n1 http://other.org/b\n'
+                             b'http://mirror.org/c\n')
+        self.assertEqual(replies, b'0 OK store-id=http://pkg.squid.internal/a\n'
+                                  b'1 ERR\n'
+                                  b'OK store-id=http://pkg.squid.internal/c\n')
+
+    def test_slow_client(self):
+        # a client, that doesn't read its replies, is dropped eventually,
+        # while the others are served meanwhile
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(self.config.resolver_socket)
+        self.assertTrue(wait_for(lambda: len(resolver.Resolver._clients) == 1))
+        conn = list(resolver.Resolver._clients)[0]
+        def flood():
+            try:
+                while True:
+                    slow.sendall(b'http://mirror.org/a\n' * 1000)
+            except OSError:
+                pass
+        sender = threading.Thread(target = flood, daemon = True)
+        sender.start()
+        self.assertTrue(wait_for(lambda: resolver.Resolver._clients.get(conn) and
+                                 resolver.Resolver._clients[conn][1].buffer))
+        self.assertEqual(self.relay(b'http://mirror.org/b\n'),
+                         b'OK store-id=http://pkg.squid.internal/b\n')
+        self.assertTrue(wait_for(lambda: conn not in resolver.Resolver._clients, 30))
+        sender.join()
+        slow.close()
+
+
+class TestClient(TestCase):
+
+    def test_unexpected_reply(self):
+        # replies without a pending request are dropped
+        sock, peer = socket.socketpair()
+        client = resolver.Client(record.recordfactory('Config', resolver_socket = 'test'))
+        client._sock = sock
+        def serve():
+            peer.recv(4096)
+            peer.sendall(b'OK store-id=http://pkg/a\nOK\n')
+        server = threading.Thread(target = serve, daemon = True)
+        server.start()
+        r, w = os.pipe()
+        os.write(w, b'http://mirror.org/a\n')
+        os.close(w)
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        try:
+            Dedup._reader = linereader.LineReader(r)
+            self.assertTrue(client.run())
+            output = sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdout = stdout
+            Dedup._reader = None
+            os.close(r)
+            server.join()
+            peer.close()
+        self.assertEqual(output, b'OK store-id=http://pkg/a\n')
+        self.assertEqual(len(client.pending), 0)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import tempfile
+import threading
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import sampler
+
+def waiting(event):
+    event.wait()
+
+class TestSampler(TestCase):
+
+    def setUp(self):
+        self.event = threading.Event()
+        self.thread = threading.Thread(target = waiting, args = (self.event, ))
+        self.thread.start()
+
+    def tearDown(self):
+        self.event.set()
+        self.thread.join()
+
+    def test_sample(self):
+        s = sampler.Sampler({self.thread.ident: 'worker'}, '.')
+        for i in range(3):
+            s.sample()
+        lines = s.collapse()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('worker;'))
+        self.assertIn(';waiting (test_sampler.py:', lines[0])
+        self.assertTrue(lines[0].endswith(' 3'))
+        # unregistered threads aren't sampled
+        s = sampler.Sampler({}, '.')
+        s.sample()
+        self.assertEqual(s.collapse(), [])
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s = sampler.Sampler({self.thread.ident: 'worker'}, tmpdir)
+            s.sample()
+            s.write(0)
+            files = os.listdir(tmpdir)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].endswith('-%s-samples.folded' % os.getpid()))
+            self.assertEqual(s.samples, 0)
+            # nothing sampled: nothing written
+            s.write(1)
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import tempfile
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import record
+import simulate
+import fixtures
+
+SECTION = record.recordfactory('Section', name = 'pkg', fetch = False)
+
+LOG = b'''\
+1000.0 10 10.0.0.1 TCP_MISS/200 1000 GET http://a.mirror/pkg/x - DIRECT/a text/plain
+1001.0 10 10.0.0.1 TCP_MISS/206 100 GET http://b.mirror/pkg/x - DIRECT/b text/plain
+1002.0 10 10.0.0.1 TCP_MISS/404 100 GET http://b.mirror/pkg/y - DIRECT/b text/plain
+1003.0 10 10.0.0.1 TCP_MISS/200 1000 GET http://b.mirror/pkg/x - DIRECT/b text/plain
+'''
+
+
+class Dedup:
+    """ rewrites the URLs of any mirror to http://pkg/<path> """
+    def parse_bytes(self, url):
+        return SECTION, b'http://pkg/' + url.split(b'/', 3)[3]
+
+
+class TestSimulator(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'access.log')
+        with open(self.path, 'wb') as f:
+            f.write(LOG)
+        simulate._dedup = Dedup()
+
+    def tearDown(self):
+        simulate._dedup = None
+        self.tmpdir.cleanup()
+
+    def test_partial(self):
+        config = fixtures.config(simulate_cache_size = 1 << 20,
+                                 simulate_max_object_size = 0,
+                                 section_dict = {'pkg': SECTION})
+        sim = simulate.Simulator(config, [self.path])
+        records = simulate.match_chunk((self.path, 0, len(LOG)))
+        self.assertEqual([r[-1] for r in records], [200, 206, 200])
+        for r in records:
+            sim.account(r)
+        # partial responses are reported separately, the store-id hit counts
+        self.assertEqual(dict(sim._partial), {'pkg': [1, 100]})
+        self.assertEqual(sim._sections['pkg'], [2, 2000, 0, 0, 1, 1000])
+        self.assertEqual((sim._first, sim._last), (1000.0, 1003.0))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import io
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import sink
+
+class FailingIO(io.BytesIO):
+
+    def readinto(self, b):
+        if self.tell() >= 100:
+            raise IOError('connection reset')
+        return super().readinto(memoryview(b)[:50])
+
+
+class TestDiscardSink(TestCase):
+
+    def test_drain(self):
+        ds = sink.DiscardSink(1000)
+        buffer = ds.buffer
+        self.assertEqual(ds.drain(io.BytesIO(b'x' * 12345)), 12345)
+        self.assertEqual(ds.nbytes, 12345)
+        # the buffer is reused
+        self.assertIs(ds.buffer, buffer)
+        self.assertEqual(ds.drain(io.BytesIO(b'')), 0)
+
+    def test_callback(self):
+        ds = sink.DiscardSink(1000)
+        blocks = []
+        def callback(n):
+            blocks.append(n)
+            return len(blocks) < 3
+        self.assertEqual(ds.drain(io.BytesIO(b'x' * 12345), callback), 3000)
+        self.assertEqual(blocks, [1000, 1000, 1000])
+
+    def test_exception(self):
+        ds = sink.DiscardSink(1000)
+        self.assertRaises(IOError, ds.drain, FailingIO(b'x' * 1000))
+        self.assertEqual(ds.nbytes, 100)
+        self.assertGreaterEqual(ds.throughput(), 0.0)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import random
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import sketch
+
+class TestTopK(TestCase):
+
+    def test_exact(self):
+        topk = sketch.TopK(3)
+        for key in 'aababc':
+            topk.update(key)
+        self.assertEqual(topk.top(), [('a', 3, 0), ('b', 2, 0), ('c', 1, 0)])
+        self.assertEqual(topk.top(1), [('a', 3, 0)])
+        self.assertEqual(topk.total, 6)
+
+    def test_heavy_hitters(self):
+        rnd = random.Random(42)
+        topk = sketch.TopK(10)
+        true = {}
+        # zipf like: a few hot keys among many rare ones
+        for i in range(20000):
+            key = 'url%d' % int(1 / rnd.random() ** 1.2)
+            true[key] = true.get(key, 0) + 1
+            topk.update(key)
+        self.assertLess(len(topk), 20)
+        hot = sorted(true, key = true.get, reverse = True)[:5]
+        top = topk.top()
+        self.assertEqual([key for key, count, error in top[:5]], hot)
+        for key, count, error in top:
+            # counts are overestimated by at most their error
+            self.assertGreaterEqual(count, true[key])
+            self.assertLessEqual(count - error, true[key])
+
+    def test_late_key(self):
+        topk = sketch.TopK(2)
+        # c and d are evicted with the 4th key
+        for key in 'aaabbcd':
+            topk.update(key)
+        self.assertEqual((len(topk), topk.floor), (2, 1))
+        topk.update('e')
+        self.assertEqual(topk.top(3)[-1], ('e', 2, 1))
+
+
+class TestHyperLogLog(TestCase):
+
+    def test_small(self):
+        hll = sketch.HyperLogLog()
+        self.assertEqual(hll.count(), 0)
+        for i in range(3):
+            for n in range(100):
+                hll.add('url%d' % n)
+        self.assertAlmostEqual(hll.count(), 100, delta = 2)
+
+    def test_large(self):
+        for p in (10, 12):
+            hll = sketch.HyperLogLog(p)
+            n = 100000
+            for i in range(n):
+                hll.add(b'http://example.com/%d' % i)
+            # 5 standard errors
+            self.assertAlmostEqual(hll.count(), n, delta = n * 5.2 / 2 ** (p / 2))
+            self.assertEqual(len(hll.registers), 2 ** p)
+
+    def test_precision(self):
+        self.assertRaises(ValueError, sketch.HyperLogLog, 3)
+        self.assertRaises(ValueError, sketch.Traffic, 10, 17)
+
+
+class TestTraffic(TestCase):
+
+    def test_report(self):
+        traffic = sketch.Traffic(2)
+        for url in (b'http://a.example.com/x', b'http://b.example.com/x',
+                    b'http://a.example.com/x', b'http://a.example.com/y'):
+            traffic.update('test', url, b'http://example.squid.internal/' + url[-1:])
+        traffic.update('other', 'http://c.example.com/z', 'http://other.squid.internal/z')
+        report = traffic.report()
+        self.assertEqual(sorted(report), ['other', 'test'])
+        test = report['test']
+        self.assertEqual((test['requests'], test['urls']), (4, 3))
+        self.assertEqual(test['objects'][0], ('http://example.squid.internal/x', 3, 0))
+        self.assertEqual(test['origins'], [('a.example.com', 3, 0), ('b.example.com', 1, 0)])
+        self.assertEqual(report['other']['origins'], [('c.example.com', 1, 0)])
+
+    def test_host(self):
+        self.assertEqual(sketch.host('http://a.example.com/x/y'), 'a.example.com')
+        self.assertEqual(sketch.host(b'http://a.example.com'), b'a.example.com')
+        self.assertEqual(sketch.host('invalid'), 'invalid')
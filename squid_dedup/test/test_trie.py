@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import trie
+
+class TestPrefixTrie(TestCase):
+
+    def setUp(self):
+        self.trie = trie.PrefixTrie()
+        for prefix, value in (('http://a.org/', 'a'),
+                              ('http://a.org/pub/', 'pub'),
+                              ('http://b.org/x', 'b')):
+            self.trie.add(prefix, value)
+
+    def test_match(self):
+        self.assertEqual(self.trie.match('http://a.org/file'), ('a', 13))
+        # the longest prefix wins
+        self.assertEqual(self.trie.match('http://a.org/pub/file'), ('pub', 17))
+        self.assertEqual(self.trie.match('http://b.org/xyz'), ('b', 14))
+        self.assertIsNone(self.trie.match('http://b.org/'))
+        self.assertIsNone(self.trie.match('http://c.org/'))
+        self.assertIsNone(self.trie.match(''))
+
+    def test_add(self):
+        self.assertEqual(len(self.trie), 3)
+        self.assertEqual(self.trie.add('http://a.org/', 'c'), 'a')
+        self.assertEqual(len(self.trie), 3)
+        self.assertEqual(self.trie.match('http://a.org/file'), ('c', 13))
+
+    def test_bytes(self):
+        t = trie.PrefixTrie()
+        t.add(b'http://a.org/', 'a')
+        self.assertEqual(t.match(b'http://a.org/file'), ('a', 13))
+        self.assertIsNone(t.match(b'http://b.org/file'))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import urlcache
+from lib import record
+from lib import memory
+
+def section(name, replace):
+    head, sep, tail = replace.partition('\\1')
+    return record.recordfactory('Section', name = name, prefix_replace = (head, tail),
+                                prefix_breplace = (head.encode(), tail.encode()))
+
+PKG = section('pkg', 'http://pkg.squid.internal/\\1')
+CDN = section('cdn', 'http://cdn.squid.internal/\\1?cdn')
+
+
+class TestFifoCache(TestCase):
+
+    def test_evict(self):
+        cache = urlcache.FifoCache(2)
+        for key in 'abc':
+            cache[key] = key.upper()
+        self.assertEqual(list(cache.items()), [('b', 'B'), ('c', 'C')])
+        self.assertRaises(KeyError, cache.__getitem__, 'a')
+        cache = urlcache.FifoCache()
+        for key in range(100):
+            cache[key] = key
+        self.assertEqual(len(cache), 100)
+
+
+class TestCompactCache(TestCase):
+
+    def test_str(self):
+        cache = urlcache.CompactCache(10, [PKG, CDN])
+        rules = {'http://mirror.example.com/pub/a.rpm': (PKG, 'http://pkg.squid.internal/a.rpm'),
+                 'http://a1.cdn.example.org/b': (CDN, 'http://cdn.squid.internal/b?cdn'),
+                 # no suffix of the URL: kept as is
+                 'http://mirror.example.com/pub/c.rpm?x=1': (PKG, 'http://pkg.squid.internal/c.rpm'),
+                 'http://mirror.example.com/': (PKG, 'http://pkg.squid.internal/')}
+        for url, rule in rules.items():
+            cache[url] = rule
+        for url, rule in rules.items():
+            self.assertEqual(cache[url], rule)
+            self.assertIs(cache[url][0], rule[0])
+        self.assertEqual(sum(type(value) is int for value in cache._new.values()), 3)
+        self.assertRaises(KeyError, cache.__getitem__, 'http://mirror.example.com/pub/d.rpm')
+
+    def test_bytes(self):
+        cache = urlcache.CompactCache(10, [PKG], binary = True)
+        newurl = b'http://pkg.squid.internal/a.rpm'
+        cache[b'http://mirror.example.com/pub/a.rpm'] = (PKG, newurl, b'OK store-id=' + newurl)
+        self.assertEqual(cache[b'http://mirror.example.com/pub/a.rpm'],
+                         (PKG, newurl, b'OK store-id=' + newurl))
+
+    def test_unknown_section(self):
+        # e.g. of a reloaded ruleset: kept as is
+        cache = urlcache.CompactCache(10, [PKG])
+        other = section('pkg', 'http://pkg.squid.internal/\\1')
+        cache['http://x/a'] = (other, 'http://pkg.squid.internal/a')
+        self.assertIs(cache['http://x/a'][0], other)
+
+    def test_collision(self):
+        cache = urlcache.CompactCache(10, [PKG])
+        url = 'http://mirror.example.com/pub/a.rpm'
+        cache[url] = (PKG, 'http://pkg.squid.internal/a.rpm')
+        # fake a hash collision with a different URL
+        other = 'http://mirror.example.com/pub/b.rpm'
+        cache._new[hash(other)] = cache._new[hash(url)]
+        self.assertRaises(KeyError, cache.__getitem__, other)
+        self.assertEqual(cache.collisions, 1)
+
+    def test_generations(self):
+        cache = urlcache.CompactCache(4, [PKG])
+        urls = ['http://x/%d' % i for i in range(6)]
+        for url in urls[:4]:
+            cache[url] = (PKG, 'http://pkg.squid.internal/' + url[-1])
+        # 0 and 1 were moved to the old generation, and dropped with 2 and 3
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(KeyError, cache.__getitem__, urls[0])
+        cache[urls[4]] = (PKG, 'http://pkg.squid.internal/4')
+        # a hit in the old generation keeps the entry
+        self.assertEqual(cache[urls[2]][1], 'http://pkg.squid.internal/2')
+        cache[urls[5]] = (PKG, 'http://pkg.squid.internal/5')
+        self.assertEqual(cache[urls[2]][1], 'http://pkg.squid.internal/2')
+        self.assertRaises(KeyError, cache.__getitem__, urls[3])
+
+    def test_size(self):
+        fifo = urlcache.FifoCache(1000)
+        compact = urlcache.CompactCache(1000, [PKG], binary = True)
+        for i in range(500):
+            url = b'http://mirror%d.example.com/pub/dist/%d/pkg-%d.rpm' % (i % 7, i % 97, i)
+            newurl = b'http://pkg.squid.internal/dist/%d/pkg-%d.rpm' % (i % 97, i)
+            rule = (PKG, newurl, b'OK store-id=' + newurl)
+            fifo[url] = compact[url] = rule
+        self.assertEqual(len(compact), 500)
+        self.assertLess(memory.size(compact) * 3, memory.size(fifo))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+import os
+import sys
+import fcntl
+import select
+
+from unittest import TestCase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from lib import journal
+from lib import linereader
+from lib import logsetup
+from lib import record
+from worker import FetchWorker, Feed
+from fixtures import config
+
+SECTION = record.recordfactory('Section', name = 'pkg', fetch = True)
+
+
+def worker_config():
+    return config(fetch_queue = journal.JournalQueue(), ruleset = None,
+                  section_dict = {'pkg': SECTION})
+
+
+class Policy:
+    """ records the requests of a feed """
+    def __init__(self):
+        self.requests = []
+
+    def request(self, section, newurl, url):
+        self.requests.append((section.name, newurl, url))
+
+
+class TestFetchWorker(TestCase):
+
+    def setUp(self):
+        self.worker = FetchWorker(worker_config())
+        self.fds = []
+
+    def tearDown(self):
+        for pipe in (self.worker._feeding, self.worker._pipe):
+            if pipe is not None:
+                pipe.close()
+        for fd in self.fds:
+            os.close(fd)
+
+    def pipe(self):
+        """ a non-blocking pipe, as the worker is fed with, and its read end """
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL, fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.fds.append(r)
+        return os.fdopen(w, 'wb', buffering = 0), r
+
+    def test_record(self):
+        self.worker._pipe, r = self.pipe()
+        self.worker.request(SECTION, 'http://pkg/ä', 'http://mirror/ä')
+        data = os.read(r, 4096)
+        self.assertEqual(data, 'pkg\thttp://pkg/ä\thttp://mirror/ä\n'.encode('utf-8'))
+        # the feed splits it again
+        feed = Feed(worker_config())
+        feed._policy = Policy()
+        feed.process(data.rstrip(b'\n'))
+        self.assertEqual(feed._policy.requests, [('pkg', 'http://pkg/ä', 'http://mirror/ä')])
+        self.assertEqual((self.worker.fed, self.worker.dropped), (1, 0))
+
+    def test_too_long(self):
+        # records beyond PIPE_BUF might be written partially: dropped
+        self.worker._pipe, r = self.pipe()
+        self.worker.request(SECTION, 'http://pkg/' + 'x' * select.PIPE_BUF, 'http://mirror/x')
+        self.assertEqual((self.worker.fed, self.worker.dropped), (0, 1))
+        self.assertEqual(select.select([r], [], [], 0)[0], [])
+
+    def test_full(self):
+        # requests are dropped, while the worker lags behind
+        self.worker._pipe, r = self.pipe()
+        while self.worker.dropped == 0:
+            self.worker.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        fed = self.worker.fed
+        self.worker.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        self.assertEqual((self.worker.fed, self.worker.dropped), (fed, 2))
+        # complete records only
+        data = b''
+        while select.select([r], [], [], 0)[0]:
+            data += os.read(r, 65536)
+        self.assertEqual(data, b'pkg\thttp://pkg/a\thttp://mirror/a\n' * fed)
+        self.worker.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        self.assertEqual(self.worker.fed, fed + 1)
+
+    def test_gone(self):
+        # the worker is gone: dropped
+        self.worker._pipe, r = self.pipe()
+        self.fds.remove(r)
+        os.close(r)
+        self.worker.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        self.assertEqual((self.worker.fed, self.worker.dropped), (0, 1))
+
+    def test_restart(self):
+        # the dedup thread takes over the pipe of a restarted worker, and
+        # closes the previous one then
+        old, r1 = self.pipe()
+        self.worker._pipe = old
+        self.worker.request(SECTION, 'http://pkg/a', 'http://mirror/a')
+        self.worker._pipe, r2 = self.pipe()
+        self.assertFalse(old.closed)
+        self.worker.request(SECTION, 'http://pkg/b', 'http://mirror/b')
+        self.assertTrue(old.closed)
+        self.assertEqual(os.read(r1, 4096), b'pkg\thttp://pkg/a\thttp://mirror/a\n')
+        self.assertEqual(os.read(r2, 4096), b'pkg\thttp://pkg/b\thttp://mirror/b\n')
+        self.assertEqual(self.worker.fed, 2)
+
+
+class TestFeed(TestCase):
+
+    def tearDown(self):
+        Feed._reader = None
+
+    def test_eof(self):
+        # all records are processed, an unterminated last one as well,
+        # and the feed ends with the helper
+        r, w = os.pipe()
+        os.write(w, b'pkg\thttp://pkg/a\thttp://mirror/a\ninvalid\n'
+                    b'other\thttp://other/b\thttp://mirror/b\n'
+                    b'pkg\thttp://pkg/c\thttp://mirror/c')
+        os.close(w)
+        Feed._reader = linereader.LineReader(r)
+        feed = Feed(worker_config())
+        feed._policy = Policy()
+        try:
+            feed.run()
+        finally:
+            os.close(r)
+        self.assertEqual(feed._policy.requests, [('pkg', 'http://pkg/a', 'http://mirror/a'),
+                                                 ('pkg', 'http://pkg/c', 'http://mirror/c')])
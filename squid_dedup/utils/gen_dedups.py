@@ -0,0 +1,733 @@
+#! /usr/bin/env python3
+"""
+Description:
+    harvest the mirror lists of distributions concurrently, and generate
+    their redirects suitable for squid_dedup in one run
+
+Usage: %(appname)s [-hVvsfaP][-l log][-c conf][-j jobs][-t secs][source ...]
+       -h, --help           this message
+       -V, --version        print version and exit
+       -v, --verbose        verbose mode (cumulative)
+       -s, --syslog         log errors to syslog
+       -l, --logfile=fname  log to this file
+       -f, --force          force operation (download and replacement)
+       -a, --all            harvest all sources
+       -c, --config=fname   read additional or modified sources from fname
+       -j, --jobs=n         fetch up to n mirror lists concurrently
+                            [default: %(jobs)s]
+       -t, --timeout=secs   network timeout [default: %(timeout)s]
+       -P, --prefix         generate literal URL prefixes instead of
+                            regular expressions (faster matching)
+
+Sources: %(sources)s
+
+Without sources given, all sources are harvested, whose dedup file exists.
+
+Mirror lists are requested conditionally (ETag, If-Modified-Since), and parsed,
+while they are downloaded. A dedup file is only replaced, if its rules changed.
+
+Sources are modified or added with an ini style file, e.g.:
+[debian]
+dedup = /srv/squid/dedup/debian.conf
+replace = http://debian.%%(intdomain)s/\\1
+
+[example]
+url = http://www.example.org/mirrors.html
+extractor = links
+href = ^http://.*/example/$
+country = h3
+
+Source options: %(options)s
+Extractors: %(extractors)s
+
+The fetched pages are stored in the path, that TMPDIR, TEMP or TMP
+environment variables point to, and limits access to the user itself.
+
+The usual way to run this script is by crontab -e. Add a line similar to:
+0 6 * * * /path/to/this/script/%(appname)s -vs
+
+Remember to create the dedup files beforehand,
+writable for the user running the crontab, with decent permissions, e.g.:
+$ touch /etc/squid/dedup/opensuse.conf
+$ chown user:group /etc/squid/dedup/opensuse.conf
+$ chmod 644 /etc/squid/dedup/opensuse.conf
+"""
+#
+# vim:set et ts=8 sw=4:
+#
+
+__version__ = '0.1'
+__author__ = 'Hans-Peter Jansen <hpj@urpla.net>'
+__license__ = 'GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details'
+
+
+import os
+import re
+import sys
+import abc
+import json
+import time
+import getopt
+import logging
+import logging.handlers
+import tempfile
+import configparser
+import email.utils
+import urllib.error
+import urllib.request
+import concurrent.futures
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+class gpar:
+    """ global parameter class """
+    appdir, appname = os.path.split(sys.argv[0])
+    if appdir == '.':
+        appdir = os.getcwd()
+    version = __version__
+    author = __author__
+    license = __license__
+    loglevel = logging.WARNING
+    syslog = False
+    logfile = None
+    force = False
+    all = False
+    config = None
+    jobs = 4
+    timeout = 60
+    prefix = False
+
+# exit codes
+NO_ERR, OPTION_ERR, FETCH_ERR, PARSE_ERR, WRITE_ERR = range(5)
+
+# read size of mirror lists
+CHUNK_SIZE = 64 * 1024
+
+# built-in sources: options of Source
+SOURCES = {
+    'opensuse': dict(
+        url = 'http://mirrors.opensuse.org/list/all.html',
+        page = 'openSUSE-mirrors.html',
+        extractor = 'opensuse',
+        section = 'openSUSE',
+        match = [r'http\:\/\/[a-z0-9]+\.opensuse\.org\/(.*)'],
+        comment = 'openSUSE Headquarter',
+        replace = 'http://download.opensuse.org.%(intdomain)s/\\1',
+    ),
+    'packman': dict(
+        url = 'http://packman.links2linux.de/mirrors',
+        page = 'packman-mirrors.html',
+        extractor = 'packman',
+        replace = 'http://packman.%(intdomain)s/\\1',
+    ),
+    'debian': dict(
+        url = 'https://www.debian.org/mirror/list',
+        extractor = 'links',
+        href = r'^http://[^/]+/(.+/)?debian/?$',
+        country = 'h3',
+        match = [r'http\:\/\/deb\.debian\.org\/debian\/(.*)'],
+        comment = 'Debian redirector',
+        replace = 'http://debian.%(intdomain)s/\\1',
+    ),
+    'ubuntu': dict(
+        url = 'https://launchpad.net/ubuntu/+archivemirrors',
+        extractor = 'links',
+        href = r'^http://',
+        text = r'^http$',
+        country = 'th',
+        match = [r'http\:\/\/(?:[a-z]+\.)?archive\.ubuntu\.com\/ubuntu\/(.*)'],
+        comment = 'Ubuntu archive',
+        replace = 'http://ubuntu.%(intdomain)s/\\1',
+    ),
+    'fedora': dict(
+        url = 'https://mirrors.fedoraproject.org/mirrorlist?'
+              'repo=rawhide&arch=x86_64&protocol=http',
+        extractor = 'text',
+        strip = 'development/rawhide/Everything/x86_64/os/',
+        replace = 'http://fedora.%(intdomain)s/\\1',
+    ),
+    'centos': dict(
+        url = 'https://mirrors.centos.org/mirrorlist?'
+              'repo=centos-baseos-10-stream&arch=x86_64&protocol=http',
+        extractor = 'text',
+        strip = '10-stream/BaseOS/x86_64/os/',
+        replace = 'http://centos.%(intdomain)s/\\1',
+    ),
+}
+
+# extractor classes by name, registered with @extractor
+EXTRACTORS = {}
+
+log = logging.getLogger(gpar.appname)
+
+stderr = lambda *s: print(*s, file = sys.stderr, flush = True)
+
+def exit(ret = 0, msg = None, usage = False):
+    """ terminate process with optional message and usage """
+    if msg:
+        stderr('%s: %s' % (gpar.appname, msg))
+    if usage:
+        stderr(__doc__ % dict(gpar.__dict__,
+                              sources = ', '.join(sorted(SOURCES)),
+                              options = ', '.join(sorted(Source.options())),
+                              extractors = ', '.join(sorted(EXTRACTORS))))
+    sys.exit(ret)
+
+
+def setup_logging(loglevel, logfile, syslog_errors):
+    """ setup various aspects of logging facility """
+    logconfig = dict(
+        level = loglevel,
+        format = '%(asctime)s %(levelname)5s: [%(name)s] %(message)s',
+        datefmt = '%Y-%m-%d %H:%M:%S',
+    )
+    if logfile is not None:
+        logconfig['filename'] = logfile
+    logging.basicConfig(**logconfig)
+    if syslog_errors:
+        syslog = logging.handlers.SysLogHandler(address = '/dev/log')
+        syslog.setLevel(logging.ERROR)
+        formatter = logging.Formatter('%(name)s[%(process)d]: %(levelname)s: %(message)s')
+        syslog.setFormatter(formatter)
+        logging.getLogger().addHandler(syslog)
+
+
+class Source:
+    """ a mirror list: where to fetch it, how to extract the mirror URLs, and
+        the dedup section generated from them
+    """
+    url = None
+    # name of the saved page [default: <name>-mirrors]
+    page = None
+    # name of the extractor
+    extractor = None
+    # dedup file [default: /etc/squid/dedup/<name>.conf]
+    dedup = None
+    # section name [default: <name>]
+    section = None
+    # regular expressions, matched in addition to the mirrors, and their comment
+    match = ()
+    comment = None
+    replace = None
+    # generate literal URL prefixes
+    prefix = False
+    # links extractor: regular expressions of href and text of the mirror links
+    href = None
+    text = None
+    # links extractor: tag of the elements, that contain the country
+    country = None
+    # text extractor: path of the mirror URLs, that is stripped off
+    strip = None
+
+    def __init__(self, name, **options):
+        self.name = name
+        for key, value in options.items():
+            if key not in self.options():
+                raise ValueError('source <%s>: invalid option <%s>' % (name, key))
+            setattr(self, key, value)
+        if not self.url:
+            raise ValueError('source <%s>: url missing' % name)
+        if not self.replace:
+            raise ValueError('source <%s>: replace missing' % name)
+        if self.extractor not in EXTRACTORS:
+            raise ValueError('source <%s>: invalid extractor <%s>' % (name, self.extractor))
+        self.page = self.page or '%s-mirrors' % name
+        self.dedup = self.dedup or '/etc/squid/dedup/%s.conf' % name
+        self.section = self.section or name
+
+    @classmethod
+    def options(cls):
+        return [key for key in vars(cls) if not key.startswith('_') and key != 'options']
+
+
+def extractor(name):
+    """ class decorator: register an extractor under name """
+    def register(cls):
+        EXTRACTORS[name] = cls
+        return cls
+    return register
+
+
+class Extractor(metaclass = abc.ABCMeta):
+    """ incremental parser of a mirror list: feed() it with the page in chunks,
+        close() returns the mirror URLs as list of (url, country)
+    """
+    def __init__(self, source):
+        self.source = source
+        self.urls = []
+        self._seen = set()
+
+    @abc.abstractmethod
+    def feed(self, data):
+        """ parse the next chunk of the page """
+
+    def close(self):
+        return self.urls
+
+    def add(self, url, country):
+        url = url.strip()
+        if not url.endswith('/'):
+            url += '/'
+        if url not in self._seen:
+            self._seen.add(url)
+            self.urls.append((url, country))
+
+
+class HTMLExtractor(Extractor):
+    """ HTML pages are parsed with lxml, the elements are passed to start(),
+        and to end(), when they are complete. Table rows are dropped then.
+    """
+    def __init__(self, source):
+        super().__init__(source)
+        if etree is None:
+            raise ValueError('source <%s>: lxml is required' % source.name)
+        self._parser = etree.HTMLPullParser(events = ('start', 'end'))
+
+    def feed(self, data):
+        self._parser.feed(data)
+        self._events()
+
+    def close(self):
+        self._parser.close()
+        self._events()
+        return self.urls
+
+    def _events(self):
+        for event, e in self._parser.read_events():
+            if event == 'start':
+                self.start(e)
+            else:
+                self.end(e)
+                if e.tag == 'tr':
+                    e.clear()
+
+    def start(self, e):
+        pass
+
+    def end(self, e):
+        pass
+
+
+@extractor('opensuse')
+class OpenSUSEExtractor(HTMLExtractor):
+    """ mirrors.opensuse.org: HTTP links of the summary table, countries
+        are given by cells with a flag image
+    """
+    def __init__(self, source):
+        super().__init__(source)
+        self._table = 0
+        self._country = None
+
+    def start(self, e):
+        if e.tag == 'table' and e.get('summary') is not None:
+            self._table += 1
+
+    def end(self, e):
+        if e.tag == 'table' and e.get('summary') is not None:
+            self._table -= 1
+        elif not self._table:
+            pass
+        elif e.tag == 'td':
+            for se in e:
+                if se.tag == 'img':
+                    cc = se.get('alt')
+                    if cc:
+                        self._country = '%s (%s)' % (e.xpath('string()').strip(), cc)
+                    break
+        elif e.tag == 'a' and e.text == 'HTTP':
+            self.add(e.get('href'), self._country)
+
+
+@extractor('packman')
+class PackmanExtractor(HTMLExtractor):
+    """ packman.links2linux.de: http links of mirror tables, countries are
+        given by header cells
+    """
+    def __init__(self, source):
+        super().__init__(source)
+        self._table = 0
+        self._country = None
+
+    def start(self, e):
+        if e.tag == 'table' and e.get('class') == 'mirrortable':
+            self._table += 1
+            self._country = None
+
+    def end(self, e):
+        if e.tag == 'table' and e.get('class') == 'mirrortable':
+            self._table -= 1
+        elif not self._table:
+            pass
+        elif e.tag == 'th' and e.text:
+            self._country = e.text
+        elif e.tag == 'a' and e.text and e.text.startswith('http'):
+            self.add(e.get('href'), self._country)
+
+
+@extractor('links')
+class LinksExtractor(HTMLExtractor):
+    """ generic: links, whose href (and text) match the regular expressions
+        of the source, countries are given by elements with the country tag
+    """
+    def __init__(self, source):
+        super().__init__(source)
+        if not source.href:
+            raise ValueError('source <%s>: href missing' % source.name)
+        self._href = re.compile(source.href)
+        self._text = re.compile(source.text) if source.text else None
+        self._country = None
+
+    def end(self, e):
+        if e.tag == self.source.country:
+            self._country = e.xpath('string()').strip() or self._country
+        elif e.tag == 'a':
+            href = e.get('href')
+            if href and self._href.search(href):
+                if self._text is None or self._text.search(e.xpath('string()').strip()):
+                    self.add(href, self._country)
+
+
+@extractor('text')
+class TextExtractor(Extractor):
+    """ plain text lists of mirror URLs (e.g. of MirrorManager), one per line,
+        # starts a comment. URLs, that don't end with the strip path of the
+        source, are ignored.
+    """
+    def __init__(self, source):
+        super().__init__(source)
+        self._rest = b''
+
+    def feed(self, data):
+        lines = (self._rest + data).split(b'\n')
+        self._rest = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        self._line(self._rest)
+        self._rest = b''
+        return self.urls
+
+    def _line(self, line):
+        url = line.decode('utf-8', 'replace').partition('#')[0].strip()
+        if not url:
+            return
+        strip = self.source.strip
+        if strip:
+            if not url.rstrip('/').endswith(strip.rstrip('/')):
+                log.debug('%s: <%s> ignored', self.source.name, url)
+                return
+            url = url.rstrip('/')[:-len(strip.rstrip('/'))]
+        self.add(url, None)
+
+
+def pagefile(source):
+    return os.path.join(tempfile.gettempdir(), source.page)
+
+
+def fetch(source, parser, force):
+    """ fetch the mirror list of source, and feed parser with it, while it is
+        saved as pagefile, with its validators in pagefile.json
+        the request is conditional, unless force is set
+        return error code, and the timestamp of the page, or None, if unchanged
+    """
+    url = source.url
+    fname = pagefile(source)
+    vname = fname + '.json'
+    headers = {'User-Agent': '%s/%s' % (gpar.appname, gpar.version)}
+    validators = {}
+    if not force and os.path.exists(fname):
+        try:
+            with open(vname) as fd:
+                validators = json.load(fd)
+        except (IOError, ValueError):
+            pass
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    log.info('fetch %s', url)
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers = headers),
+                                          timeout = gpar.timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            log.info('<%s> unchanged', url)
+            return NO_ERR, None
+        log.error('open %s failed: %s', url, e)
+        return FETCH_ERR, None
+    except Exception as e:
+        log.error('open %s failed: %s', url, e)
+        return FETCH_ERR, None
+
+    log.debug('http header\n%s', response.info())
+    # last modification as unix timestamp
+    lm = email.utils.parsedate_tz(response.info()['Last-Modified'] or '')
+    ts = email.utils.mktime_tz(lm) if lm else time.time()
+    tmpname = fname + '.part'
+    log.debug('read %s', url)
+    try:
+        with response, open(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                            'wb') as fd:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                fd.write(data)
+                parser.feed(data)
+    except IOError as e:
+        log.error('read %s failed: %s', url, e)
+        return FETCH_ERR, None
+    except Exception as e:
+        log.error('<%s> malformed: %s', url, e)
+        return PARSE_ERR, None
+    os.replace(tmpname, fname)
+    atime = os.stat(fname).st_atime
+    os.utime(fname, times = (atime, ts))
+    validators = {}
+    if response.info()['ETag']:
+        validators['etag'] = response.info()['ETag']
+    if response.info()['Last-Modified']:
+        validators['last_modified'] = response.info()['Last-Modified']
+    try:
+        with open(os.open(vname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fd:
+            json.dump(validators, fd)
+    except IOError as e:
+        log.warning('write %s failed: %s', vname, e)
+    return NO_ERR, ts
+
+
+def parse(source, parser):
+    """ feed parser with the saved page of source
+        return error code, and the timestamp of the page
+    """
+    fname = pagefile(source)
+    log.debug('read %s', fname)
+    try:
+        with open(fname, 'rb') as fd:
+            while True:
+                data = fd.read(CHUNK_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+    except IOError as e:
+        log.error('read %s failed: %s', fname, e)
+        return FETCH_ERR, None
+    except Exception as e:
+        log.error('<%s> malformed: %s', fname, e)
+        return PARSE_ERR, None
+    return NO_ERR, os.stat(fname).st_mtime
+
+
+def harvest(source, force):
+    """ fetch and extract the mirror list of source (in a worker thread)
+        an unchanged page is extracted from the saved copy: generate() decides,
+        if the rules changed, e.g. due to modified source options
+        return error code, mirror URLs, and timestamp
+    """
+    try:
+        parser = EXTRACTORS[source.extractor](source)
+    except ValueError as e:
+        log.error(e)
+        return PARSE_ERR, None, None
+    ret, ts = fetch(source, parser, force)
+    if ret == NO_ERR and ts is None:
+        ret, ts = parse(source, parser)
+    if ret != NO_ERR:
+        return ret, None, None
+    try:
+        urls = parser.close()
+    except Exception as e:
+        log.error('<%s> malformed: %s', source.url, e)
+        return PARSE_ERR, None, None
+    if not urls:
+        log.error('<%s>: no mirrors found', source.url)
+        return PARSE_ERR, None, None
+    log.info('%s: %s mirrors', source.name, len(urls))
+    return NO_ERR, urls, ts
+
+
+def rule(url, prefix):
+    """ return a mirror url as literal prefix, or as regular expression """
+    if prefix:
+        return '    %s' % url
+    return '    %s(.*)' % re.escape(url)
+
+
+def rules(data):
+    """ return data without its leading comments (e.g. the timestamp) """
+    lines = data.split('\n')
+    while lines and lines[0].startswith('#'):
+        lines.pop(0)
+    return lines
+
+
+def generate(source, urls, ts, force):
+    """ write the dedup file of source, if its rules changed """
+    vars = dict(appname = gpar.appname, url = source.url,
+                url_timestamp = email.utils.formatdate(ts, localtime = True))
+    data = ['''\
+#
+# this file was generated by %(appname)s
+# from %(url)s
+# with timestamp %(url_timestamp)s
+#''' % vars, '[%s]' % source.section]
+    if source.match:
+        data.append('match:')
+        if source.comment:
+            data.append('    # %s' % source.comment)
+        data.extend('    %s' % regexp for regexp in source.match)
+    if source.prefix:
+        data.append('prefix:')
+    elif not source.match:
+        data.append('match:')
+    country = None
+    for url, cc in urls:
+        if cc != country:
+            data.append('    # %s' % cc)
+            country = cc
+        data.append(rule(url, source.prefix))
+    data.append('''\
+replace: %s
+# fetch all redirected objects explicitly
+fetch: true
+
+''' % source.replace)
+    newdata = '\n'.join(data)
+    if not force:
+        try:
+            with open(source.dedup, 'r') as fd:
+                olddata = fd.read()
+        except Exception:
+            pass
+        else:
+            if rules(olddata) == rules(newdata):
+                log.info('<%s> unchanged', source.dedup)
+                return NO_ERR
+    log.info('generate %s', source.dedup)
+    # replace the dedup config file atomically: squid_dedup might reload it
+    # any time, and must never see it partially written
+    tmpname = source.dedup + '.part'
+    try:
+        with open(tmpname, 'w') as fd:
+            fd.write(newdata)
+        os.replace(tmpname, source.dedup)
+    except Exception as e:
+        log.error(e)
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        return WRITE_ERR
+    return NO_ERR
+
+
+def load_sources(config = None):
+    """ return the built-in sources, modified and extended by config """
+    options = {name: dict(opts) for name, opts in SOURCES.items()}
+    if config:
+        cp = configparser.ConfigParser(interpolation = None)
+        if not cp.read(config):
+            raise ValueError('%s: not readable' % config)
+        for name in cp.sections():
+            opts = options.setdefault(name, {})
+            for key, value in cp.items(name):
+                if key == 'prefix':
+                    value = cp.getboolean(name, key)
+                elif key == 'match':
+                    value = [regexp for regexp in value.split('\n') if regexp]
+                opts[key] = value
+    return {name: Source(name, **opts) for name, opts in options.items()}
+
+
+def run(sources, force = False, jobs = None):
+    """ harvest sources concurrently, and generate their dedup files
+        return the highest error code
+    """
+    ret = NO_ERR
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs or len(sources)) as executor:
+        futures = [(source, executor.submit(harvest, source, force)) for source in sources]
+        for source, future in futures:
+            err, urls, ts = future.result()
+            if urls:
+                err = max(err, generate(source, urls, ts, force))
+            ret = max(ret, err)
+    return ret
+
+
+def gen_dedups(names):
+    try:
+        sources = load_sources(gpar.config)
+    except (ValueError, configparser.Error) as e:
+        log.error(e)
+        return OPTION_ERR
+    for name in names:
+        if name not in sources:
+            log.error('unknown source <%s>', name)
+            return OPTION_ERR
+    if names:
+        sources = [sources[name] for name in names]
+    elif gpar.all:
+        sources = [sources[name] for name in sorted(sources)]
+    else:
+        sources = [sources[name] for name in sorted(sources)
+                   if os.path.exists(sources[name].dedup)]
+        if not sources:
+            log.error('no dedup files found: select sources, or use --all')
+            return OPTION_ERR
+    for source in sources:
+        source.prefix = source.prefix or gpar.prefix
+    return run(sources, gpar.force, gpar.jobs)
+
+
+def main():
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hVvsfaPl:c:j:t:',
+            ('help', 'version', 'verbose', 'syslog', 'logfile=', 'force',
+             'all', 'config=', 'jobs=', 'timeout=', 'prefix')
+        )
+    except getopt.error as msg:
+        exit(OPTION_ERR, msg, True)
+
+    for opt, par in optlist:
+        if opt in ('-h', '--help'):
+            exit(usage = True)
+        elif opt in ('-V', '--version'):
+            exit(msg = 'version %s' % gpar.version)
+        elif opt in ('-v', '--verbose'):
+            if gpar.loglevel > logging.DEBUG:
+                gpar.loglevel -= 10
+        elif opt in ('-s', '--syslog'):
+            gpar.syslog = True
+        elif opt in ('-l', '--logfile'):
+            gpar.logfile = par
+        elif opt in ('-f', '--force'):
+            gpar.force = True
+        elif opt in ('-a', '--all'):
+            gpar.all = True
+        elif opt in ('-c', '--config'):
+            gpar.config = par
+        elif opt in ('-j', '--jobs'):
+            try:
+                gpar.jobs = int(par)
+            except ValueError:
+                exit(OPTION_ERR, 'invalid jobs <%s>' % par, True)
+        elif opt in ('-t', '--timeout'):
+            try:
+                gpar.timeout = float(par)
+            except ValueError:
+                exit(OPTION_ERR, 'invalid timeout <%s>' % par, True)
+        elif opt in ('-P', '--prefix'):
+            gpar.prefix = True
+
+    setup_logging(gpar.loglevel, gpar.logfile, gpar.syslog)
+
+    sys.exit(gen_dedups(args))
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ Description:
     generate openSUSE redirects suitable for squid_dedup
     fetched from %(url)s
 
-Usage: %(appname)s [-hVvsf][-l log][-u url][-p page][-d dedup][-r repl]
+Usage: %(appname)s [-hVvsfP][-l log][-u url][-p page][-d dedup][-r repl]
        -h, --help           this message
        -V, --version        print version and exit
        -v, --verbose        verbose mode (cumulative)
@@ -19,6 +19,8 @@ Usage: %(appname)s [-hVvsf][-l log][-u url][-p page][-d dedup][-r repl]
                             [default: %(dedup)s]
        -r, --repl=repl      matched URLs replacement argument
                             [default: %(replace)s]
+       -P, --prefix         generate literal URL prefixes instead of
+                            regular expressions (faster matching)
 
 The fetched page is stored in the path, that TMPDIR, TEMP or TMP
 environment variables point to, and limits access to the user itself.
@@ -42,19 +44,16 @@ __license__ = 'GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details'
 
 
 import os
-import re
 import sys
 import getopt
 import logging
 import logging.handlers
-import tempfile
-import posixpath
-import email.utils
-import urllib.parse
-import urllib.error
-import urllib.request
 
-from lxml import etree
+try:
+    from squid_dedup.utils import gen_dedups
+except ImportError:
+    # run from the source tree
+    import gen_dedups
 
 
 class gpar:
@@ -69,15 +68,14 @@ class gpar:
     syslog = False
     logfile = None
     force = False
-    url = 'http://mirrors.opensuse.org/list/all.html'
-    page = 'openSUSE-mirrors.html'
+    url = gen_dedups.SOURCES['opensuse']['url']
+    page = gen_dedups.SOURCES['opensuse']['page']
     dedup = '/etc/squid/dedup/opensuse.conf'
-    replace = 'http://download.opensuse.org.%(intdomain)s/\\1'
-    # internal
-    url_timestamp = None
+    prefix = False
+    replace = gen_dedups.SOURCES['opensuse']['replace']
 
 # exit codes
-NO_ERR, OPTION_ERR, FETCH_ERR, PARSE_ERR, WRITE_ERR = range(5)
+OPTION_ERR = gen_dedups.OPTION_ERR
 
 log = logging.getLogger(gpar.appname)
 
@@ -110,141 +108,23 @@ def setup_logging(loglevel, logfile, syslog_errors):
         logging.getLogger().addHandler(syslog)
 
 
-def fetch(url, pagefile, force):
-    """ fetch page from url as pagefile, if newer
-        adjust permissions and mtime of pagefile
-        return data, if successful or None
-    """
-    log.info('fetch %s', url)
-
-    mtime = None
-    if os.path.exists(pagefile):
-        mtime = os.stat(pagefile).st_mtime
-
-    try:
-        response = urllib.request.urlopen(url)
-    except urllib.error.URLError as e:
-        log.error('open (%s failed: %s', url, e)
-        return FETCH_ERR, None
-    else:
-        log.debug('http header\n%s', response.info())
-        # last modification as unix timestamp
-        lm = email.utils.parsedate_tz(response.info()['Last-Modified'])
-        ts = email.utils.mktime_tz(lm)
-
-        if force or mtime is None or ts > mtime:
-            log.debug('read %s', url)
-            try:
-                data = response.read()
-            except Exception as e:
-                log.error('read %s failed: %s', url, e)
-            else:
-                log.debug('write %s', pagefile)
-                try:
-                    open(pagefile, 'wb').write(data)
-                except IOError as e:
-                    log.error('write %s failed: %s', pagefile, e)
-                else:
-                    atime = os.stat(pagefile).st_atime
-                    os.utime(pagefile, times = (atime, ts))
-                    os.chmod(pagefile, 0o600)
-                    return NO_ERR, data
-
-        elif mtime is not None and ts <= mtime:
-            log.info('<%s> unchanged', pagefile)
-            #return NO_ERR, open(pagefile, 'r').read()
-            return NO_ERR, None
-
-
-def extract(pagedata, pagefile):
-    ret = []
-    try:
-        root = etree.HTML(pagedata)
-    except etree.LxmlError as e:
-        log.error('<%s> malformed: %s', pagefile, e)
-        return ret
-
-    table = root.find('.//table[@summary]')
-    if table is None:
-        log.error('<%s> malformed: summary table not found', pagefile)
-        return ret
-
-    country = None
-    for e in table.iter('a', 'td'):
-        if e.tag == 'td':
-            cc = None
-            for se in e:
-                if se.tag == 'img':
-                    cc = se.get('alt')
-                    break
-            if cc:
-                country = '%s (%s)' % (e.xpath('string()').strip(), cc)
-        elif e.tag == 'a':
-            if e.text == 'HTTP':
-                url = e.get('href')
-                if not url.endswith('/'):
-                    url += '/'
-                ret.append((url, country))
-    return ret
-
-
-def generate(pagedata, pagefile, dedupfile, vars):
-    log.info('generate %s', dedupfile)
-    urls = extract(pagedata, pagefile)
-    if not urls:
-        return PARSE_ERR
-    data = ['''\
-#
-# this file was generated by %(appname)s
-# from %(url)s
-# with timestamp %(url_timestamp)s
-#
-[openSUSE]
-match:
-    # openSUSE Headquarter
-    http\:\/\/[a-z0-9]+\.opensuse\.org\/(.*)''' % vars]
-    country = None
-    for url, cc in urls:
-        if cc != country:
-            data.append('    # %s' % cc)
-            country = cc
-        data.append('    %s(.*)' % re.escape(url))
-    data.append('''\
-replace: %(replace)s
-# fetch all redirected objects explicitly
-fetch: true
-
-''' % vars)
-    # open, write and close the dedup config file in one go
+def gen_openSUSE_dedups():
+    """ harvest the opensuse mirror list with gen_dedups """
+    options = dict(gen_dedups.SOURCES['opensuse'], url = gpar.url, page = gpar.page,
+                   dedup = gpar.dedup, replace = gpar.replace, prefix = gpar.prefix)
     try:
-        open(dedupfile, 'w').write('\n'.join(data))
-    except Exception as e:
+        source = gen_dedups.Source('opensuse', **options)
+    except ValueError as e:
         log.error(e)
-        return WRITE_ERR
-    return NO_ERR
-
-
-def gen_openSUSE_dedups():
-    ret = NO_ERR
-    if gpar.page:
-        fname = gpar.page
-    else:
-        path = urllib.parse.urlparse(gpar.url).path
-        fname = posixpath.basename(path)
-    pagefile = os.path.join(tempfile.gettempdir(), fname)
-    ret, pagedata = fetch(gpar.url, pagefile, gpar.force)
-    if pagedata:
-        mtime = os.stat(pagefile).st_mtime
-        gpar.url_timestamp = email.utils.formatdate(mtime, localtime = True)
-        ret = generate(pagedata, pagefile, gpar.dedup, gpar.__dict__)
-    return ret
+        return OPTION_ERR
+    return gen_dedups.run([source], gpar.force)
 
 
 if __name__ == '__main__':
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'hVvsfl:u:p:d:r:',
+        optlist, args = getopt.getopt(sys.argv[1:], 'hVvsfPl:u:p:d:r:',
             ('help', 'version', 'verbose', 'syslog', 'logfile',
-             'force', 'url=', 'page=', 'dedup=', 'repl=')
+             'force', 'url=', 'page=', 'dedup=', 'repl=', 'prefix')
         )
     except getopt.error as msg:
         exit(OPTION_ERR, msg, True)
@@ -271,9 +151,8 @@ if __name__ == '__main__':
             gpar.dedup = par
         elif opt in ('-r', '--repl'):
             gpar.replace = par
-
-    if not os.path.exists(gpar.dedup):
-        gpar.force = True
+        elif opt in ('-P', '--prefix'):
+            gpar.prefix = True
 
     setup_logging(gpar.loglevel, gpar.logfile, gpar.syslog)
 
@@ -4,7 +4,7 @@ Description:
     generate packman redirects suitable for squid_dedup
     fetched from %(url)s
 
-Usage: %(appname)s [-hVvs][-l log][-u url][-p page][-d dedup][-r repl]
+Usage: %(appname)s [-hVvsP][-l log][-u url][-p page][-d dedup][-r repl]
        -h, --help           this message
        -V, --version        print version and exit
        -v, --verbose        verbose mode (cumulative)
@@ -18,6 +18,8 @@ Usage: %(appname)s [-hVvs][-l log][-u url][-p page][-d dedup][-r repl]
                             [default: %(dedup)s]
        -r, --repl=repl      matched URLs replacement argument
                             [default: %(replace)s]
+       -P, --prefix         generate literal URL prefixes instead of
+                            regular expressions (faster matching)
 
 The fetched page is stored in the path, that TMPDIR, TEMP or TMP
 environment variables point to, and limits access to the user itself.
@@ -41,19 +43,16 @@ __license__ = 'GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details'
 
 
 import os
-import re
 import sys
 import getopt
 import logging
 import logging.handlers
-import tempfile
-import posixpath
-import email.utils
-import urllib.parse
-import urllib.error
-import urllib.request
 
-from lxml import etree
+try:
+    from squid_dedup.utils import gen_dedups
+except ImportError:
+    # run from the source tree
+    import gen_dedups
 
 
 class gpar:
@@ -67,15 +66,14 @@ class gpar:
     loglevel = logging.WARNING
     syslog = False
     logfile = None
-    url = 'http://packman.links2linux.de/mirrors'
-    page = 'packman-mirrors.html'
+    url = gen_dedups.SOURCES['packman']['url']
+    page = gen_dedups.SOURCES['packman']['page']
     dedup = '/etc/squid/dedup/packman.conf'
-    replace = 'http://packman.%(intdomain)s/\\1'
-    # internal
-    url_timestamp = None
+    prefix = False
+    replace = gen_dedups.SOURCES['packman']['replace']
 
 # exit codes
-NO_ERR, OPTION_ERR, FETCH_ERR, PARSE_ERR, WRITE_ERR = range(5)
+OPTION_ERR = gen_dedups.OPTION_ERR
 
 log = logging.getLogger(gpar.appname)
 
@@ -108,133 +106,23 @@ def setup_logging(loglevel, logfile, syslog_errors):
         logging.getLogger().addHandler(syslog)
 
 
-def fetch(url, pagefile):
-    """ fetch page from url as pagefile, if newer
-        adjust permissions and mtime of pagefile
-        return data, if successful or None
-    """
-    log.info('fetch %s', url)
-    try:
-        response = urllib.request.urlopen(url)
-    except urllib.error.URLError as e:
-        log.error('open (%s failed: %s', url, e)
-        return FETCH_ERR, None
-    else:
-        log.debug('http header\n%s', response.info())
-        # packman has no last-modified header, fetch every time
-        log.debug('read %s', url)
-        try:
-            data = response.read()
-        except Exception as e:
-            log.error('read %s failed: %s', url, e)
-        else:
-            # check, if page has changed
-            try:
-                olddata = open(pagefile, 'rb').read()
-            except IOError:
-                olddata = None
-            else:
-                if olddata == data:
-                    log.info('mirror page not changed')
-                    return NO_ERR, olddata
-            # page has changed
-            log.debug('write %s', pagefile)
-            try:
-                open(pagefile, 'wb').write(data)
-            except IOError as e:
-                log.error('write %s failed: %s', pagefile, e)
-            else:
-                os.chmod(pagefile, 0o600)
-                return NO_ERR, data
-
-
-def extract(pagedata, pagefile):
-    ret = []
-    try:
-        root = etree.HTML(pagedata)
-    except etree.LxmlError as e:
-        log.error('<%s> malformed: %s', pagefile, e)
-        return ret
-
-    for table in root.findall('.//table[@class="mirrortable"]'):
-        country = None
-        for e in table.iter('a', 'td', 'th'):
-            if e.tag == 'th' and e.text:
-                country = e.text
-            elif e.tag == 'a' and e.text.startswith('http'):
-                url = e.get('href')
-                if not url.endswith('/'):
-                    url += '/'
-                ret.append((url, country))
-    return ret
-
-
-def generate(pagedata, pagefile, dedupfile, vars):
-    urls = extract(pagedata, pagefile)
-    if not urls:
-        return PARSE_ERR
-    data = ['''\
-#
-# this file was generated by %(appname)s
-# from %(url)s
-# with timestamp %(url_timestamp)s
-#
-[packman]
-match:''' % vars]
-    country = None
-    for url, cc in urls:
-        if cc != country:
-            data.append('    # %s' % cc)
-            country = cc
-        data.append('    %s(.*)' % re.escape(url))
-    data.append('''\
-replace: %(replace)s
-# fetch all redirected objects explicitly
-fetch: true
-
-''' % vars)
-    try:
-        olddata = open(dedupfile, 'r').read()
-    except Exception:
-        olddata = None
-    else:
-        newdata = '\n'.join(data)
-        #log.debug('old:\n%s', olddata)
-        #log.debug('new:\n%s', newdata)
-        if olddata == newdata:
-            return NO_ERR
-
-    # open, write and close the dedup config file in one go
-    log.info('generate %s', dedupfile)
+def gen_packman_dedups():
+    """ harvest the packman mirror list with gen_dedups """
+    options = dict(gen_dedups.SOURCES['packman'], url = gpar.url, page = gpar.page,
+                   dedup = gpar.dedup, replace = gpar.replace, prefix = gpar.prefix)
     try:
-        open(dedupfile, 'w').write('\n'.join(data))
-    except Exception as e:
+        source = gen_dedups.Source('packman', **options)
+    except ValueError as e:
         log.error(e)
-        return WRITE_ERR
-    return NO_ERR
-
-
-def gen_packman_dedups():
-    ret = NO_ERR
-    if gpar.page:
-        fname = gpar.page
-    else:
-        path = urllib.parse.urlparse(gpar.url).path
-        fname = posixpath.basename(path)
-    pagefile = os.path.join(tempfile.gettempdir(), fname)
-    ret, pagedata = fetch(gpar.url, pagefile)
-    if pagedata:
-        mtime = os.stat(pagefile).st_mtime
-        gpar.url_timestamp = email.utils.formatdate(mtime, localtime = True)
-        ret = generate(pagedata, pagefile, gpar.dedup, gpar.__dict__)
-    return ret
+        return OPTION_ERR
+    return gen_dedups.run([source], False)
 
 
 def main():
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'hVvsl:u:p:d:r:',
+        optlist, args = getopt.getopt(sys.argv[1:], 'hVvsPl:u:p:d:r:',
             ('help', 'version', 'verbose', 'syslog', 'logfile',
-             'url=', 'page=', 'dedup=', 'repl=')
+             'url=', 'page=', 'dedup=', 'repl=', 'prefix')
         )
     except getopt.error as msg:
         exit(OPTION_ERR, msg, True)
@@ -259,6 +147,8 @@ def main():
             gpar.dedup = par
         elif opt in ('-r', '--repl'):
             gpar.replace = par
+        elif opt in ('-P', '--prefix'):
+            gpar.prefix = True
 
     setup_logging(gpar.loglevel, gpar.logfile, gpar.syslog)
 
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# Author: Hans-Peter Jansen <hpj@urpla.net>
+# License: GNU GPL 2 - see http://www.gnu.org/licenses/gpl2.txt for details
+# vim:set et ts=8 sw=4:
+
+# fetch worker process: the fetch policy, queue and fetchers run in a child
+# process, that the helper feeds with the requests of rewritten URLs through
+# a pipe, thus the dedup thread only matches and replies
+
+import os
+import sys
+import time
+import fcntl
+import select
+import logging
+import subprocess
+
+from dedup import DEDUP_TIMEOUT
+from policy import FetchPolicy
+from lib import linereader
+from lib import profile
+
+log = logging.getLogger('worker')
+
+# min. seconds between restarts of a terminated worker
+RESTART_DELAY = 5.0
+# seconds to wait for the worker to finish, before it is terminated
+EXIT_TIMEOUT = 5.0
+# feed records: section, newurl and url, separated by tabs
+SEPARATOR = b'\t'
+
+
+class FetchWorker:
+    """ spawn and supervise the fetch worker process, and feed it in place of
+        a FetchPolicy: the pipe doesn't block, requests are dropped, while
+        the worker lags behind or restarts
+    """
+    def __init__(self, config):
+        self._config = config
+        self._proc = None
+        self._pipe = None
+        # the pipe, the dedup thread writes to: it closes the previous one,
+        # when it takes over a new one
+        self._feeding = None
+        self._started = 0
+        self.restarts = 0
+        self.fed = 0
+        self.dropped = 0
+
+    def start(self):
+        """ spawn the worker: this script with the same arguments """
+        args = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+        args.append('--fetch-worker')
+        # stdout is reserved for squid
+        proc = subprocess.Popen(args, stdin = subprocess.PIPE,
+                                stdout = subprocess.DEVNULL, bufsize = 0)
+        fd = proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # a single reference assignment: the dedup thread takes over the new
+        # pipe with its next request, thus no pipe is closed under its hands
+        self._pipe = proc.stdin
+        self._proc = proc
+        self._started = time.monotonic()
+        log.info('fetch worker started (%s)', proc.pid)
+
+    def request(self, section, newurl, url):
+        """ feed the worker with a request of newurl via url """
+        record = SEPARATOR.join((section.name.encode('utf-8'), newurl.encode('utf-8'),
+                                 url.encode('utf-8'))) + b'\n'
+        # longer records might be written partially
+        if len(record) > select.PIPE_BUF:
+            log.debug('fetch worker: record of <%s> too long', newurl)
+            self.dropped += 1
+            return
+        pipe = self._pipe
+        if pipe is not self._feeding:
+            if self._feeding is not None:
+                self._feeding.close()
+            self._feeding = pipe
+        try:
+            n = pipe.write(record)
+        except OSError:
+            # the worker is gone
+            n = None
+        if n is None:
+            self.dropped += 1
+        else:
+            self.fed += 1
+
+    def check(self):
+        """ restart a terminated worker, returns False, while it isn't running """
+        ret = self._proc.poll()
+        if ret is None:
+            return True
+        if time.monotonic() - self._started < RESTART_DELAY:
+            return False
+        log.error('fetch worker (%s) terminated with %s: restarting', self._proc.pid, ret)
+        self.restarts += 1
+        self.start()
+        return False
+
+    def signal(self, sig):
+        """ pass a signal on to the worker """
+        if self._proc.poll() is None:
+            self._proc.send_signal(sig)
+
+    def exit(self):
+        """ close the feed, wait for the worker to finish, and terminate
+            it, if it didn't in time
+        """
+        for pipe in (self._feeding, self._pipe):
+            if pipe is not None:
+                pipe.close()
+        try:
+            self._proc.wait(EXIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            log.error('fetch worker (%s) did not finish: terminated', self._proc.pid)
+            self._proc.terminate()
+            self._proc.wait()
+        log.info('fetch worker (%s) finished with %s', self._proc.pid, self._proc.returncode)
+
+    def stats(self):
+        return dict(pid = self._proc.pid, running = self._proc.poll() is None,
+                    restarts = self.restarts, fed = self.fed, dropped = self.dropped)
+
+
+class Feed:
+    """ worker side: read the requests of the helper from stdin, and pass
+        them to the fetch policy, ends with the helper
+    """
+
+    # stdin reader: keeps partial records across reloads
+    _reader = None
+
+    def __init__(self, config):
+        self._config = config
+        self._exiting = False
+        self._ruleset = config.ruleset
+        self._policy = FetchPolicy(config)
+
+    def exit(self):
+        self._exiting = True
+
+    def process(self, record):
+        try:
+            name, newurl, url = record.decode('utf-8', 'replace').split('\t')
+        except ValueError:
+            log.error('invalid feed record <%s>', record)
+            return
+        section = self._config.section_dict.get(name)
+        # unknown after a reload, or fetching disabled meanwhile
+        if section is not None and section.fetch:
+            self._policy.request(section, newurl, url)
+
+    @profile.profile('feed')
+    def run(self):
+        log.debug('running')
+        if Feed._reader is None:
+            Feed._reader = linereader.LineReader(sys.stdin.fileno())
+        reader = Feed._reader
+        while not self._exiting:
+            self._profiler.check()
+            if self._config.ruleset is not self._ruleset:
+                # reloaded: apply the fetch policy settings
+                self._ruleset = self._config.ruleset
+                self._policy = FetchPolicy(self._config)
+            if reader.wait(DEDUP_TIMEOUT):
+                eof = not reader.fill()
+                for record in reader.lines():
+                    self.process(record)
+                if eof:
+                    log.info('feed closed. Ending the process.')
+                    break
+        log.debug('finished')